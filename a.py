@@ -4,42 +4,3446 @@ Pixabay Music Downloader Tool
 Tải nhạc MP3 từ Pixabay với khả năng chọn range
 """
 
-import requests
-from bs4 import BeautifulSoup
 import re
 import os
+import sys
 import urllib.parse
 from urllib.parse import urljoin
 import time
 import json
+import hashlib
+import heapq
+import bisect
+import itertools
+import functools
+import importlib
+import importlib.util
+import unicodedata
+from array import array
+import queue
+import socket
+import tarfile
+import zipfile
+import tempfile
+import contextvars
 from typing import List, Dict, Optional
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import contextlib
+from contextlib import contextmanager
 import threading
 from threading import Lock
 
+try:
+    import fcntl  # Khóa file cho manifest dùng chung giữa nhiều process (không có trên Windows)
+except ImportError:
+    fcntl = None
+
+class LazyModule:
+    """
+    Module chỉ được import ở lần đầu dùng tới (truy cập attribute).
+    requests, bs4, httpx, asyncio tốn hàng trăm ms để import - `--help`, `catalog ...` không cần tới chúng
+    """
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def available(self) -> bool:
+        """
+        Module có cài không - không import (dùng cho dependency tùy chọn)
+        """
+        return self._module is not None or importlib.util.find_spec(self._name) is not None
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    def __repr__(self) -> str:
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f"<LazyModule {self._name} ({state})>"
+
+
+requests = LazyModule('requests')
+bs4 = LazyModule('bs4')
+asyncio = LazyModule('asyncio')
+# Chỉ dùng cho profile / báo cáo bộ nhớ
+cProfile = LazyModule('cProfile')
+pstats = LazyModule('pstats')
+tracemalloc = LazyModule('tracemalloc')
+httpx = LazyModule('httpx')  # Tùy chọn: pip install 'httpx[http2]' để bật HTTP/2
+lxml_etree = LazyModule('lxml.etree')  # Parse streaming trang tìm kiếm (HTMLPullParser)
+
+# Content-Type của các response lỗi/HTML - gặp là dừng transfer ngay
+ERROR_CONTENT_TYPES = ('text/html', 'text/plain', 'application/json', 'application/xml', 'text/xml')
+
+# Engine async gom chunk thành lô cỡ này trước khi ghi vào sink trong thread
+ASYNC_WRITE_BATCH = 1024 * 1024
+
+
+class DownloadIntegrityError(Exception):
+    """
+    File tải về không hợp lệ (HTML/lỗi, bị cắt ngắn, sai độ dài...)
+    """
+
+
+def sniff_audio_header(head: bytes) -> str:
+    """
+    Nhận diện loại nội dung từ vài bytes đầu tiên
+    Returns: 'id3' | 'mpeg' | 'text' | 'unknown'
+    """
+    if head.startswith(b'ID3'):
+        return 'id3'
+    # MPEG frame sync: 11 bit đầu đều là 1
+    if len(head) >= 2 and head[0] == 0xFF and (head[1] & 0xE0) == 0xE0:
+        return 'mpeg'
+    stripped = head.lstrip(b'\xef\xbb\xbf \t\r\n')
+    if stripped[:1] in (b'<', b'{', b'['):
+        return 'text'
+    return 'unknown'
+
+
+class StreamVerifier:
+    """
+    Kiểm tra file ngay trong lúc stream (không cần đọc lại file):
+    đếm bytes so với Content-Length, tính SHA-256 dần dần và sniff header MP3
+    """
+    SNIFF_BYTES = 16
+
+    def __init__(self, expected_length: Optional[int] = None):
+        self.expected_length = expected_length
+        self.bytes_received = 0
+        self.kind = None
+        self._sha256 = hashlib.sha256()
+        self._head = b''
+
+    def feed(self, chunk: bytes):
+        """
+        Cập nhật với một chunk mới - raise DownloadIntegrityError nếu payload là HTML/lỗi
+        """
+        if self.kind is None:
+            self._head = (self._head + chunk)[:self.SNIFF_BYTES]
+            if len(self._head) >= self.SNIFF_BYTES:
+                self._sniff()
+        
+        self.bytes_received += len(chunk)
+        if self.expected_length is not None and self.bytes_received > self.expected_length:
+            raise DownloadIntegrityError(
+                f"Nhận {self.bytes_received:,} bytes, vượt Content-Length {self.expected_length:,}")
+        self._sha256.update(chunk)
+
+    def finalize(self) -> str:
+        """
+        Kết thúc stream - kiểm tra độ dài và trả về SHA-256 hex
+        """
+        if self.kind is None:
+            self._sniff()
+        if self.bytes_received == 0:
+            raise DownloadIntegrityError("Response rỗng")
+        if self.expected_length is not None and self.bytes_received != self.expected_length:
+            raise DownloadIntegrityError(
+                f"Transfer bị cắt ngắn: {self.bytes_received:,}/{self.expected_length:,} bytes")
+        return self._sha256.hexdigest()
+
+    def _sniff(self):
+        self.kind = sniff_audio_header(self._head)
+        if self.kind == 'text':
+            preview = self._head.decode('utf-8', errors='replace').strip()
+            raise DownloadIntegrityError(f"Payload là HTML/text, không phải audio: {preview!r}")
+
+    @staticmethod
+    def expected_length_from(headers) -> Optional[int]:
+        """
+        Lấy Content-Length - bỏ qua khi response bị nén (iter_content trả về bytes đã giải nén)
+        """
+        encoding = headers.get('content-encoding', '').lower()
+        if encoding and encoding != 'identity':
+            return None
+        try:
+            return int(headers.get('content-length', ''))
+        except ValueError:
+            return None
+
+
+class BandwidthLimiter:
+    """
+    Token bucket giới hạn tổng bytes/giây, dùng chung cho mọi thread download
+    rate = 0 nghĩa là không giới hạn. Có thể đổi rate khi đang chạy.
+    """
+    def __init__(self, rate: float = 0, burst: Optional[float] = None):
+        self._lock = Lock()
+        self._tokens = 0.0
+        self._last_refill = time.monotonic()
+        self.rate = 0.0
+        self.burst = 0.0
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate: float, burst: Optional[float] = None):
+        """
+        Đổi giới hạn băng thông (bytes/giây) lúc runtime
+        """
+        with self._lock:
+            self._refill()
+            self.rate = max(float(rate), 0.0)
+            # Mặc định cho phép burst 1 giây, tối thiểu 64KB để chunk đầu không phải chờ
+            self.burst = float(burst) if burst else max(self.rate, 64 * 1024)
+            self._tokens = min(self._tokens, self.burst)
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate > 0:
+            self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def reserve(self, amount: int) -> float:
+        """
+        Trừ token cho amount bytes và trả về số giây cần chờ.
+        Token được phép âm (nợ) nên các thread đến sau sẽ chờ lâu hơn - chia đều băng thông.
+        """
+        with self._lock:
+            if self.rate <= 0:
+                return 0.0
+            self._refill()
+            self._tokens -= amount
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def consume(self, amount: int):
+        """
+        Block cho đến khi được phép dùng amount bytes
+        """
+        delay = self.reserve(amount)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class AdjustableSemaphore:
+    """
+    Semaphore có thể đổi số slot lúc đang chạy (threading.Semaphore thì không)
+    """
+    def __init__(self, limit: int):
+        self._cond = threading.Condition()
+        self._limit = max(int(limit), 1)
+        self._active = 0
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    def set_limit(self, limit: int):
+        with self._cond:
+            self._limit = max(int(limit), 1)
+            self._cond.notify_all()
+
+    def acquire(self):
+        with self._cond:
+            while self._active >= self._limit:
+                self._cond.wait()
+            self._active += 1
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class AsyncLimit:
+    """
+    Bản asyncio của AdjustableSemaphore cho engine async: limit là hàm, đọc lại mỗi lần acquire
+    nên giới hạn đổi lúc runtime (HostConcurrencyLimiter.set_limit, AIMD) có hiệu lực ngay.
+    Tạo bên trong event loop đang chạy
+    """
+    def __init__(self, limit):
+        self._limit = limit
+        self._active = 0
+        self._cond = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._active < max(self._limit(), 1))
+            self._active += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self._cond:
+            self._active -= 1
+            # notify_all: limit có thể đã tăng, nhiều coroutine cùng được chạy
+            self._cond.notify_all()
+
+
+class HostConcurrencyLimiter:
+    """
+    Giới hạn số request đồng thời theo từng host (pixabay.com vs cdn.pixabay.com)
+    """
+    DEFAULT_LIMITS = {
+        'pixabay.com': 3,
+        'cdn.pixabay.com': 6,
+    }
+
+    def __init__(self, limits: Optional[Dict[str, int]] = None, default_limit: int = 8):
+        self._lock = Lock()
+        self.default_limit = default_limit
+        self._slots = {}
+        for host, limit in (limits if limits is not None else self.DEFAULT_LIMITS).items():
+            self._slots[host] = AdjustableSemaphore(limit)
+
+    def slot(self, url: str) -> AdjustableSemaphore:
+        """
+        Trả về semaphore của host trong URL - dùng với `with limiter.slot(url):`
+        """
+        host = (urllib.parse.urlparse(url).hostname or '').lower()
+        with self._lock:
+            if host not in self._slots:
+                self._slots[host] = AdjustableSemaphore(self.default_limit)
+            return self._slots[host]
+
+    def set_limit(self, host: str, limit: int):
+        """
+        Đổi giới hạn của một host lúc runtime
+        """
+        host = host.lower()
+        with self._lock:
+            if host in self._slots:
+                self._slots[host].set_limit(limit)
+            else:
+                self._slots[host] = AdjustableSemaphore(limit)
+
+    def limits(self) -> Dict[str, int]:
+        with self._lock:
+            return {host: slot.limit for host, slot in self._slots.items()}
+
+
+class DNSCache:
+    """
+    Cache kết quả getaddrinfo (có TTL) cho các host trong `hosts`: kết nối mới tới pixabay.com / cdn.pixabay.com
+    (requests, httpx, cả engine async) không phải resolve DNS lại. Bật bằng install(), tắt bằng uninstall().
+    install() thay socket.getaddrinfo của cả process - host ngoài `hosts` đi thẳng tới resolver thật, không cache.
+    getaddrinfo không trả về TTL của bản ghi DNS nên cache dùng TTL cố định `ttl` (ngắn, mặc định 60s)
+    - CDN đổi IP thì kết nối mới chậm nhất sau `ttl` giây mới thấy
+    """
+    def __init__(self, ttl: float = 60, hosts: Optional[List[str]] = None):
+        self.ttl = ttl
+        # None = cache mọi host
+        self.hosts = {host.lower() for host in hosts} if hosts is not None else None
+        self._lock = Lock()
+        self._entries = {}  # (host, port) -> (hết hạn lúc, kết quả getaddrinfo)
+        self._original = None
+        self.hits = 0
+        self.misses = 0
+
+    def install(self):
+        module = importlib.import_module('socket')
+        if self._original is None:
+            self._original = module.getaddrinfo
+            module.getaddrinfo = self._getaddrinfo
+
+    def uninstall(self):
+        if self._original is not None:
+            importlib.import_module('socket').getaddrinfo = self._original
+            self._original = None
+
+    def resolve(self, host: str, port: int) -> list:
+        """
+        Resolve trước (prefetch) - trả về danh sách địa chỉ, lỗi DNS thì ném socket.gaierror
+        """
+        return self._getaddrinfo(host, port)
+
+    def _getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        lookup = self._original or importlib.import_module('socket').getaddrinfo
+        if flags or not isinstance(host, str) or (self.hosts is not None and host.lower() not in self.hosts):
+            return lookup(host, port, family, type, proto, flags)
+        key = (host.lower(), port)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                results = entry[1]
+            else:
+                results = None
+        if results is None:
+            # Lưu kết quả đầy đủ (mọi family/type), lọc theo tham số ở dưới
+            results = lookup(host, port, 0, 0, 0, 0)
+            with self._lock:
+                self.misses += 1
+                self._entries[key] = (now + self.ttl, results)
+        return [result for result in results
+                if (not family or result[0] == family) and (not type or result[1] == type)
+                and (not proto or result[2] == proto)]
+
+
+class ConnectionWarmer:
+    """
+    Mở sẵn kết nối keep-alive tới các host sắp dùng (trả trước DNS + TCP + TLS) trong lúc user đang chọn
+    range hoặc crawl đang chạy, rồi giữ chúng sống qua các khoảng nghỉ bằng request HEAD định kỳ.
+    request(url) gửi một request nhẹ qua session/pool dùng chung; host đang bận thì bỏ qua lượt ping.
+    """
+    def __init__(self, request, origins: List[str], connections: int = 2, interval: float = 30.0,
+                 dns_cache: Optional[DNSCache] = None, host_limiter: Optional[HostConcurrencyLimiter] = None):
+        self.request = request
+        self.origins = list(dict.fromkeys(origins))
+        self.connections = max(int(connections), 1)
+        self.interval = interval
+        self.dns_cache = dns_cache
+        self.host_limiter = host_limiter
+        self.warmed = {}  # origin -> thời gian lượt warm đầu tiên (giây)
+        self.pings = 0
+        self._stop_event = threading.Event()
+        self._warm_done = threading.Event()
+        self._thread = None
+
+    def _connections_for(self, origin: str) -> int:
+        if self.host_limiter is None:
+            return self.connections
+        return min(self.connections, self.host_limiter.slot(origin).limit)
+
+    def warm(self, skip_busy: bool = False) -> Dict[str, float]:
+        """
+        Resolve DNS rồi mở song song tối đa `connections` kết nối mỗi host - trả về thời gian mỗi host
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        origins = [origin for origin in self.origins
+                   if not (skip_busy and self.host_limiter is not None and self.host_limiter.slot(origin).active)]
+        if self.dns_cache is not None:
+            for origin in origins:
+                parsed = urllib.parse.urlparse(origin)
+                try:
+                    self.dns_cache.resolve(parsed.hostname, parsed.port or (443 if parsed.scheme == 'https' else 80))
+                except OSError:
+                    pass
+        timings = {}
+
+        def warm_origin(origin: str):
+            started_at = time.monotonic()
+            # Các request chạy cùng lúc nên mỗi request giữ một kết nối riêng trong pool
+            with ThreadPoolExecutor(max_workers=self._connections_for(origin)) as executor:
+                list(executor.map(lambda _: self.request(origin), range(self._connections_for(origin))))
+            timings[origin] = time.monotonic() - started_at
+
+        with ThreadPoolExecutor(max_workers=max(len(origins), 1)) as executor:
+            list(executor.map(warm_origin, origins))
+        return timings
+
+    def _run(self):
+        self.warmed = self.warm()
+        self._warm_done.set()
+        while not self._stop_event.wait(self.interval):
+            self.warm(skip_busy=True)
+            self.pings += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='ConnectionWarmer', daemon=True)
+        self._thread.start()
+        return self
+
+    def wait_warm(self, timeout: Optional[float] = None) -> bool:
+        """
+        Chờ lượt warm đầu tiên xong (nếu cần số liệu) - trả về False nếu hết timeout
+        """
+        return self._warm_done.wait(timeout)
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+
+class AIMDController:
+    """
+    Tự điều chỉnh số worker active của một stage (crawl/resolve/download) theo AIMD:
+    tăng 1 khi mọi thứ ổn, giảm một nửa khi gặp 403/429, latency tăng vọt hoặc throughput sụt.
+    Latency là thứ caller ghi vào record(): thời gian cả job cho crawl/resolve, time-to-first-byte cho download
+    (thời gian tải cả file tăng theo kích thước file chứ không theo tải của server)
+    """
+    BLOCKED_STATUSES = (403, 429)
+
+    def __init__(self, stage: str, initial: int = 1, minimum: int = 1, maximum: int = 8, window: int = 4,
+                 block_threshold: float = 0.1, latency_factor: float = 2.0, print_lock: Optional[Lock] = None):
+        self.stage = stage
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = window
+        self.block_threshold = block_threshold
+        self.latency_factor = latency_factor
+        self.semaphore = AdjustableSemaphore(min(max(initial, minimum), maximum))
+        self.decisions = []
+        self._print_lock = print_lock or Lock()
+        self._lock = Lock()
+        self._samples = []
+        self._window_started = time.monotonic()
+        self._best_latency = None
+        self._last_throughput = None
+        self._last_action = None
+
+    @property
+    def limit(self) -> int:
+        return self.semaphore.limit
+
+    def __enter__(self):
+        self.semaphore.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.semaphore.release()
+
+    def record(self, latency: float, statuses: List[int], nbytes: int = 0, ok: bool = True):
+        """
+        Ghi nhận một request/job đã xong - đủ window mẫu thì ra quyết định
+        """
+        with self._lock:
+            self._samples.append((latency, statuses, nbytes, ok))
+            if len(self._samples) >= self.window:
+                self._adjust()
+
+    def _adjust(self):
+        samples, self._samples = self._samples, []
+        now = time.monotonic()
+        elapsed = max(now - self._window_started, 1e-6)
+        self._window_started = now
+        
+        blocked = sum(1 for _, statuses, _, _ in samples if any(code in self.BLOCKED_STATUSES for code in statuses))
+        block_rate = blocked / len(samples)
+        latencies = sorted(latency for latency, _, _, _ in samples)
+        median_latency = latencies[len(latencies) // 2]
+        total_bytes = sum(nbytes for _, _, nbytes, _ in samples)
+        # Stage không có bytes (crawl/resolve) thì đo throughput theo số job/giây
+        throughput = (total_bytes if total_bytes else len(samples)) / elapsed
+        if self._best_latency is None or median_latency < self._best_latency:
+            self._best_latency = median_latency
+        
+        old_limit = self.limit
+        if block_rate > self.block_threshold:
+            new_limit = max(self.minimum, old_limit // 2)
+            reason = f"bị chặn {block_rate:.0%} (403/429)"
+        elif median_latency > self._best_latency * self.latency_factor:
+            new_limit = max(self.minimum, old_limit // 2)
+            reason = f"latency {median_latency:.2f}s > {self.latency_factor:g}x tốt nhất {self._best_latency:.2f}s"
+        elif self._last_action == 'increase' and self._last_throughput and throughput < self._last_throughput * 0.75:
+            new_limit = max(self.minimum, old_limit // 2)
+            reason = f"throughput sụt {throughput:,.1f} < {self._last_throughput:,.1f}/s sau khi tăng"
+        else:
+            new_limit = min(self.maximum, old_limit + 1)
+            reason = f"ổn định (throughput {throughput:,.1f}/s, latency {median_latency:.2f}s)"
+        
+        self._last_throughput = throughput
+        self._last_action = 'increase' if new_limit > old_limit else ('decrease' if new_limit < old_limit else 'hold')
+        if new_limit != old_limit:
+            self.semaphore.set_limit(new_limit)
+        self.decisions.append({'time': time.time(), 'stage': self.stage, 'from': old_limit,
+                               'to': new_limit, 'reason': reason})
+        with self._print_lock:
+            print(f"🎛️  [AIMD {self.stage}] {old_limit} → {new_limit} workers: {reason}")
+
+
+class HttpxStreamResponse:
+    """
+    Bọc httpx.Response (stream) để có cùng interface với requests.Response
+    mà vòng lặp download đang dùng (headers, status_code, iter_content, close...)
+    """
+    def __init__(self, response):
+        self._response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.http_version = response.http_version
+
+    def raise_for_status(self):
+        self._response.raise_for_status()
+
+    def iter_content(self, chunk_size: int = 8192):
+        return self._response.iter_bytes(chunk_size=chunk_size)
+
+    def close(self):
+        self._response.close()
+
+
+class LocalFileWriter:
+    """
+    Writer của LocalFileSink: ghi ra file .part, commit mới rename thành tên thật
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.part_path = path + '.part'
+        # Layout theo trang/hash ghi vào thư mục con
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._file = open(self.part_path, 'wb')
+
+    def write(self, chunk: bytes):
+        self._file.write(chunk)
+
+    def commit(self):
+        self._file.close()
+        os.replace(self.part_path, self.path)
+
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
+
+
+class LocalFileSink:
+    """
+    Storage sink mặc định: lưu file vào thư mục local
+    """
+    def __init__(self, folder: str):
+        self.folder = folder
+
+    def describe(self) -> str:
+        return os.path.abspath(self.folder)
+
+    def prepare(self):
+        os.makedirs(self.folder, exist_ok=True)
+
+    def list_names(self) -> List[str]:
+        if not os.path.exists(self.folder):
+            return []
+        return os.listdir(self.folder)
+
+    def open_writer(self, name: str) -> LocalFileWriter:
+        return LocalFileWriter(os.path.join(self.folder, name))
+
+    def delete(self, name: str):
+        os.remove(os.path.join(self.folder, name))
+
+    def close(self):
+        pass
+
+
+class S3MultipartWriter:
+    """
+    Writer stream thẳng lên S3 bằng multipart upload.
+    Chỉ giữ tối đa 1 part đang gom + max_parallel_parts part đang upload trong bộ nhớ.
+    """
+    def __init__(self, sink: 'S3MultipartSink', key: str):
+        self.sink = sink
+        self.key = key
+        self.upload_id = None
+        self._buffer = bytearray()
+        self._futures = []
+        self._inflight = threading.BoundedSemaphore(sink.max_parallel_parts)
+
+    def write(self, chunk: bytes):
+        self._buffer += chunk
+        while len(self._buffer) >= self.sink.part_size:
+            part = bytes(self._buffer[:self.sink.part_size])
+            del self._buffer[:self.sink.part_size]
+            self._upload_part(part)
+
+    def _upload_part(self, data: bytes):
+        if self.upload_id is None:
+            response = self.sink.client.create_multipart_upload(Bucket=self.sink.bucket, Key=self.key)
+            self.upload_id = response['UploadId']
+        
+        part_number = len(self._futures) + 1
+        # Chờ khi đã có đủ part đang upload - giữ bộ nhớ có giới hạn
+        self._inflight.acquire()
+        try:
+            future = self.sink.executor.submit(
+                self.sink.client.upload_part, Bucket=self.sink.bucket, Key=self.key,
+                UploadId=self.upload_id, PartNumber=part_number, Body=data)
+        except Exception:
+            self._inflight.release()
+            raise
+        future.add_done_callback(lambda _: self._inflight.release())
+        self._futures.append((part_number, future))
+
+    def commit(self):
+        if self.upload_id is None:
+            # File nhỏ hơn 1 part - upload một lần
+            self.sink.client.put_object(Bucket=self.sink.bucket, Key=self.key, Body=bytes(self._buffer))
+            self._buffer = bytearray()
+            return
+        
+        if self._buffer:
+            self._upload_part(bytes(self._buffer))
+            self._buffer = bytearray()
+        parts = [{'PartNumber': part_number, 'ETag': future.result()['ETag']}
+                 for part_number, future in self._futures]
+        self.sink.client.complete_multipart_upload(
+            Bucket=self.sink.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': parts})
+
+    def abort(self):
+        self._buffer = bytearray()
+        if self.upload_id is not None:
+            for _, future in self._futures:
+                future.cancel()
+            try:
+                self.sink.client.abort_multipart_upload(Bucket=self.sink.bucket, Key=self.key, UploadId=self.upload_id)
+            except Exception as e:
+                print(f"⚠️  Không abort được multipart upload {self.key}: {e}")
+
+
+class S3MultipartSink:
+    """
+    Storage sink S3-compatible (AWS S3, MinIO...) - track đi thẳng từ stream download
+    lên bucket, không chạm ổ đĩa local. Cần boto3 (tùy chọn).
+    """
+    MIN_PART_SIZE = 5 * 1024 * 1024
+
+    def __init__(self, bucket: str, prefix: str = '', endpoint_url: Optional[str] = None,
+                 part_size: int = 8 * 1024 * 1024, max_parallel_parts: int = 4, upload_threads: int = 8,
+                 client=None):
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.endpoint_url = endpoint_url
+        # S3 yêu cầu mọi part (trừ part cuối) >= 5MB
+        self.part_size = max(part_size, self.MIN_PART_SIZE)
+        self.max_parallel_parts = max_parallel_parts
+        if client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise RuntimeError("S3 sink cần boto3 - chạy: pip install boto3")
+            client = boto3.client('s3', endpoint_url=endpoint_url)
+        self.client = client
+        from concurrent.futures import ThreadPoolExecutor
+        self.executor = ThreadPoolExecutor(max_workers=upload_threads, thread_name_prefix="S3Upload")
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs) -> 'S3MultipartSink':
+        """
+        Tạo sink từ URL dạng s3://bucket/prefix
+        """
+        parsed = urllib.parse.urlparse(url)
+        return cls(parsed.netloc, parsed.path, **kwargs)
+
+    def describe(self) -> str:
+        endpoint = f" ({self.endpoint_url})" if self.endpoint_url else ""
+        return f"s3://{self.bucket}/{self.prefix}{endpoint}"
+
+    def prepare(self):
+        pass
+
+    def list_names(self) -> List[str]:
+        names = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for obj in page.get('Contents', []):
+                names.append(obj['Key'][len(self.prefix):])
+        return names
+
+    def open_writer(self, name: str) -> S3MultipartWriter:
+        return S3MultipartWriter(self, self.prefix + name)
+
+    def delete(self, name: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + name)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+class ArchiveMemberWriter:
+    """
+    Writer của ArchiveSink: gom dữ liệu track vào SpooledTemporaryFile (RAM, tràn ra đĩa khi lớn)
+    rồi giao cho writer thread duy nhất của sink ghi vào archive
+    """
+    def __init__(self, sink: 'ArchiveSink', name: str):
+        self.sink = sink
+        self.name = name
+        self._spool = tempfile.SpooledTemporaryFile(max_size=sink.spool_max_memory)
+
+    def write(self, chunk: bytes):
+        self._spool.write(chunk)
+
+    def commit(self):
+        size = self._spool.tell()
+        self._spool.seek(0)
+        # Chờ writer thread ghi xong để caller biết chắc track đã nằm trong archive
+        self.sink._submit('add', self.name, self._spool, size).result()
+
+    def abort(self):
+        self._spool.close()
+
+
+class ArchiveSink:
+    """
+    Storage sink gom track vào các archive tar (hoặc zip không nén) xoay vòng theo dung lượng,
+    thay vì hàng nghìn file nhỏ. Mọi thao tác ghi đi qua một writer thread nên các thread
+    download không tranh nhau archive. Mỗi archive có file index JSON (offset từng member)
+    để đọc ngẫu nhiên mà không cần quét cả archive. Trong lúc ghi, mỗi member được nối thêm một
+    dòng vào <archive>.index.jsonl; index JSON đầy đủ chỉ ghi khi đóng archive (xoay vòng/close).
+    Archive dở dang do crash được dựng lại index từ file JSONL ở lần prepare sau.
+    """
+    def __init__(self, folder: str, archive_format: str = 'tar', max_archive_bytes: int = 1024 * 1024 * 1024,
+                 basename: str = 'batch', spool_max_memory: int = 8 * 1024 * 1024, queue_size: int = 16):
+        if archive_format not in ('tar', 'zip'):
+            raise ValueError(f"Định dạng archive không hỗ trợ: {archive_format}")
+        self.folder = folder
+        self.archive_format = archive_format
+        self.max_archive_bytes = max_archive_bytes
+        self.basename = basename
+        self.spool_max_memory = spool_max_memory
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._archive = None
+        self._archive_path = None
+        self._archive_number = 0
+        self._members = {}
+        self._index_log = None
+        self._names_lock = Lock()
+        self._written_names = set()
+
+    def describe(self) -> str:
+        size_mb = self.max_archive_bytes / (1024 * 1024)
+        return f"{os.path.abspath(self.folder)} ({self.basename}-NNNN.{self.archive_format}, xoay vòng {size_mb:,.0f}MB)"
+
+    def prepare(self):
+        os.makedirs(self.folder, exist_ok=True)
+        if self._thread is None:
+            # Không bao giờ ghi tiếp vào archive cũ - luôn mở số mới để offset trong index cố định
+            pattern = re.compile(rf'^{re.escape(self.basename)}-(\d+)\.{self.archive_format}$')
+            numbers = [int(m.group(1)) for m in map(pattern.match, os.listdir(self.folder)) if m]
+            self._archive_number = max(numbers, default=0)
+            self._recover_index_logs()
+            self._thread = threading.Thread(target=self._writer_loop, name="ArchiveWriter", daemon=True)
+            self._thread.start()
+
+    def list_names(self) -> List[str]:
+        names = set()
+        if os.path.exists(self.folder):
+            for filename in os.listdir(self.folder):
+                if filename.endswith('.index.json'):
+                    try:
+                        with open(os.path.join(self.folder, filename), encoding='utf-8') as f:
+                            members = json.load(f)['members']
+                        names.update(name for name, info in members.items() if not info.get('deleted'))
+                    except (OSError, ValueError, KeyError) as e:
+                        print(f"⚠️  Không đọc được index {filename}: {e}")
+        with self._names_lock:
+            names.update(self._written_names)
+        return sorted(names)
+
+    def open_writer(self, name: str) -> ArchiveMemberWriter:
+        return ArchiveMemberWriter(self, name)
+
+    def delete(self, name: str):
+        # Archive chỉ ghi nối tiếp - đánh dấu deleted trong index thay vì xóa dữ liệu
+        self._submit('delete', name, None, 0).result()
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _submit(self, action: str, name: str, spool, size: int) -> 'Future':
+        from concurrent.futures import Future
+        future = Future()
+        self._queue.put((action, name, spool, size, future))
+        return future
+
+    def _writer_loop(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            action, name, spool, size, future = job
+            try:
+                if action == 'add':
+                    self._append_member(name, spool, size)
+                else:
+                    self._mark_deleted(name)
+                future.set_result(name)
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                if spool is not None:
+                    spool.close()
+        self._finish_archive()
+
+    def _append_member(self, name: str, spool, size: int):
+        if self._archive is not None and self._members and \
+                self._archive_size() + size > self.max_archive_bytes:
+            self._finish_archive()
+        if self._archive is None:
+            self._start_archive()
+        
+        if self.archive_format == 'tar':
+            info = tarfile.TarInfo(name)
+            info.size = size
+            info.mtime = int(time.time())
+            header_offset = self._archive.offset
+            self._archive.addfile(info, spool)
+            # Header (có thể kèm PAX header cho tên unicode) nằm trước, data được pad tới block 512 bytes
+            padded_size = -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            data_offset = self._archive.offset - padded_size
+        else:
+            info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            with self._archive.open(info, 'w', force_zip64=size > 0xFFFFFFFF) as dest:
+                data_offset = self._archive.fp.tell()
+                for chunk in iter(lambda: spool.read(1024 * 1024), b''):
+                    dest.write(chunk)
+            header_offset = info.header_offset
+        
+        self._members[name] = {'header_offset': header_offset, 'offset': data_offset, 'size': size}
+        self._log_index_entry({'name': name, **self._members[name]})
+        with self._names_lock:
+            self._written_names.add(name)
+
+    def _mark_deleted(self, name: str):
+        if name in self._members:
+            self._members[name]['deleted'] = True
+            self._log_index_entry({'name': name, 'deleted': True})
+        else:
+            # Member nằm trong archive cũ - sửa index của archive đó
+            for filename in os.listdir(self.folder):
+                if not filename.endswith('.index.json'):
+                    continue
+                index_path = os.path.join(self.folder, filename)
+                with open(index_path, encoding='utf-8') as f:
+                    index = json.load(f)
+                if name in index['members']:
+                    index['members'][name]['deleted'] = True
+                    self._write_json_atomic(index_path, index)
+                    break
+        with self._names_lock:
+            self._written_names.discard(name)
+
+    def _archive_fileobj(self):
+        return self._archive.fileobj if self.archive_format == 'tar' else self._archive.fp
+
+    def _archive_size(self) -> int:
+        # Vị trí ghi của file object - getsize() không tính phần còn trong buffer
+        return self._archive_fileobj().tell()
+
+    def _log_index_entry(self, entry: Dict):
+        """
+        Nối một dòng vào index JSONL của archive đang ghi - O(1) mỗi member thay vì ghi lại cả index
+        """
+        # Data của member phải nằm trong file trước khi index trỏ tới
+        self._archive_fileobj().flush()
+        self._index_log.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self._index_log.flush()
+
+    def _recover_index_logs(self):
+        """
+        Archive bị crash giữa chừng chỉ có index JSONL - dựng index JSON (complete=false) từ đó.
+        Tar thiếu block kết thúc / zip thiếu central directory, member vẫn đọc được theo offset
+        """
+        for filename in os.listdir(self.folder):
+            if not filename.endswith('.index.jsonl'):
+                continue
+            log_path = os.path.join(self.folder, filename)
+            archive_path = log_path[:-len('.index.jsonl')]
+            members = {}
+            with open(log_path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Dòng cuối dở dang do crash
+                        continue
+                    name = entry.pop('name')
+                    if entry.get('deleted'):
+                        if name in members:
+                            members[name]['deleted'] = True
+                    else:
+                        members[name] = entry
+            if os.path.exists(archive_path):
+                self._write_json_atomic(archive_path + '.index.json', {
+                    'archive': os.path.basename(archive_path),
+                    'format': self.archive_format,
+                    'size': os.path.getsize(archive_path),
+                    'complete': False,
+                    'members': members,
+                })
+                print(f"🩹 Dựng lại index archive dở dang {os.path.basename(archive_path)}: {len(members)} tracks")
+            os.remove(log_path)
+
+    def _start_archive(self):
+        self._archive_number += 1
+        filename = f"{self.basename}-{self._archive_number:04d}.{self.archive_format}"
+        self._archive_path = os.path.join(self.folder, filename)
+        if self.archive_format == 'tar':
+            self._archive = tarfile.open(self._archive_path, 'w', format=tarfile.PAX_FORMAT)
+        else:
+            self._archive = zipfile.ZipFile(self._archive_path, 'w', zipfile.ZIP_STORED, allowZip64=True)
+        self._members = {}
+        self._index_log = open(self._archive_path + '.index.jsonl', 'w', encoding='utf-8')
+        print(f"🗜️  Mở archive mới: {filename}")
+
+    def _finish_archive(self):
+        if self._archive is None:
+            return
+        self._archive.close()
+        index = {
+            'archive': os.path.basename(self._archive_path),
+            'format': self.archive_format,
+            'size': os.path.getsize(self._archive_path),
+            'complete': True,
+            'members': self._members,
+        }
+        self._write_json_atomic(self._archive_path + '.index.json', index)
+        # Index đầy đủ đã có - bỏ index JSONL tạm
+        self._index_log.close()
+        os.remove(self._index_log.name)
+        self._index_log = None
+        print(f"🗜️  Đóng archive {index['archive']}: {len(self._members)} tracks, {index['size'] / (1024*1024):.1f}MB")
+        self._archive = None
+        self._members = {}
+
+    @staticmethod
+    def _write_json_atomic(path: str, data: Dict):
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=1)
+        os.replace(path + '.tmp', path)
+
+
+def open_sink(destination: str, max_archive_mb: int = 1024):
+    """
+    Chọn storage sink theo đích: s3://bucket/prefix, tar://thư_mục, zip://thư_mục
+    hoặc đường dẫn thư mục local.
+    Endpoint S3-compatible (vd. MinIO local) lấy từ biến môi trường S3_ENDPOINT_URL.
+    """
+    for archive_format in ('tar', 'zip'):
+        if destination.startswith(f'{archive_format}://'):
+            return ArchiveSink(destination[len(archive_format) + 3:] or 'downloads', archive_format,
+                               max_archive_bytes=max_archive_mb * 1024 * 1024)
+    if destination.startswith('s3://'):
+        return S3MultipartSink.from_url(destination, endpoint_url=os.environ.get('S3_ENDPOINT_URL'))
+    return LocalFileSink(destination)
+
+
+MANIFEST_FILENAME = 'manifest.jsonl'
+
+
+def extract_track_id(item: Dict) -> Optional[str]:
+    """
+    Lấy track ID của Pixabay: từ item['id'] hoặc từ URL dạng /music/title-123456/
+    """
+    if item.get('id'):
+        return str(item['id'])
+    id_match = re.search(r'-(\d+)/?$', item.get('download_url') or '')
+    return id_match.group(1) if id_match else None
+
+
+def parse_duration(text) -> Optional[int]:
+    """
+    Đổi thời lượng hiển thị trên Pixabay ("4:03", "1:02:03"), số giây ("143") hoặc ISO 8601 ("PT4M3S") thành số giây
+    """
+    iso_match = re.fullmatch(r'\s*PT(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?\s*', str(text or ''))
+    if iso_match and any(iso_match.groups()):
+        hours, minutes, seconds = (int(part or 0) for part in iso_match.groups())
+        return hours * 3600 + minutes * 60 + seconds
+    match = re.search(r'(?<![\d:])(?:(\d+):)?(\d{1,2}):(\d{2})(?![\d:])|^\s*(\d+)\s*$', str(text or ''))
+    if not match:
+        return None
+    if match.group(4):
+        return int(match.group(4))
+    hours, minutes, seconds = (int(part or 0) for part in match.group(1, 2, 3))
+    return hours * 3600 + minutes * 60 + seconds
+
+
+class Track:
+    """
+    Một track trong danh sách - dùng __slots__ thay cho dict (nhỏ hơn nhiều khi catalog có hàng trăm nghìn tracks)
+    Vẫn đọc/ghi được như dict (item['title'], item.get('page'), 'page' in item, dict(item)) để code cũ không phải đổi
+    Key 'download_url' là URL trang detail (alias của detail_url)
+    """
+    __slots__ = ('index', 'id', 'title', 'detail_url', 'resolved_url', 'page', 'duration', 'size')
+
+    FIELDS = ('index', 'id', 'title', 'download_url', 'resolved_url', 'page', 'duration', 'size')
+
+    def __init__(self, title: str = '', download_url: str = '', index: Optional[int] = None,
+                 page: Optional[int] = None, id: Optional[str] = None, resolved_url: Optional[str] = None,
+                 duration: Optional[int] = None, size: Optional[int] = None):
+        self.index = index
+        self.id = id
+        self.title = title
+        self.detail_url = download_url
+        self.resolved_url = resolved_url
+        self.page = page
+        self.duration = duration
+        self.size = size
+
+    @property
+    def download_url(self) -> str:
+        return self.detail_url
+
+    @download_url.setter
+    def download_url(self, value: str):
+        self.detail_url = value
+
+    @property
+    def track_id(self) -> Optional[str]:
+        return extract_track_id(self)
+
+    @classmethod
+    def from_dict(cls, data) -> 'Track':
+        if isinstance(data, Track):
+            return data
+        return cls(**{key: data[key] for key in cls.FIELDS if data.get(key) is not None})
+
+    def to_dict(self) -> Dict:
+        """
+        Dict chỉ gồm các field có giá trị - cùng dạng với dict track trước đây (JSON, journal, queue payload)
+        """
+        return {key: value for key, value in zip(self.FIELDS, self._values()) if value is not None}
+
+    def _values(self):
+        return (self.index, self.id, self.title, self.detail_url, self.resolved_url, self.page, self.duration,
+                self.size)
+
+    def keys(self):
+        return [key for key, value in zip(self.FIELDS, self._values()) if value is not None]
+
+    def values(self):
+        return [value for value in self._values() if value is not None]
+
+    def items(self):
+        return list(self.to_dict().items())
+
+    def __getitem__(self, key: str):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        value = getattr(self, key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value):
+        if key not in self.FIELDS:
+            raise KeyError(f"Track không có field '{key}'")
+        setattr(self, key, value)
+
+    def get(self, key: str, default=None):
+        value = getattr(self, key, None) if key in self.FIELDS else None
+        return default if value is None else value
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.FIELDS and getattr(self, key) is not None
+
+    def copy(self) -> 'Track':
+        return Track(**self.to_dict())
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (Track, dict)):
+            return self.to_dict() == (other.to_dict() if isinstance(other, Track) else other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f"Track({self.to_dict()!r})"
+
+
+class TrackTable:
+    """
+    Bảng tracks lưu theo cột (array số nguyên + list chuỗi) cho danh sách rất lớn (catalog, sync hàng trăm nghìn tracks)
+    Mỗi track chỉ tốn vài chục bytes (không có object riêng); table[i] trả về một Track mới tạo từ các cột
+    Sửa table[i] không ghi ngược vào bảng - dùng table[i] = track để cập nhật
+    """
+    INT_FIELDS = ('index', 'page', 'duration', 'size')
+    STR_FIELDS = ('id', 'title', 'download_url', 'resolved_url')
+    MISSING = -1
+
+    def __init__(self, tracks=None):
+        # index/page/duration vừa int32, size (bytes) cần int64
+        self._ints = {key: array('q' if key == 'size' else 'i') for key in self.INT_FIELDS}
+        self._strs = {key: [] for key in self.STR_FIELDS}
+        if tracks:
+            self.extend(tracks)
+
+    def append(self, track):
+        for key in self.INT_FIELDS:
+            value = track.get(key)
+            self._ints[key].append(self.MISSING if value is None else int(value))
+        for key in self.STR_FIELDS:
+            value = track.get(key)
+            # Chuỗi rỗng/None lưu chung một object None - không tốn thêm bộ nhớ
+            self._strs[key].append(value or None)
+
+    def extend(self, tracks):
+        for track in tracks:
+            self.append(track)
+
+    def __len__(self) -> int:
+        return len(self._strs['title'])
+
+    def _row(self, position: int) -> Track:
+        values = {key: self._ints[key][position] for key in self.INT_FIELDS}
+        values = {key: value for key, value in values.items() if value != self.MISSING}
+        values.update({key: self._strs[key][position] for key in self.STR_FIELDS
+                       if self._strs[key][position] is not None})
+        return Track(**values)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self._row(i) for i in range(*position.indices(len(self)))]
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError('TrackTable index out of range')
+        return self._row(position)
+
+    def __setitem__(self, position: int, track):
+        for key in self.INT_FIELDS:
+            value = track.get(key)
+            self._ints[key][position] = self.MISSING if value is None else int(value)
+        for key in self.STR_FIELDS:
+            self._strs[key][position] = track.get(key) or None
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self._row(position)
+
+    def get(self, position: int, key: str):
+        """
+        Giá trị một field của track ở vị trí position (None nếu không có) - không tạo Track
+        """
+        if key in self._ints:
+            value = self._ints[key][position]
+            return None if value == self.MISSING else value
+        return self._strs[key][position]
+
+    def memory_usage(self) -> int:
+        """
+        Bytes ước tính của bảng (array + list + chuỗi, chuỗi dùng chung chỉ tính một lần)
+        """
+        total = sum(column.buffer_info()[1] * column.itemsize for column in self._ints.values())
+        seen = set()
+        for column in self._strs.values():
+            total += sys.getsizeof(column)
+            for value in column:
+                if value is not None and id(value) not in seen:
+                    seen.add(id(value))
+                    total += sys.getsizeof(value)
+        return total
+
+
+class DirectoryLayout:
+    """
+    Cách xếp file trong thư mục download:
+    - flat: tất cả nằm chung một thư mục (NNN_title.mp3) như trước
+    - page: theo trang crawl (page_002/NNN_title.mp3)
+    - hash: shard theo hash của track ID (ab/cd/<id>.mp3) - mỗi thư mục chỉ vài chục file kể cả khi có hàng triệu
+    """
+    STRATEGIES = ('flat', 'page', 'hash')
+
+    def __init__(self, strategy: str = 'flat', depth: int = 2):
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"Layout không hỗ trợ: {strategy} (chọn {', '.join(self.STRATEGIES)})")
+        self.strategy = strategy
+        self.depth = depth
+
+    def relative_path(self, item: Dict, file_number: int, filename: str) -> str:
+        """
+        Đường dẫn tương đối (dùng '/') của track trong thư mục download
+        """
+        if self.strategy == 'page':
+            return f"page_{item.get('page') or 0:03d}/{filename}"
+        if self.strategy == 'hash':
+            key = extract_track_id(item) or hashlib.sha1(f"{file_number}:{item['title']}".encode('utf-8')).hexdigest()[:16]
+            digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+            shards = [digest[i * 2:i * 2 + 2] for i in range(self.depth)]
+            return '/'.join(shards + [f"{key}.mp3"])
+        return filename
+
+
+class LibraryManifest:
+    """
+    Manifest JSONL ánh xạ số thứ tự logic -> đường dẫn thật của track.
+    Append-only khi download; migrate_layout ghi lại bản gọn.
+    Đọc manifest nhanh hơn nhiều so với listdir khi thư mục có hàng triệu file.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Dòng cuối có thể dở dang nếu tiến trình bị kill giữa chừng
+                        continue
+                    if entry.get('deleted'):
+                        self.entries.pop(entry['index'], None)
+                    else:
+                        self.entries[entry['index']] = entry
+
+    def max_index(self) -> int:
+        return max(self.entries, default=0)
+
+    def record(self, index: int, path: str, item: Dict, sha256: Optional[str] = None, size: int = 0):
+        entry = {
+            'index': index,
+            'path': path,
+            'title': item.get('title'),
+            'id': extract_track_id(item),
+            'page': item.get('page'),
+            'sha256': sha256,
+            'size': size,
+        }
+        line = json.dumps(entry, ensure_ascii=False)
+        with self._lock:
+            self.entries[index] = entry
+            with open(self.path, 'a', encoding='utf-8') as f:
+                # Nhiều worker process có thể ghi chung manifest - khóa file khi append
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                f.write(line + '\n')
+
+    def rewrite(self):
+        """
+        Ghi lại toàn bộ manifest (đã gọn, sắp theo index) - atomic qua file tạm
+        """
+        with self._lock:
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+                for index in sorted(self.entries):
+                    f.write(json.dumps(self.entries[index], ensure_ascii=False) + '\n')
+            os.replace(self.path + '.tmp', self.path)
+
+
+def migrate_layout(folder: str, strategy: str) -> int:
+    """
+    Chuyển thư mục download hiện có sang layout mới (flat/page/hash) và cập nhật manifest.
+    File NNN_title.mp3 chưa có trong manifest được thêm vào (không có ID/trang nên hash theo index + title).
+    Returns: số file đã di chuyển
+    """
+    layout = DirectoryLayout(strategy)
+    manifest = LibraryManifest(os.path.join(folder, MANIFEST_FILENAME))
+    
+    # File phẳng cũ chưa có trong manifest
+    for filename in os.listdir(folder):
+        match = re.match(r'^(\d{3,})_(.*)\.mp3$', filename)
+        if match and int(match.group(1)) not in manifest.entries:
+            manifest.entries[int(match.group(1))] = {
+                'index': int(match.group(1)), 'path': filename, 'title': match.group(2),
+                'id': None, 'page': None, 'sha256': None,
+                'size': os.path.getsize(os.path.join(folder, filename)),
+            }
+    
+    moved = 0
+    # Thư mục vừa có file được chuyển đi - chỉ những thư mục này mới được dọn nếu rỗng
+    vacated = set()
+    for index in sorted(manifest.entries):
+        entry = manifest.entries[index]
+        item = {'title': entry.get('title') or '', 'id': entry.get('id'), 'page': entry.get('page')}
+        filename = os.path.basename(entry['path'])
+        if not re.match(r'^\d{3,}_', filename):
+            # Đang ở layout hash (<id>.mp3) - dựng lại tên NNN_title.mp3
+            safe_title = re.sub(r'[<>:"/\\|?*]', '_', item['title'])
+            filename = f"{index:03d}_{safe_title}.mp3"
+        new_path = layout.relative_path(item, index, filename)
+        if new_path == entry['path']:
+            continue
+        
+        source = os.path.join(folder, *entry['path'].split('/'))
+        target = os.path.join(folder, *new_path.split('/'))
+        if not os.path.exists(source):
+            print(f"⚠️  Thiếu file {entry['path']}, bỏ qua")
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(source, target)
+        vacated.add(os.path.normpath(os.path.dirname(source)))
+        entry['path'] = new_path
+        moved += 1
+    
+    manifest.rewrite()
+    
+    # Dọn thư mục shard/trang mà các lần chuyển vừa làm rỗng (ab/cd rồi tới ab) - thư mục rỗng khác của user giữ nguyên
+    root = os.path.normpath(folder)
+    for directory in sorted(vacated, key=len, reverse=True):
+        while directory != root and os.path.isdir(directory) and not os.listdir(directory):
+            os.rmdir(directory)
+            directory = os.path.dirname(directory)
+    
+    print(f"✅ Đã chuyển {moved} file sang layout '{strategy}' ({len(manifest.entries)} tracks trong manifest)")
+    return moved
+
+
+def migrate_layout_cli(argv: List[str]):
+    """
+    python a.py migrate-layout <thư_mục> --layout hash
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog='a.py migrate-layout',
+                                     description='Chuyển thư mục download sang layout khác và tạo manifest')
+    parser.add_argument('folder')
+    parser.add_argument('--layout', choices=DirectoryLayout.STRATEGIES, required=True)
+    args = parser.parse_args(argv)
+    migrate_layout(args.folder, args.layout)
+
+
+class SeenTracks:
+    """
+    Tập track đã biết cho chế độ sync, lưu append-only (mỗi dòng một track ID).
+    Track không có ID thì dùng URL làm khóa.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = Lock()
+        self.ids = set()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self.ids = {line.strip() for line in f if line.strip()}
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    @staticmethod
+    def key(item: Dict) -> str:
+        return extract_track_id(item) or item.get('download_url', '')
+
+    def __contains__(self, item: Dict) -> bool:
+        return self.key(item) in self.ids
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add_many(self, items: List[Dict]):
+        with self._lock:
+            new_keys = [key for key in dict.fromkeys(self.key(item) for item in items) if key and key not in self.ids]
+            if not new_keys:
+                return
+            with open(self.path, 'a', encoding='utf-8') as f:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                f.write(''.join(key + '\n' for key in new_keys))
+            self.ids.update(new_keys)
+
+
+class CheckpointJournal:
+    """
+    Journal append-only (JSONL, fsync sau mỗi dòng) ghi lại trang đã crawl xong (kèm items)
+    và file đã download xong/lỗi. Chạy lại với cùng journal sẽ bỏ qua phần đã xong.
+    """
+    def __init__(self, path: str, resume: bool = True, fsync: bool = True):
+        self.path = path
+        self.fsync = fsync
+        self._lock = Lock()
+        self.pages = {}
+        self.batches = {}
+        self.downloads = {}
+        self.done_tracks = set()  # key (SeenTracks.key) của track đã download xong, ở batch nào cũng được
+        if resume and os.path.exists(path):
+            self._replay()
+        elif os.path.exists(path):
+            os.remove(path)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def _replay(self):
+        complete_size = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Dòng cuối dở dang do crash giữa lúc ghi - cắt bỏ ở dưới
+                    break
+                complete_size += len(line)
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                kind = event.get('event')
+                if kind == 'page_done':
+                    self.pages[event['url']] = event
+                elif kind == 'batch_start':
+                    self.batches[event['key']] = event['next_file_index']
+                elif kind in ('download_done', 'download_failed'):
+                    self.downloads[(event['batch'], event['file_number'])] = event
+                    if kind == 'download_done' and event.get('track'):
+                        self.done_tracks.add(event['track'])
+        if complete_size < os.path.getsize(self.path):
+            # Không cắt thì event ghi tiếp (mode 'a') sẽ dính vào mảnh dở và bị bỏ khi replay lần sau
+            with open(self.path, 'r+b') as f:
+                f.truncate(complete_size)
+        done = sum(1 for event in self.downloads.values() if event['event'] == 'download_done')
+        print(f"📓 Journal {self.path}: {len(self.pages)} trang, {done} file đã xong")
+
+    def _write(self, event: Dict):
+        event['time'] = time.time()
+        line = json.dumps(event, ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+
+    def page_done(self, url: str, page_num: int, items: List[Track]):
+        event = {'event': 'page_done', 'url': url, 'page': page_num, 'items': [item.to_dict() for item in items]}
+        self._write(event)
+        self.pages[url] = event
+
+    def batch_start(self, key: str, next_file_index: int) -> int:
+        """
+        Ghi số thứ tự file bắt đầu của batch - khi resume trả lại đúng số cũ để tên file không đổi
+        """
+        if key in self.batches:
+            return self.batches[key]
+        self._write({'event': 'batch_start', 'key': key, 'next_file_index': next_file_index})
+        self.batches[key] = next_file_index
+        return next_file_index
+
+    def is_downloaded(self, batch: str, file_number: int) -> bool:
+        event = self.downloads.get((batch, file_number))
+        return event is not None and event['event'] == 'download_done'
+
+    def download_done(self, batch: str, file_number: int, result: Dict):
+        event = {'event': 'download_done', 'batch': batch, 'file_number': file_number,
+                 'filename': result['filename'], 'sha256': result['sha256'],
+                 'duplicate_of': result['duplicate_of'], 'size': result['file_size']}
+        if result.get('item') is not None:
+            event['track'] = SeenTracks.key(result['item'])
+        self._write(event)
+        self.downloads[(batch, file_number)] = event
+        if event.get('track'):
+            self.done_tracks.add(event['track'])
+
+    def is_track_done(self, item) -> bool:
+        """
+        Track đã download xong trong một batch bất kỳ của journal - dùng khi danh sách thay đổi giữa các lần chạy (sync)
+        """
+        return SeenTracks.key(item) in self.done_tracks
+
+    def download_failed(self, batch: str, file_number: int, error: Optional[str]):
+        event = {'event': 'download_failed', 'batch': batch, 'file_number': file_number, 'error': error}
+        self._write(event)
+        self.downloads[(batch, file_number)] = event
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class TrackCatalog:
+    """
+    Catalog tracks đã crawl, lưu trong SQLite - lần sau download range khác không cần crawl lại.
+    Khóa là track ID (track không có ID thì dùng URL detail). Mỗi track có số thứ tự cố định trong catalog
+    (track mới được đánh số nối tiếp, track đã có giữ nguyên số) - range và ID đều tra bằng index.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn().executescript("""
+            CREATE TABLE IF NOT EXISTS tracks (
+                track_id TEXT PRIMARY KEY,
+                idx INTEGER NOT NULL UNIQUE,
+                source TEXT,
+                page INTEGER,
+                title TEXT NOT NULL,
+                detail_url TEXT,
+                resolved_url TEXT,
+                duration INTEGER,
+                size INTEGER,
+                crawled_at REAL NOT NULL,
+                resolved_at REAL,
+                downloaded_at REAL
+            );
+        """)
+        self._migrate()
+
+    def describe(self) -> str:
+        return os.path.abspath(self.path)
+
+    def _migrate(self):
+        """
+        Catalog tạo bởi bản cũ chưa có cột downloaded_at - thêm cột, track đã có resolved_at
+        (bản cũ chỉ đặt sau khi download xong) được coi là đã download
+        """
+        conn = self._conn()
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(tracks)')}
+        if 'downloaded_at' not in columns:
+            conn.execute('ALTER TABLE tracks ADD COLUMN downloaded_at REAL')
+            conn.execute('UPDATE tracks SET downloaded_at = resolved_at')
+
+    def _conn(self) -> 'sqlite3.Connection':
+        # Giống SQLiteJobQueue: mỗi thread một kết nối, WAL để đọc không chặn ghi
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            import sqlite3
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA busy_timeout=30000')
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def key(item) -> str:
+        return SeenTracks.key(item)
+
+    def add_tracks(self, items: List, source: Optional[str] = None) -> tuple:
+        """
+        Thêm/cập nhật tracks (Track hoặc dict, có thể kèm 'crawled_at'). Returns: (số track mới, số track cập nhật)
+        URL thực/kích thước đã biết không bị ghi đè bằng giá trị rỗng
+        """
+        now = time.time()
+        added = updated = 0
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            next_idx = conn.execute('SELECT COALESCE(MAX(idx), 0) + 1 FROM tracks').fetchone()[0]
+            for item in items:
+                key = self.key(item)
+                if not key:
+                    continue
+                values = (item.get('source') or source, item.get('page'), item.get('title') or '',
+                          item.get('download_url'), item.get('resolved_url'), item.get('duration'),
+                          item.get('size'), item.get('crawled_at') or now, item.get('resolved_at'))
+                cursor = conn.execute(
+                    'INSERT OR IGNORE INTO tracks (track_id, idx, source, page, title, detail_url, resolved_url, '
+                    'duration, size, crawled_at, resolved_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (key, next_idx) + values)
+                if cursor.rowcount:
+                    added += 1
+                    next_idx += 1
+                    continue
+                conn.execute(
+                    'UPDATE tracks SET source = COALESCE(?, source), page = COALESCE(?, page), title = ?, '
+                    'detail_url = COALESCE(?, detail_url), resolved_url = COALESCE(?, resolved_url), '
+                    'duration = COALESCE(?, duration), size = COALESCE(?, size), crawled_at = ?, '
+                    'resolved_at = COALESCE(?, resolved_at) WHERE track_id = ?', values + (key,))
+                updated += 1
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return added, updated
+
+    def set_resolved(self, item, resolved_url: str, size: Optional[int] = None):
+        """
+        Lưu URL thực (và kích thước) sau khi resolve - lần sau không phải fetch lại trang detail
+        """
+        self._conn().execute(
+            'UPDATE tracks SET resolved_url = ?, size = COALESCE(?, size), resolved_at = ? WHERE track_id = ?',
+            (resolved_url, size or None, time.time(), self.key(item)))
+
+    def set_downloaded(self, item, resolved_url: str, size: Optional[int] = None):
+        """
+        Đánh dấu track đã download xong (gọi sau khi sink commit file) kèm URL thực và kích thước.
+        Chỉ downloaded_at quyết định downloaded:yes - add_tracks/import_jsonl không bao giờ đặt cột này
+        """
+        now = time.time()
+        self._conn().execute(
+            'UPDATE tracks SET resolved_url = ?, size = COALESCE(?, size), resolved_at = ?, downloaded_at = ? '
+            'WHERE track_id = ?', (resolved_url, size or None, now, now, self.key(item)))
+
+    _COLUMNS = 'idx, track_id, title, detail_url, resolved_url, page, duration, size'
+
+    @staticmethod
+    def _track(row) -> Track:
+        idx, key, title, detail_url, resolved_url, page, duration, size = row
+        # Khóa bằng URL (track không có ID) thì không đặt id
+        return Track(title=title, download_url=detail_url or '', index=idx, page=page,
+                     id=key if key != detail_url else None, resolved_url=resolved_url,
+                     duration=duration, size=size)
+
+    def select_range(self, start: int, end: int) -> List[Track]:
+        """
+        Tracks có số thứ tự từ start đến end (tra theo index UNIQUE của idx)
+        """
+        rows = self._conn().execute(f'SELECT {self._COLUMNS} FROM tracks WHERE idx BETWEEN ? AND ? ORDER BY idx',
+                                    (start, end)).fetchall()
+        return [self._track(row) for row in rows]
+
+    def select_ids(self, track_ids: List[str]) -> List[Track]:
+        """
+        Tracks theo danh sách ID (giữ thứ tự truyền vào, bỏ ID không có trong catalog)
+        """
+        found = {}
+        track_ids = [str(track_id) for track_id in track_ids]
+        # SQLite giới hạn số tham số mỗi câu lệnh - tra theo từng lô
+        for chunk_start in range(0, len(track_ids), 500):
+            chunk = track_ids[chunk_start:chunk_start + 500]
+            rows = self._conn().execute(
+                f"SELECT {self._COLUMNS} FROM tracks WHERE track_id IN ({','.join('?' * len(chunk))})", chunk)
+            for row in rows:
+                found[row[1]] = self._track(row)
+        return [found[track_id] for track_id in dict.fromkeys(track_ids) if track_id in found]
+
+    def count(self) -> int:
+        return self._conn().execute('SELECT COUNT(*) FROM tracks').fetchone()[0]
+
+    def downloaded_keys(self) -> set:
+        """
+        Key của các track đã download xong (set_downloaded được gọi sau khi tải thành công)
+        """
+        return {row[0] for row in self._conn().execute('SELECT track_id FROM tracks WHERE downloaded_at IS NOT NULL')}
+
+    def stamp(self) -> List:
+        """
+        Dấu phiên bản nội dung catalog (số track, số đã tải, lần crawl/tải gần nhất) - index lưu ra file dùng
+        để biết còn khớp với catalog không
+        """
+        return list(self._conn().execute(
+            'SELECT COUNT(*), COUNT(downloaded_at), MAX(crawled_at), MAX(downloaded_at) FROM tracks').fetchone())
+
+    def stats(self) -> Dict:
+        row = self._conn().execute(
+            'SELECT COUNT(*), COUNT(resolved_url), COUNT(DISTINCT source), MIN(crawled_at), MAX(crawled_at) '
+            'FROM tracks').fetchone()
+        return {'tracks': row[0], 'resolved': row[1], 'sources': row[2], 'first_crawl': row[3], 'last_crawl': row[4]}
+
+    def export_jsonl(self, path: str) -> int:
+        """
+        Ghi toàn bộ catalog ra JSONL (mỗi dòng một track, theo số thứ tự)
+        """
+        count = 0
+        rows = self._conn().execute(f'SELECT {self._COLUMNS}, source, crawled_at, resolved_at FROM tracks ORDER BY idx')
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            for row in rows:
+                entry = self._track(row[:8]).to_dict()
+                entry.update({key: value for key, value in zip(('source', 'crawled_at', 'resolved_at'), row[8:])
+                              if value is not None})
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+                count += 1
+        os.replace(path + '.tmp', path)
+        return count
+
+    def import_jsonl(self, path: str) -> tuple:
+        """
+        Nạp JSONL (từ export_jsonl) vào catalog - track mới được đánh số nối tiếp theo thứ tự trong file
+        Returns: (số track mới, số track cập nhật)
+        """
+        with open(path, encoding='utf-8') as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+        return self.add_tracks(entries)
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def tracks_digest(tracks, salt: str = '') -> str:
+    """
+    Khóa ngắn ổn định theo đúng danh sách tracks (theo thứ tự) - cùng range nhưng tracks khác thì khóa khác
+    """
+    digest = hashlib.sha1(salt.encode('utf-8'))
+    for track in tracks:
+        digest.update(SeenTracks.key(track).encode('utf-8'))
+    return digest.hexdigest()[:12]
+
+
+class SearchResult:
+    """
+    Kết quả tìm kiếm trên TrackIndex: chỉ giữ vị trí trong index, track chỉ được lấy ra khi cần
+    (hiển thị từng trang, download) - vẫn dùng được như list (len, [i], [a:b], for)
+    """
+    def __init__(self, index: 'TrackIndex', positions: List[int], query: str = ''):
+        self.index = index
+        self.positions = positions
+        self.query = query
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self.index.tracks[i] for i in self.positions[position]]
+        return self.index.tracks[self.positions[position]]
+
+    def __iter__(self):
+        return (self.index.tracks[i] for i in self.positions)
+
+    def is_downloaded(self, position: int) -> bool:
+        return self.positions[position] in self.index.downloaded
+
+    def page_count(self, page_size: int) -> int:
+        return max(1, -(-len(self.positions) // page_size))
+
+    def page(self, number: int, page_size: int = 20) -> List[Track]:
+        """
+        Tracks của trang `number` (bắt đầu từ 1)
+        """
+        start = (number - 1) * page_size
+        return self[start:start + page_size]
+
+    def print_page(self, number: int, page_size: int = 20):
+        """
+        In một trang kết quả - chỉ lấy ra page_size tracks, không in cả danh sách
+        """
+        start = (number - 1) * page_size
+        query_info = f", query: {self.query}" if self.query else ""
+        print(f"\n📋 Trang {number}/{self.page_count(page_size)} ({len(self)} tracks{query_info})")
+        print("-" * 80)
+        for offset, item in enumerate(self.page(number, page_size)):
+            mark = '✅' if self.is_downloaded(start + offset) else '  '
+            page_info = f" (Trang {item['page']})" if item.get('page') else ""
+            duration_info = f" [{item['duration'] // 60}:{item['duration'] % 60:02d}]" if item.get('duration') else ""
+            print(f"{start + offset + 1:5d}. {mark} {item['title']}{duration_info}{page_info}")
+
+    def key(self) -> str:
+        """
+        Khóa ổn định của kết quả (query + tracks) - dùng làm batch key của journal
+        """
+        return tracks_digest(self, self.query)
+
+
+class TrackIndex:
+    """
+    Inverted index trên tên track, slug của URL detail và track ID: token -> vị trí track (tăng dần).
+    Query AND các từ (không phân biệt hoa thường/dấu, `pia*` = prefix) kèm bộ lọc:
+    page:2 | page:1-3, duration:<120 | duration:>60 | duration:60-180 (giây), downloaded:yes|no, id:123456
+    Lưu/nạp bằng save()/load() (JSON, gồm cả posting lists - không phải tokenize lại).
+    Tracks lưu trong TrackTable (theo cột) - index trên cả catalog không giữ một object cho mỗi track
+    """
+    VERSION = 1
+    FILTER_PATTERN = re.compile(r'^(page|duration|downloaded|id):(.+)$')
+
+    def __init__(self, tracks: Optional[List] = None, downloaded=()):
+        self.tracks = TrackTable()
+        self.downloaded = set()   # vị trí các track đã download
+        self.meta = {}            # vd. stamp của catalog lúc build
+        self._postings = {}       # token -> array('i') vị trí
+        self._positions = {}      # key track -> vị trí
+        self._sorted_tokens = None
+        if tracks:
+            self.add(tracks)
+        for key in downloaded:
+            self.mark_downloaded(key)
+
+    @staticmethod
+    def key(item) -> str:
+        return SeenTracks.key(item)
+
+    @staticmethod
+    def tokenize(text) -> List[str]:
+        """
+        Chữ thường, bỏ dấu (nhạc -> nhac, đàn -> dan), tách theo ký tự không phải chữ/số
+        """
+        text = unicodedata.normalize('NFKD', str(text or '').lower().replace('đ', 'd'))
+        return re.findall(r'\w+', ''.join(char for char in text if not unicodedata.combining(char)))
+
+    def _track_tokens(self, item) -> set:
+        slug = urllib.parse.urlparse(item.get('download_url') or '').path.rstrip('/').rsplit('/', 1)[-1]
+        return set(self.tokenize(item.get('title'))) | set(self.tokenize(slug)) | set(self.tokenize(item.get('id')))
+
+    def add(self, tracks: List) -> int:
+        """
+        Thêm tracks vào index (track đã có - cùng key - thì bỏ qua). Returns: số track mới
+        """
+        added = 0
+        for item in tracks:
+            key = self.key(item)
+            if not key or key in self._positions:
+                continue
+            position = len(self.tracks)
+            self.tracks.append(item)
+            self._positions[key] = position
+            for token in self._track_tokens(item):
+                postings = self._postings.get(token)
+                if postings is None:
+                    postings = self._postings[token] = array('i')
+                postings.append(position)
+            added += 1
+        if added:
+            self._sorted_tokens = None
+        return added
+
+    def mark_downloaded(self, item_or_key) -> bool:
+        position = self._positions.get(item_or_key if isinstance(item_or_key, str) else self.key(item_or_key))
+        if position is None:
+            return False
+        self.downloaded.add(position)
+        return True
+
+    def __len__(self) -> int:
+        return len(self.tracks)
+
+    def _lookup(self, term: str) -> set:
+        """
+        Vị trí các track chứa term (`abc*` = mọi token bắt đầu bằng abc)
+        """
+        if not term.endswith('*'):
+            tokens = self.tokenize(term)
+            # "lo-fi" tách thành nhiều token - track phải chứa tất cả
+            result = None
+            for token in tokens:
+                positions = set(self._postings.get(token, ()))
+                result = positions if result is None else result & positions
+            return result or set()
+        prefix = ''.join(self.tokenize(term[:-1]))
+        if self._sorted_tokens is None:
+            self._sorted_tokens = sorted(self._postings)
+        result = set()
+        start = bisect.bisect_left(self._sorted_tokens, prefix)
+        for token in itertools.islice(self._sorted_tokens, start, None):
+            if not token.startswith(prefix):
+                break
+            result.update(self._postings[token])
+        return result
+
+    @staticmethod
+    def _parse_bounds(value: str) -> tuple:
+        """
+        "5" -> (5, 5), "1-3" -> (1, 3), "<120" -> (None, 119), ">60" -> (61, None)
+        """
+        if value.startswith('<='):
+            return None, int(value[2:])
+        if value.startswith('>='):
+            return int(value[2:]), None
+        if value.startswith('<'):
+            return None, int(value[1:]) - 1
+        if value.startswith('>'):
+            return int(value[1:]) + 1, None
+        if '-' in value:
+            low, high = value.split('-', 1)
+            return int(low) if low else None, int(high) if high else None
+        return int(value), int(value)
+
+    @staticmethod
+    def _in_bounds(value, bounds: Optional[tuple]) -> bool:
+        if bounds is None:
+            return True
+        if value is None:
+            return False
+        low, high = bounds
+        return (low is None or value >= low) and (high is None or value <= high)
+
+    def search(self, query: str = '', page=None, duration=None, downloaded: Optional[bool] = None) -> SearchResult:
+        """
+        Tìm tracks khớp query (mọi từ) và bộ lọc - kết quả theo thứ tự trong index.
+        page / duration: số hoặc (min, max) - None ở một đầu là không giới hạn; downloaded: True/False/None
+        Bộ lọc trong query (page:1-3...) được ưu tiên hơn tham số. Query sai cú pháp ném ValueError
+        """
+        terms = []
+        track_id = None
+        for word in (query or '').split():
+            match = self.FILTER_PATTERN.match(word.lower())
+            if not match:
+                # Bỏ qua từ không có chữ/số nào (vd. "-", "*")
+                if self.tokenize(word):
+                    terms.append(word)
+                continue
+            name, value = match.groups()
+            try:
+                if name == 'page':
+                    page = self._parse_bounds(value)
+                elif name == 'duration':
+                    duration = self._parse_bounds(value)
+                elif name == 'id':
+                    track_id = value
+                elif value in ('yes', 'y', 'true', '1', 'có', 'co'):
+                    downloaded = True
+                elif value in ('no', 'n', 'false', '0', 'không', 'khong'):
+                    downloaded = False
+                else:
+                    raise ValueError(value)
+            except ValueError:
+                raise ValueError(f"Bộ lọc không hợp lệ: {word}")
+        page = (page, page) if isinstance(page, int) else page
+        duration = (duration, duration) if isinstance(duration, int) else duration
+
+        candidates = None
+        if track_id is not None:
+            candidates = {self._positions[track_id]} if track_id in self._positions else set()
+        # Tra term có ít kết quả trước - giao nhanh hơn và dừng sớm khi rỗng
+        for positions in sorted((self._lookup(term) for term in terms), key=len):
+            candidates = positions if candidates is None else candidates & positions
+            if not candidates:
+                break
+        positions = sorted(candidates) if candidates is not None else range(len(self.tracks))
+        results = [position for position in positions
+                   if self._in_bounds(self.tracks.get(position, 'page'), page)
+                   and self._in_bounds(self.tracks.get(position, 'duration'), duration)
+                   and (downloaded is None or (position in self.downloaded) == downloaded)]
+        return SearchResult(self, results, query or '')
+
+    def token_count(self) -> int:
+        return len(self._postings)
+
+    @classmethod
+    def from_catalog(cls, catalog: TrackCatalog, path: Optional[str] = None) -> 'TrackIndex':
+        """
+        Index trên toàn bộ catalog. path: file index đã lưu - dùng lại nếu còn khớp catalog (stamp),
+        không thì build lại rồi ghi ra
+        """
+        stamp = catalog.stamp()
+        if path and os.path.exists(path):
+            try:
+                index = cls.load(path)
+                if index.meta.get('stamp') == stamp:
+                    print(f"🔎 Dùng index đã lưu {path}: {len(index)} tracks")
+                    return index
+                print(f"🔄 Index {path} cũ hơn catalog - build lại...")
+            except (OSError, ValueError, KeyError) as e:
+                print(f"⚠️  Không đọc được index {path}: {e} - build lại...")
+        index = cls(catalog.select_range(1, catalog.count()), catalog.downloaded_keys())
+        index.meta['stamp'] = stamp
+        if path:
+            index.save(path)
+        return index
+
+    def save(self, path: str):
+        """
+        Ghi index ra JSON (ghi file tạm rồi rename)
+        """
+        data = {
+            'version': self.VERSION,
+            'meta': self.meta,
+            'tracks': [track.to_dict() for track in self.tracks],
+            'downloaded': sorted(self.downloaded),
+            'postings': {token: positions.tolist() for token, positions in self._postings.items()},
+        }
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path: str) -> 'TrackIndex':
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') != cls.VERSION:
+            raise ValueError(f"Index {path} có version {data.get('version')}, cần {cls.VERSION}")
+        index = cls()
+        index.meta = data.get('meta', {})
+        index.tracks = TrackTable(data['tracks'])
+        index._positions = {cls.key(entry): position for position, entry in enumerate(data['tracks'])}
+        index.downloaded = set(data['downloaded'])
+        index._postings = {token: array('i', positions) for token, positions in data['postings'].items()}
+        return index
+
+
+class SQLiteJobQueue:
+    """
+    Hàng đợi job dùng chung giữa nhiều process trên cùng một máy, lưu trong SQLite.
+    Claim job trong transaction BEGIN IMMEDIATE (SQLite khóa file) nên hai worker
+    không bao giờ lấy cùng một job. Job có lease: worker chết thì hết lease job quay lại hàng đợi.
+    """
+    def __init__(self, path: str, lease_seconds: float = 120, max_attempts: int = 3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        conn = self._conn()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                queue TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                result TEXT,
+                updated_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (queue, status, id);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        """)
+
+    def describe(self) -> str:
+        return f"sqlite:///{os.path.abspath(self.path)}"
+
+    def _conn(self) -> 'sqlite3.Connection':
+        # sqlite3.Connection không dùng chung giữa các thread được - mỗi thread một kết nối
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            import sqlite3
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA busy_timeout=30000')
+            self._local.conn = conn
+        return conn
+
+    def reset(self):
+        self._conn().executescript("DELETE FROM jobs; DELETE FROM meta;")
+
+    def put_many(self, queue_name: str, payloads: List[Dict]):
+        now = time.time()
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        conn.executemany('INSERT INTO jobs (queue, payload, updated_at) VALUES (?, ?, ?)',
+                         [(queue_name, json.dumps(payload, ensure_ascii=False), now) for payload in payloads])
+        conn.execute('COMMIT')
+
+    def claim(self, queue_name: str, worker_id: str) -> Optional[tuple]:
+        """
+        Lấy một job pending (hoặc job có lease đã hết hạn). Returns: (job_id, payload) hoặc None
+        """
+        now = time.time()
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            self._fail_exhausted(conn, now)
+            row = conn.execute(
+                "SELECT id, payload FROM jobs WHERE queue = ? AND attempts < ? AND "
+                "(status = 'pending' OR (status = 'leased' AND lease_until < ?)) ORDER BY id LIMIT 1",
+                (queue_name, self.max_attempts, now)).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1, "
+                    "updated_at = ? WHERE id = ?", (worker_id, now + self.lease_seconds, now, row[0]))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return (row[0], json.loads(row[1])) if row is not None else None
+
+    def _fail_exhausted(self, conn: 'sqlite3.Connection', now: float):
+        # Lease hết hạn mà job đã hết lượt thử (worker chết nhiều lần) - đánh dấu failed
+        conn.execute("UPDATE jobs SET status = 'failed', updated_at = ? "
+                     "WHERE status = 'leased' AND lease_until < ? AND attempts >= ?", (now, now, self.max_attempts))
+
+    def extend_lease(self, job_id: int, worker_id: str) -> bool:
+        cursor = self._conn().execute(
+            "UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+            (time.time() + self.lease_seconds, job_id, worker_id))
+        return cursor.rowcount == 1
+
+    def complete(self, job_id: int, worker_id: str, result: Dict) -> bool:
+        """
+        Báo job xong - chỉ khi worker vẫn giữ lease. Returns: False nếu lease đã mất (job đã về worker khác)
+        """
+        cursor = self._conn().execute(
+            "UPDATE jobs SET status = 'done', result = ?, updated_at = ? "
+            "WHERE id = ? AND worker = ? AND status = 'leased'",
+            (json.dumps(result, ensure_ascii=False), time.time(), job_id, worker_id))
+        return cursor.rowcount == 1
+
+    def fail(self, job_id: int, worker_id: str, error: str) -> bool:
+        # Còn lượt thử thì trả về pending cho worker khác, hết lượt thì đánh dấu failed
+        cursor = self._conn().execute(
+            "UPDATE jobs SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, "
+            "result = ?, updated_at = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+            (self.max_attempts, json.dumps({'error': error}, ensure_ascii=False), time.time(), job_id, worker_id))
+        return cursor.rowcount == 1
+
+    def counts(self, queue_name: str) -> Dict[str, int]:
+        self._fail_exhausted(self._conn(), time.time())
+        rows = self._conn().execute('SELECT status, COUNT(*) FROM jobs WHERE queue = ? GROUP BY status',
+                                    (queue_name,)).fetchall()
+        return dict(rows)
+
+    def results(self, queue_name: str) -> List[tuple]:
+        rows = self._conn().execute('SELECT payload, status, result FROM jobs WHERE queue = ? ORDER BY id',
+                                    (queue_name,)).fetchall()
+        return [(json.loads(payload), status, json.loads(result) if result else None)
+                for payload, status, result in rows]
+
+    def set_meta(self, key: str, value: str):
+        self._conn().execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def get_meta(self, key: str) -> Optional[str]:
+        row = self._conn().execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+
+class RedisJobQueue:
+    """
+    Hàng đợi job qua Redis (hoặc server tương thích / fakeredis để test) cho nhiều máy.
+    pending là list, lease là sorted set theo thời điểm hết hạn, dữ liệu job là hash.
+    Cần redis-py (tùy chọn) nếu không truyền client.
+    """
+    def __init__(self, url: Optional[str] = None, prefix: str = 'pixabay', lease_seconds: float = 120,
+                 max_attempts: int = 3, client=None):
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise RuntimeError("Queue Redis cần redis-py - chạy: pip install redis")
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.url = url
+        self.prefix = prefix
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+    def describe(self) -> str:
+        return f"{self.url or 'redis'} (prefix {self.prefix})"
+
+    def _key(self, *parts) -> str:
+        return ':'.join((self.prefix,) + tuple(str(part) for part in parts))
+
+    def reset(self):
+        keys = list(self.client.scan_iter(match=self._key('*')))
+        if keys:
+            self.client.delete(*keys)
+
+    def put_many(self, queue_name: str, payloads: List[Dict]):
+        pipe = self.client.pipeline()
+        first_id = self.client.incrby(self._key('seq'), len(payloads)) - len(payloads) + 1
+        for offset, payload in enumerate(payloads):
+            job_id = first_id + offset
+            pipe.hset(self._key('job', job_id), mapping={
+                'queue': queue_name, 'payload': json.dumps(payload, ensure_ascii=False),
+                'status': 'pending', 'attempts': 0})
+            pipe.rpush(self._key(queue_name, 'pending'), job_id)
+            pipe.rpush(self._key(queue_name, 'all'), job_id)
+        pipe.execute()
+
+    @staticmethod
+    def _text(value) -> Optional[str]:
+        return value.decode() if isinstance(value, bytes) else value
+
+    def _transaction(self, watch_keys: List[str], func):
+        """
+        WATCH các key, gọi func(pipe) để đọc rồi xếp lệnh sau pipe.multi() - MULTI/EXEC chạy tất cả một lần
+        (không có trạng thái nửa chừng nếu worker chết). Key bị sửa giữa chừng thì thử lại
+        """
+        from redis.exceptions import WatchError
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(*watch_keys)
+                    return func(pipe)
+                except WatchError:
+                    continue
+
+    def _requeue_expired(self, queue_name: str):
+        leases_key = self._key(queue_name, 'leases')
+        for job_id in self.client.zrangebyscore(leases_key, 0, time.time()):
+            job_key = self._key('job', int(job_id))
+
+            def requeue(pipe):
+                # Lease có thể vừa được gia hạn / job vừa xong - kiểm tra lại sau WATCH
+                score = pipe.zscore(leases_key, job_id)
+                if score is None or score > time.time():
+                    pipe.unwatch()
+                    return
+                attempts = int(pipe.hget(job_key, 'attempts') or 0)
+                pipe.multi()
+                pipe.zrem(leases_key, job_id)
+                self._queue_retry(pipe, queue_name, job_id, attempts, None)
+                pipe.execute()
+
+            self._transaction([leases_key, job_key], requeue)
+
+    def _queue_retry(self, pipe, queue_name: str, job_id, attempts: int, error: Optional[str]):
+        # Còn lượt thử thì trả về pending, hết lượt thì failed (xếp lệnh trong MULTI)
+        status = 'pending' if attempts < self.max_attempts else 'failed'
+        mapping = {'status': status}
+        if error is not None:
+            mapping['result'] = json.dumps({'error': error}, ensure_ascii=False)
+        pipe.hset(self._key('job', int(job_id)), mapping=mapping)
+        if status == 'pending':
+            pipe.rpush(self._key(queue_name, 'pending'), job_id)
+
+    def claim(self, queue_name: str, worker_id: str) -> Optional[tuple]:
+        """
+        Lấy job đầu hàng đợi - lấy ra khỏi pending và đặt lease trong cùng một MULTI/EXEC
+        """
+        self._requeue_expired(queue_name)
+        pending_key = self._key(queue_name, 'pending')
+
+        def pop_and_lease(pipe):
+            job_id = pipe.lindex(pending_key, 0)
+            if job_id is None:
+                pipe.unwatch()
+                return None
+            job_key = self._key('job', int(job_id))
+            pipe.multi()
+            pipe.lpop(pending_key)
+            pipe.zadd(self._key(queue_name, 'leases'), {int(job_id): time.time() + self.lease_seconds})
+            pipe.hset(job_key, mapping={'status': 'leased', 'worker': worker_id})
+            pipe.hincrby(job_key, 'attempts', 1)
+            pipe.hget(job_key, 'payload')
+            return int(job_id), json.loads(pipe.execute()[-1])
+
+        return self._transaction([pending_key], pop_and_lease)
+
+    def _owned_update(self, job_id: int, worker_id: str, update) -> bool:
+        """
+        Chạy update(pipe, queue_name, attempts) trong MULTI chỉ khi worker vẫn giữ lease của job
+        """
+        job_key = self._key('job', job_id)
+
+        def guarded(pipe):
+            job = {key: self._text(value) for key, value in
+                   zip(('status', 'worker', 'queue', 'attempts'), pipe.hmget(job_key, 'status', 'worker', 'queue',
+                                                                          'attempts'))}
+            if job['status'] != 'leased' or job['worker'] != worker_id:
+                pipe.unwatch()
+                return False
+            pipe.multi()
+            update(pipe, job['queue'], int(job['attempts'] or 0))
+            pipe.execute()
+            return True
+
+        return self._transaction([job_key], guarded)
+
+    def extend_lease(self, job_id: int, worker_id: str) -> bool:
+        return self._owned_update(job_id, worker_id, lambda pipe, queue_name, attempts: pipe.zadd(
+            self._key(queue_name, 'leases'), {job_id: time.time() + self.lease_seconds}, xx=True))
+
+    def complete(self, job_id: int, worker_id: str, result: Dict) -> bool:
+        def finish(pipe, queue_name, attempts):
+            pipe.zrem(self._key(queue_name, 'leases'), job_id)
+            pipe.hset(self._key('job', job_id), mapping={
+                'status': 'done', 'result': json.dumps(result, ensure_ascii=False)})
+
+        return self._owned_update(job_id, worker_id, finish)
+
+    def fail(self, job_id: int, worker_id: str, error: str) -> bool:
+        def retry(pipe, queue_name, attempts):
+            pipe.zrem(self._key(queue_name, 'leases'), job_id)
+            self._queue_retry(pipe, queue_name, job_id, attempts, error)
+
+        return self._owned_update(job_id, worker_id, retry)
+
+    def _jobs(self, queue_name: str) -> List[Dict]:
+        jobs = []
+        for job_id in self.client.lrange(self._key(queue_name, 'all'), 0, -1):
+            data = self.client.hgetall(self._key('job', int(job_id)))
+            jobs.append({(k.decode() if isinstance(k, bytes) else k): (v.decode() if isinstance(v, bytes) else v)
+                         for k, v in data.items()})
+        return jobs
+
+    def counts(self, queue_name: str) -> Dict[str, int]:
+        self._requeue_expired(queue_name)
+        counts = {}
+        for job in self._jobs(queue_name):
+            counts[job['status']] = counts.get(job['status'], 0) + 1
+        return counts
+
+    def results(self, queue_name: str) -> List[tuple]:
+        return [(json.loads(job['payload']), job['status'], json.loads(job['result']) if job.get('result') else None)
+                for job in self._jobs(queue_name)]
+
+    def set_meta(self, key: str, value: str):
+        self.client.hset(self._key('meta'), key, value)
+
+    def get_meta(self, key: str) -> Optional[str]:
+        value = self.client.hget(self._key('meta'), key)
+        return value.decode() if isinstance(value, bytes) else value
+
+
+def open_job_queue(url: str, lease_seconds: float = 120):
+    """
+    Mở job queue theo URL: sqlite:///đường/dẫn/queue.db hoặc redis://host:6379/0
+    """
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisJobQueue(url, lease_seconds=lease_seconds)
+    if url.startswith('sqlite:///'):
+        return SQLiteJobQueue(url[len('sqlite:///'):], lease_seconds=lease_seconds)
+    return SQLiteJobQueue(url, lease_seconds=lease_seconds)
+
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+THROUGHPUT_BUCKETS = (64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2)
+
+# Tên metric -> (loại, mô tả, buckets cho histogram)
+METRIC_DEFINITIONS = {
+    'pixabay_pages_fetched_total': ('counter', 'Số trang tìm kiếm đã crawl theo kết quả', None),
+    'pixabay_page_parse_seconds': ('histogram', 'Thời gian parse HTML một trang', LATENCY_BUCKETS),
+    'pixabay_prewarm_seconds': ('histogram', 'Thời gian mở sẵn/giữ kết nối keep-alive theo host', LATENCY_BUCKETS),
+    'pixabay_page_first_track_seconds': ('histogram', 'Thời gian từ lúc gửi request trang tới track đầu tiên',
+                                         LATENCY_BUCKETS),
+    'pixabay_items_per_page': ('histogram', 'Số tracks tìm thấy mỗi trang', (0, 1, 5, 10, 20, 50, 100)),
+    'pixabay_stage_seconds': ('histogram', 'Latency mỗi đơn vị công việc theo stage (crawl/resolve/download)',
+                              LATENCY_BUCKETS),
+    'pixabay_stage_total': ('counter', 'Số đơn vị công việc theo stage và kết quả', None),
+    'pixabay_active_workers': ('gauge', 'Số worker đang chạy trong mỗi stage', None),
+    'pixabay_http_responses_total': ('counter', 'Số response HTTP theo status code', None),
+    'pixabay_retries_total': ('counter', 'Số lần thử lại/phương pháp thay thế theo stage', None),
+    'pixabay_downloads_total': ('counter', 'Số file download theo kết quả (ok/duplicate/failed)', None),
+    'pixabay_download_bytes_total': ('counter', 'Tổng bytes đã download', None),
+    'pixabay_download_throughput_bytes_per_second': ('histogram', 'Throughput của từng file', THROUGHPUT_BUCKETS),
+    'pixabay_download_ttfb_seconds': ('histogram', 'Time-to-first-byte của request download (tới khi có headers)',
+                                      LATENCY_BUCKETS),
+}
+
+
+class MetricsRegistry:
+    """
+    Counter / gauge / histogram theo kiểu Prometheus, thread-safe, không cần thư viện ngoài.
+    Xuất text format cho Prometheus (serve) hoặc JSON (to_dict / dump_json).
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._values = {}      # (name, labels) -> số (counter/gauge)
+        self._histograms = {}  # (name, labels) -> {'buckets': [...], 'sum': x, 'count': n}
+        self._server = None
+
+    @staticmethod
+    def _labels(labels: Dict) -> tuple:
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, self._labels(labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        buckets = METRIC_DEFINITIONS[name][2]
+        key = (name, self._labels(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            for position, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram['buckets'][position] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @staticmethod
+    def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+        pairs = labels + extra
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+    def render_prometheus(self) -> str:
+        """
+        Text exposition format 0.0.4 (cumulative buckets, _sum, _count)
+        """
+        with self._lock:
+            values = dict(self._values)
+            histograms = {key: dict(value, buckets=list(value['buckets'])) for key, value in self._histograms.items()}
+        lines = []
+        for name, (kind, description, buckets) in METRIC_DEFINITIONS.items():
+            series = [(key, value) for key, value in (histograms if kind == 'histogram' else values).items()
+                      if key[0] == name]
+            if not series:
+                continue
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (_, labels), value in sorted(series):
+                if kind != 'histogram':
+                    lines.append(f"{name}{self._format_labels(labels)} {value}")
+                    continue
+                for bound, count in zip(buckets, value['buckets']):
+                    lines.append(f"{name}_bucket{self._format_labels(labels, (('le', str(bound)),))} {count}")
+                lines.append(f"{name}_bucket{self._format_labels(labels, (('le', '+Inf'),))} {value['count']}")
+                lines.append(f"{name}_sum{self._format_labels(labels)} {value['sum']}")
+                lines.append(f"{name}_count{self._format_labels(labels)} {value['count']}")
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self) -> Dict:
+        with self._lock:
+            metrics = {}
+            for (name, labels), value in self._values.items():
+                metrics.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+            for (name, labels), value in self._histograms.items():
+                metrics.setdefault(name, []).append({
+                    'labels': dict(labels), 'count': value['count'], 'sum': value['sum'],
+                    'buckets': dict(zip((str(bound) for bound in METRIC_DEFINITIONS[name][2]), value['buckets'])),
+                })
+        return metrics
+
+    def dump_json(self, path: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+        print(f"📈 Đã ghi metrics JSON: {path}")
+
+    def serve(self, port: int, host: str = '127.0.0.1'):
+        """
+        Mở endpoint /metrics (Prometheus text format) trong thread nền
+        """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/metrics', '/'):
+                    self.send_error(404)
+                    return
+                body = registry.render_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=self._server.serve_forever, name='Metrics', daemon=True).start()
+        print(f"📈 Metrics: http://{host}:{self._server.server_address[1]}/metrics")
+        return self._server.server_address[1]
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+# Span đang mở của thread/coroutine hiện tại - contextvars để task asyncio không lẫn span của nhau
+_current_span = contextvars.ContextVar('pixabay_current_span', default=None)
+
+
+def traced(name: str, attrs=None):
+    """
+    Decorator cho method: chạy cả method trong span `name` của self.tracer,
+    attrs(*args, **kwargs) (cùng tham số với method, không có self) trả về attributes của span
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self.tracer.span(name, **(attrs(*args, **kwargs) if attrs else {})):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def traced_async(name: str, attrs=None):
+    """
+    Như traced nhưng cho coroutine method - span đóng khi coroutine chạy xong, không phải khi được tạo
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            with self.tracer.span(name, **(attrs(*args, **kwargs) if attrs else {})):
+                return await func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Tracer:
+    """
+    Ghi span theo stage (page/track/http/parse/...) kèm tên thread.
+    Xuất Chrome trace_event JSON (mở bằng Perfetto / chrome://tracing) hoặc OTLP JSON cho collector.
+    Tắt mặc định - span() khi tắt không ghi gì.
+    """
+    def __init__(self, enabled: bool = False, max_spans: int = 200000, service_name: str = 'pixabay-downloader'):
+        self.enabled = enabled
+        self.max_spans = max_spans
+        self.service_name = service_name
+        self.spans = []
+        self.dropped = 0
+        self.trace_id = os.urandom(16).hex()
+        self._lock = Lock()
+        # perf_counter cho độ chính xác, cộng offset để ra thời gian thực (OTLP cần unix nano)
+        self._epoch_offset_ns = time.time_ns() - time.perf_counter_ns()
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        """
+        Mở một span con của span hiện tại. Caller có thể thêm attrs qua span['attrs'] (None khi tắt).
+        """
+        if not self.enabled:
+            yield None
+            return
+        thread = threading.current_thread()
+        record = {
+            'name': name,
+            'span_id': os.urandom(8).hex(),
+            'parent_id': _current_span.get(),
+            'start_ns': time.perf_counter_ns(),
+            'end_ns': None,
+            'thread_id': thread.ident,
+            'thread_name': thread.name,
+            'attrs': attrs,
+            'error': None,
+        }
+        token = _current_span.set(record['span_id'])
+        try:
+            yield record
+        except BaseException as e:
+            record['error'] = str(e) or type(e).__name__
+            raise
+        finally:
+            record['end_ns'] = time.perf_counter_ns()
+            _current_span.reset(token)
+            with self._lock:
+                if len(self.spans) < self.max_spans:
+                    self.spans.append(record)
+                else:
+                    self.dropped += 1
+
+    def to_chrome_trace(self) -> Dict:
+        """
+        Chrome trace_event format: mỗi span là một complete event ('X'), thêm metadata tên thread
+        """
+        with self._lock:
+            spans = list(self.spans)
+        pid = os.getpid()
+        events = []
+        # ident của thread được tái sử dụng khi pool cũ kết thúc - đánh tid theo cặp (ident, tên)
+        thread_ids = {}
+        for record in spans:
+            tid = thread_ids.setdefault((record['thread_id'], record['thread_name']), len(thread_ids) + 1)
+            args = {key: str(value) for key, value in record['attrs'].items()}
+            if record['error']:
+                args['error'] = record['error']
+            events.append({
+                'name': record['name'],
+                'cat': record['name'].split('.')[0],
+                'ph': 'X',
+                'ts': (record['start_ns'] + self._epoch_offset_ns) / 1000,
+                'dur': (record['end_ns'] - record['start_ns']) / 1000,
+                'pid': pid,
+                'tid': tid,
+                'args': args,
+            })
+        for (_, thread_name), tid in thread_ids.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                           'args': {'name': thread_name}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def to_otlp(self) -> Dict:
+        """
+        OTLP/JSON (ExportTraceServiceRequest) - POST lên /v1/traces của collector
+        """
+        with self._lock:
+            spans = list(self.spans)
+        otlp_spans = []
+        for record in spans:
+            attributes = [{'key': key, 'value': {'stringValue': str(value)}} for key, value in record['attrs'].items()]
+            attributes.append({'key': 'thread.name', 'value': {'stringValue': record['thread_name']}})
+            attributes.append({'key': 'thread.id', 'value': {'intValue': str(record['thread_id'])}})
+            otlp_span = {
+                'traceId': self.trace_id,
+                'spanId': record['span_id'],
+                'name': record['name'],
+                'kind': 1,
+                'startTimeUnixNano': str(record['start_ns'] + self._epoch_offset_ns),
+                'endTimeUnixNano': str(record['end_ns'] + self._epoch_offset_ns),
+                'attributes': attributes,
+                'status': {'code': 2, 'message': record['error']} if record['error'] else {'code': 1},
+            }
+            if record['parent_id']:
+                otlp_span['parentSpanId'] = record['parent_id']
+            otlp_spans.append(otlp_span)
+        return {'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': self.service_name}}]},
+            'scopeSpans': [{'scope': {'name': 'pixabay_music_downloader'}, 'spans': otlp_spans}],
+        }]}
+
+    def dump_chrome(self, path: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_chrome_trace(), f, ensure_ascii=False)
+        print(f"🧭 Đã ghi trace ({len(self.spans)} spans): {path} - mở bằng https://ui.perfetto.dev")
+        if self.dropped:
+            print(f"⚠️  Bỏ {self.dropped} spans vì vượt giới hạn {self.max_spans}")
+
+    def export_otlp(self, endpoint: str) -> bool:
+        """
+        Gửi spans tới OTLP/HTTP collector, vd. http://localhost:4318
+        """
+        url = endpoint if endpoint.rstrip('/').endswith('/v1/traces') else endpoint.rstrip('/') + '/v1/traces'
+        try:
+            response = requests.post(url, json=self.to_otlp(), timeout=10)
+            response.raise_for_status()
+            print(f"🧭 Đã gửi {len(self.spans)} spans tới {url}")
+            return True
+        except Exception as e:
+            print(f"⚠️  Không gửi được trace tới {url}: {e}")
+            return False
+
+
+class StageProfiler:
+    """
+    Profile CPU theo stage (crawl / resolve / download) trên mọi worker thread.
+    - cprofile: mỗi (thread, stage) một cProfile.Profile, bật/tắt khi vào/ra stage; gộp thành pstats theo stage
+    - sample: thread nền chụp stack của các thread đang ở trong stage mỗi `interval` giây -
+      overhead thấp, để bật được trong các lần chạy dài
+    Cả hai ghi file collapsed stacks (flamegraph.pl / speedscope đọc được).
+    """
+    MODES = ('cprofile', 'sample')
+
+    def __init__(self, mode: str = 'cprofile', interval: float = 0.01):
+        if mode not in self.MODES:
+            raise ValueError(f"Chế độ profile không hỗ trợ: {mode} (chọn {', '.join(self.MODES)})")
+        self.mode = mode
+        self.interval = interval
+        self._lock = Lock()
+        self._local = threading.local()
+        self.profiles = {}        # (thread_name, stage) -> cProfile.Profile
+        self.thread_stats = {}    # (thread_name, stage) -> {'units', 'wall', 'cpu'}
+        self.samples = {}         # collapsed stack -> số lần chụp
+        self.sample_count = 0
+        self.skipped = 0
+        self._active = {}         # thread ident -> stage hiện tại (cho sampling)
+        self._sampler = None
+        self._stop_event = threading.Event()
+
+    def start(self):
+        if self.mode == 'sample' and self._sampler is None:
+            self._stop_event.clear()
+            self._sampler = threading.Thread(target=self._sample_loop, name='Sampler', daemon=True)
+            self._sampler.start()
+
+    def stop(self):
+        if self._sampler is not None:
+            self._stop_event.set()
+            self._sampler.join()
+            self._sampler = None
+
+    def enter(self, stage: str):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        thread_name = threading.current_thread().name
+        profile = None
+        if self.mode == 'cprofile':
+            # Stage lồng nhau: tạm dừng profile của stage ngoài để thời gian không bị tính hai lần
+            if stack and stack[-1][1] is not None:
+                stack[-1][1].disable()
+            with self._lock:
+                profile = self.profiles.get((thread_name, stage))
+                if profile is None:
+                    profile = self.profiles[(thread_name, stage)] = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Python 3.12+ chỉ cho một profiler hoạt động cùng lúc - bỏ qua đơn vị này
+                profile = None
+                self.skipped += 1
+        self._active[threading.get_ident()] = stage
+        stack.append((stage, profile, time.perf_counter(), time.thread_time()))
+
+    def exit(self):
+        stage, profile, wall_started_at, cpu_started_at = self._local.stack.pop()
+        if profile is not None:
+            profile.disable()
+        thread_name = threading.current_thread().name
+        with self._lock:
+            stats = self.thread_stats.setdefault((thread_name, stage), {'units': 0, 'wall': 0.0, 'cpu': 0.0})
+            stats['units'] += 1
+            stats['wall'] += time.perf_counter() - wall_started_at
+            stats['cpu'] += time.thread_time() - cpu_started_at
+        stack = self._local.stack
+        if stack:
+            self._active[threading.get_ident()] = stack[-1][0]
+            if stack[-1][1] is not None:
+                stack[-1][1].enable()
+        else:
+            self._active.pop(threading.get_ident(), None)
+
+    def _sample_loop(self):
+        while not self._stop_event.wait(self.interval):
+            frames = sys._current_frames()
+            for thread_id, stage in list(self._active.items()):
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                key = ';'.join([stage] + names[::-1])
+                self.samples[key] = self.samples.get(key, 0) + 1
+            self.sample_count += 1
+
+    @staticmethod
+    def _frame_name(func: tuple) -> str:
+        filename, line, name = func
+        return f"{name} ({os.path.basename(filename)}:{line})"
+
+    def _collapsed_from_stats(self, stats: 'pstats.Stats', stage: str) -> Dict[str, int]:
+        """
+        cProfile chỉ lưu cạnh caller -> callee nên stack được dựng lại bằng cách chia tottime của
+        mỗi hàm cho các caller theo tỉ lệ cumtime (gần đúng, đủ để nhìn flamegraph). Đơn vị: micro giây.
+        """
+        raw = stats.stats
+        collapsed = {}
+
+        def walk(func, weight, suffix, seen, depth):
+            callers = raw.get(func, (0, 0, 0, 0, {}))[4]
+            callers = {caller: data for caller, data in callers.items() if caller not in seen}
+            if not callers or depth > 40:
+                key = ';'.join([stage] + [self._frame_name(frame) for frame in reversed(suffix)])
+                collapsed[key] = collapsed.get(key, 0) + weight
+                return
+            total = sum(data[3] for data in callers.values()) or len(callers)
+            for caller, data in callers.items():
+                share = weight * (data[3] or 1) / total
+                if share >= 1:
+                    walk(caller, share, suffix + [caller], seen | {caller}, depth + 1)
+
+        for func, (_, _, tottime, _, _) in raw.items():
+            if tottime > 0:
+                walk(func, tottime * 1e6, [func], {func}, 0)
+        return {key: int(value) for key, value in collapsed.items() if int(value) > 0}
+
+    def write(self, output_dir: str) -> List[str]:
+        """
+        Ghi kết quả vào output_dir, trả về danh sách file đã ghi
+        """
+        self.stop()
+        os.makedirs(output_dir, exist_ok=True)
+        written = []
+
+        def write_collapsed(path, collapsed):
+            with open(path, 'w', encoding='utf-8') as f:
+                for key, value in sorted(collapsed.items()):
+                    f.write(f"{key} {value}\n")
+            written.append(path)
+
+        stages = sorted({stage for _, stage in self.thread_stats})
+        if self.mode == 'cprofile':
+            for stage in stages:
+                profiles = [profile for (_, profile_stage), profile in self.profiles.items() if profile_stage == stage]
+                profiles = [profile for profile in profiles if profile.getstats()]
+                if not profiles:
+                    continue
+                stats = pstats.Stats(*profiles)
+                pstats_path = os.path.join(output_dir, f"profile_{stage}.pstats")
+                stats.dump_stats(pstats_path)
+                written.append(pstats_path)
+                text_path = os.path.join(output_dir, f"profile_{stage}.txt")
+                with open(text_path, 'w', encoding='utf-8') as f:
+                    pstats.Stats(pstats_path, stream=f).sort_stats('cumulative').print_stats(40)
+                written.append(text_path)
+                write_collapsed(os.path.join(output_dir, f"profile_{stage}.collapsed"),
+                                self._collapsed_from_stats(stats, stage))
+        else:
+            for stage in stages:
+                write_collapsed(os.path.join(output_dir, f"profile_{stage}.collapsed"),
+                                {key: value for key, value in self.samples.items() if key.split(';', 1)[0] == stage})
+            write_collapsed(os.path.join(output_dir, "profile_all.collapsed"), self.samples)
+
+        threads_path = os.path.join(output_dir, "profile_threads.txt")
+        with open(threads_path, 'w', encoding='utf-8') as f:
+            f.write(f"{'stage':<10}{'thread':<20}{'units':>8}{'wall(s)':>10}{'cpu(s)':>10}{'cpu%':>7}\n")
+            for (thread_name, stage), stats in sorted(self.thread_stats.items(), key=lambda entry: (entry[0][1], entry[0][0])):
+                cpu_percent = stats['cpu'] / stats['wall'] * 100 if stats['wall'] > 0 else 0
+                f.write(f"{stage:<10}{thread_name:<20}{stats['units']:>8}{stats['wall']:>10.2f}"
+                        f"{stats['cpu']:>10.2f}{cpu_percent:>6.0f}%\n")
+        written.append(threads_path)
+
+        print(f"🔬 Profile ({self.mode}) theo stage:")
+        for stage in stages:
+            entries = [stats for (_, entry_stage), stats in self.thread_stats.items() if entry_stage == stage]
+            wall = sum(stats['wall'] for stats in entries)
+            cpu = sum(stats['cpu'] for stats in entries)
+            print(f"   {stage:<9} {sum(stats['units'] for stats in entries):>5} đơn vị | {len(entries)} threads | "
+                  f"wall {wall:.2f}s | cpu {cpu:.2f}s")
+        if self.mode == 'sample':
+            print(f"   📸 {self.sample_count} lần chụp stack (mỗi {self.interval * 1000:.0f}ms)")
+        if self.skipped:
+            print(f"   ⚠️  {self.skipped} đơn vị không profile được (Python chỉ cho một cProfile hoạt động cùng lúc)")
+        print(f"📁 Đã ghi {len(written)} file profile vào {output_dir}")
+        return written
+
+
+class MemoryMonitor:
+    """
+    Đo bộ nhớ bằng tracemalloc: peak khi mỗi stage đang chạy (thread nền lấy mẫu), phần giữ lại sau mỗi
+    đơn vị công việc, và theo từng trang (HTML, cây BeautifulSoup, items giữ lại).
+    Có budget thì crawl chỉ bắt đầu trang mới khi bộ nhớ hiện tại + ước lượng chi phí một trang còn nằm trong budget.
+    Số đo theo trang là gần đúng khi nhiều thread parse cùng lúc (tracemalloc đếm chung cả process).
+    """
+    def __init__(self, budget_bytes: int = 0, interval: float = 0.05, default_page_cost: int = 4 * 1024 * 1024):
+        self.budget_bytes = budget_bytes
+        self.interval = interval
+        self.page_cost = default_page_cost
+        self._started_tracemalloc = not tracemalloc.is_tracing()
+        if self._started_tracemalloc:
+            tracemalloc.start()
+        self._lock = Lock()
+        self._budget_condition = threading.Condition()
+        self._reserved = 0
+        self._in_flight = 0
+        self.throttled = 0
+        self.throttle_wait = 0.0
+        self.stages = {}     # stage -> {'units', 'peak', 'retained'}
+        self.pages = []
+        self._active = {}    # stage -> số đơn vị đang chạy
+        self.peak = 0
+        self._stop_event = threading.Event()
+        self._sampler = threading.Thread(target=self._sample_loop, name='MemorySampler', daemon=True)
+        self._sampler.start()
+
+    @staticmethod
+    def current() -> int:
+        return tracemalloc.get_traced_memory()[0]
+
+    def _sample_loop(self):
+        while not self._stop_event.wait(self.interval):
+            current = self.current()
+            with self._lock:
+                self.peak = max(self.peak, current)
+                for stage, active in self._active.items():
+                    if active:
+                        stats = self.stages[stage]
+                        stats['peak'] = max(stats['peak'], current)
+
+    def stage_enter(self, stage: str):
+        current = self.current()
+        with self._lock:
+            stats = self.stages.setdefault(stage, {'units': 0, 'peak': 0, 'retained': 0, '_window_start': 0})
+            stats['peak'] = max(stats['peak'], current)
+            # Phần giữ lại đo theo cửa sổ từ lúc đơn vị đầu tiên vào đến lúc đơn vị cuối cùng ra -
+            # cộng delta từng đơn vị sẽ đếm trùng khi nhiều thread chạy song song
+            if not self._active.get(stage):
+                stats['_window_start'] = current
+            self._active[stage] = self._active.get(stage, 0) + 1
+
+    def stage_exit(self, stage: str):
+        current = self.current()
+        with self._lock:
+            stats = self.stages[stage]
+            stats['units'] += 1
+            stats['peak'] = max(stats['peak'], current)
+            self._active[stage] -= 1
+            if not self._active[stage]:
+                stats['retained'] += current - stats['_window_start']
+
+    @contextmanager
+    def page_slot(self):
+        """
+        Chờ đến khi bắt đầu thêm một trang không vượt budget - luôn cho ít nhất một trang chạy để không kẹt
+        """
+        if not self.budget_bytes:
+            yield
+            return
+        estimate = self.page_cost
+        waited_from = None
+        with self._budget_condition:
+            while self._in_flight > 0 and self.current() + self._reserved + estimate > self.budget_bytes:
+                if waited_from is None:
+                    waited_from = time.monotonic()
+                    self.throttled += 1
+                self._budget_condition.wait(0.1)
+            self._in_flight += 1
+            self._reserved += estimate
+        if waited_from is not None:
+            self.throttle_wait += time.monotonic() - waited_from
+        try:
+            yield
+        finally:
+            with self._budget_condition:
+                self._in_flight -= 1
+                self._reserved -= estimate
+                self._budget_condition.notify_all()
+
+    def record_page(self, page_stats: Dict):
+        """
+        page_stats: page, html_bytes, tree_bytes (cây soup lúc parse xong), items, items_bytes
+        """
+        with self._lock:
+            self.pages.append(page_stats)
+            # Ước lượng chi phí một trang (HTML + cây soup) cho budget - trung bình trượt
+            cost = page_stats.get('html_bytes', 0) + max(page_stats.get('tree_bytes', 0), 0)
+            if cost > 0:
+                self.page_cost = int(self.page_cost * 0.7 + cost * 0.3)
+
+    @staticmethod
+    def items_size(items: List[Track]) -> int:
+        size = sys.getsizeof(items)
+        for item in items:
+            size += sys.getsizeof(item) + sum(sys.getsizeof(value) for value in item.values())
+        return size
+
+    def to_dict(self) -> Dict:
+        with self._lock:
+            return {
+                'budget': self.budget_bytes,
+                'peak': self.peak,
+                'current': self.current(),
+                'page_cost_estimate': self.page_cost,
+                'throttled': self.throttled,
+                'throttle_wait': self.throttle_wait,
+                'stages': {stage: {key: value for key, value in stats.items() if not key.startswith('_')}
+                           for stage, stats in self.stages.items()},
+                'pages': list(self.pages),
+            }
+
+    def report(self, path: Optional[str] = None):
+        data = self.to_dict()
+        mb = 1024 * 1024
+        print(f"🧠 BỘ NHỚ (tracemalloc): peak {data['peak'] / mb:.1f}MB | hiện tại {data['current'] / mb:.1f}MB")
+        for stage, stats in sorted(data['stages'].items()):
+            print(f"   {stage:<9} {stats['units']:>5} đơn vị | peak {stats['peak'] / mb:.1f}MB | "
+                  f"giữ lại {stats['retained'] / mb:+.2f}MB")
+        if data['pages']:
+            pages = sorted(data['pages'], key=lambda page: page.get('tree_bytes', 0), reverse=True)
+            print(f"   📄 {len(pages)} trang | HTML TB {sum(page.get('html_bytes', 0) for page in pages) / len(pages) / 1024:.0f}KB"
+                  f" | cây soup lớn nhất {pages[0].get('tree_bytes', 0) / mb:.1f}MB (trang {pages[0]['page']})"
+                  f" | items giữ lại {sum(page['items_bytes'] for page in pages) / 1024:.0f}KB")
+        if data['budget']:
+            print(f"   🎚️  Budget {data['budget'] / mb:.0f}MB | ước lượng mỗi trang {data['page_cost_estimate'] / mb:.1f}MB | "
+                  f"throttle {data['throttled']} lần (tổng thời gian chờ {data['throttle_wait']:.1f}s)")
+        if path:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            print(f"📁 Đã ghi báo cáo bộ nhớ: {path}")
+
+    def close(self):
+        self._stop_event.set()
+        self._sampler.join()
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+
+
+def predict_makespan(sizes: List[int], workers: int, throughput: float) -> float:
+    """
+    Mô phỏng thời gian hoàn thành batch: mỗi job (theo thứ tự submit) được giao
+    cho worker rảnh sớm nhất, mỗi worker tải với throughput bytes/giây
+    """
+    if not sizes or throughput <= 0:
+        return 0.0
+    finish_times = [0.0] * max(min(workers, len(sizes)), 1)
+    for size in sizes:
+        earliest = heapq.heappop(finish_times)
+        heapq.heappush(finish_times, earliest + size / throughput)
+    return max(finish_times)
+
+
 class PixabayMusicDownloader:
+    # Headers mạnh hơn để giả lập browser thật
+    BROWSER_HEADERS = {
+        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8',
+        'Accept-Language': 'en-US,en;q=0.9,vi;q=0.8',
+        'Accept-Encoding': 'gzip, deflate, br',
+        'DNT': '1',
+        'Connection': 'keep-alive',
+        'Upgrade-Insecure-Requests': '1',
+        'Sec-Fetch-Dest': 'document',
+        'Sec-Fetch-Mode': 'navigate',
+        'Sec-Fetch-Site': 'none',
+        'Cache-Control': 'max-age=0'
+    }
+    # Parse streaming: kích thước chunk đọc từ socket và class của một row kết quả tìm kiếm
+    STREAM_CHUNK_SIZE = 16 * 1024
+    STREAM_ROW_CLASS = 'audioRow'
+    # Host của trang và CDN - mở sẵn kết nối bằng prewarm_connections()
+    SITE_ORIGIN = 'https://pixabay.com'
+    CDN_ORIGIN = 'https://cdn.pixabay.com'
+    # Số kết nối keep-alive giữ lại mỗi host trong pool của session (crawl + resolve + download dùng chung)
+    POOL_SIZE = 16
+
     def __init__(self):
-        self.session = requests.Session()
-        # Headers mạnh hơn để giả lập browser thật
-        self.session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8',
-            'Accept-Language': 'en-US,en;q=0.9,vi;q=0.8',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'DNT': '1',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1',
-            'Sec-Fetch-Dest': 'document',
-            'Sec-Fetch-Mode': 'navigate',
-            'Sec-Fetch-Site': 'none',
-            'Cache-Control': 'max-age=0'
-        })
+        # Session requests tạo ở lần request đầu tiên - xem property session
+        self._session = None
+        # RLock: tạo session chính gọi _mount_adapter (cũng lấy lock này) khi đang giữ lock
+        self._session_lock = threading.RLock()
+        # Một HTTPAdapter (pool kết nối) dùng chung cho session chính và session download của từng thread
+        self._adapter = None
         self.music_list = []
         # Threading locks for thread-safe operations
         self.print_lock = Lock()
         self.progress_lock = Lock()
+        # SHA-256 -> filename của các file đã tải trong phiên, dùng để dedupe
+        self.known_hashes = {}
+        # Băng thông dùng chung cho mọi worker và giới hạn kết nối theo host
+        self.bandwidth_limiter = BandwidthLimiter()
+        self.host_limiter = HostConcurrencyLimiter()
+        # Ước lượng throughput mỗi worker (bytes/giây), cập nhật sau mỗi batch
+        self.throughput_estimate = 512 * 1024
+        # AIMD controllers theo stage (chỉ có khi bật auto concurrency)
+        self.aimd_controllers = {}
+        # Giới hạn theo host của engine async (AsyncLimit, tạo lại cho mỗi event loop)
+        self._async_host_slots = {}
+        # Trạng thái riêng của từng thread (mẫu đo của stage đang chạy)
+        self._tls = threading.local()
+        # Client HTTP/2 (httpx) - None = dùng requests/HTTP 1.1
+        self.http2_client = None
+        self._logged_http_versions = set()
+        # Metrics kiểu Prometheus cho mọi stage - xem serve_metrics()
+        self.metrics = MetricsRegistry()
+        # Tracing theo stage, tắt mặc định - xem enable_tracing()
+        self.tracer = Tracer()
+        # Delay trước mỗi request trang tìm kiếm (giây) để tránh bị block - 0 khi benchmark với mock server
+        self.request_delay = 2.0
+        # Profile CPU theo stage, tắt mặc định - xem enable_profiling()
+        self.profiler = None
+        # Đo bộ nhớ / budget cho crawl, tắt mặc định - xem enable_memory_monitor()
+        self.memory = None
+        # Catalog SQLite lưu kết quả crawl, tắt mặc định - xem open_catalog()
+        self.catalog = None
+        # Parse trang tìm kiếm trong lúc body còn đang tải (cần lxml) - False = tải hết rồi mới parse
+        self.stream_parse = True
+        # DNS cache + kết nối mở sẵn, tắt mặc định - xem prewarm_connections()
+        self.dns_cache = None
+        self.warmer = None
+        self._prewarm_errors = set()
+        # Index tìm kiếm tracks - xem build_index()
+        self.index = None
+        # Trang lỗi/403 thì thử trang Pixabay khác + danh sách demo - False = báo trang lỗi (benchmark, test)
+        self.allow_fallback = True
+        
+    @property
+    def session(self):
+        """
+        Session requests dùng chung (keep-alive) - tạo lúc cần, để import requests không nằm trên đường khởi động
+        """
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    session.headers.update(self.BROWSER_HEADERS)
+                    self._mount_adapter(session)
+                    self._session = session
+        return self._session
+
+    def _mount_adapter(self, session):
+        """
+        Gắn HTTPAdapter dùng chung vào session - mọi session lấy kết nối từ cùng một pool
+        (kể cả kết nối đã mở sẵn bởi prewarm_connections)
+        """
+        if self._adapter is None:
+            with self._session_lock:
+                if self._adapter is None:
+                    # Pool đủ lớn cho mọi thread crawl/resolve/download - kết nối trả về pool thay vì bị đóng
+                    self._adapter = requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=self.POOL_SIZE)
+        session.mount('https://', self._adapter)
+        session.mount('http://', self._adapter)
+
+    def _thread_session(self):
+        """
+        Session requests riêng cho thread hiện tại (cookies/headers của Session không thread-safe),
+        dùng chung pool kết nối qua HTTPAdapter của session chính
+        """
+        session = getattr(self._tls, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.headers.update(self.session.headers)
+            self._mount_adapter(session)
+            self._tls.session = session
+        return session
+
+    @session.setter
+    def session(self, session):
+        self._session = session
+
+    def enable_http2(self, max_connections: int = 4, verify=True, prior_knowledge: bool = False) -> bool:
+        """
+        Bật transport HTTP/2: nhiều request chạy song song (multiplex) trên vài kết nối.
+        Giao thức được thương lượng qua ALPN, server không hỗ trợ h2 thì tự fallback HTTP/1.1.
+        verify=False / ssl.SSLContext có CA riêng để test với server local dùng cert tự ký (xem tests/test_http2.py),
+        prior_knowledge=True để nói h2c (HTTP/2 không TLS) với server local.
+        """
+        if not httpx.available():
+            print("⚠️  Chưa cài httpx - chạy: pip install 'httpx[http2]'. Tiếp tục dùng HTTP/1.1")
+            return False
+        
+        headers = dict(self.session.headers)
+        # httpx chỉ giải nén br khi có brotli - chỉ xin gzip/deflate cho chắc
+        headers['Accept-Encoding'] = 'gzip, deflate'
+        headers.pop('Connection', None)
+        try:
+            self.http2_client = httpx.Client(
+                http1=not prior_knowledge,
+                http2=True,
+                headers=headers,
+                verify=verify,
+                timeout=30,
+                limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            )
+        except ImportError:
+            print("⚠️  Thiếu package h2 - chạy: pip install 'httpx[http2]'. Tiếp tục dùng HTTP/1.1")
+            return False
+        
+        print(f"⚡ Đã bật HTTP/2 (tối đa {max_connections} kết nối, multiplex nhiều stream)")
+        return True
+
+    def _log_http_version(self, url: str, http_version: str):
+        """
+        In giao thức đã thương lượng (HTTP/2 hay fallback HTTP/1.1) - mỗi host một lần
+        """
+        host = urllib.parse.urlparse(url).hostname
+        with self.print_lock:
+            if host in self._logged_http_versions:
+                return
+            self._logged_http_versions.add(host)
+            print(f"⚡ {host}: {http_version}")
+        
+    def enable_auto_concurrency(self, crawl_max: int = 5, resolve_max: int = 8, download_max: int = 8):
+        """
+        Bật chế độ tự điều chỉnh số worker (AIMD) cho các stage crawl, resolve và download.
+        max_workers truyền vào các hàm sẽ được thay bằng mức tối đa của stage.
+        """
+        for stage, maximum in (('crawl', crawl_max), ('resolve', resolve_max), ('download', download_max)):
+            if maximum:
+                self.aimd_controllers[stage] = AIMDController(stage, initial=min(2, maximum), maximum=maximum,
+                                                              print_lock=self.print_lock)
+
+    @contextmanager
+    def _stage(self, stage: str):
+        """
+        Bao một đơn vị công việc của stage: giới hạn concurrency (AIMD nếu bật) và đo latency/status/bytes.
+        Caller có thể set sample['ok'] / sample['bytes'].
+        sample['latency'] (nếu có) là latency AIMD dùng thay cho thời gian cả job - download ghi time-to-first-byte
+        để file lớn / băng thông chậm không bị coi là server quá tải.
+        """
+        controller = self.aimd_controllers.get(stage)
+        sample = {'stage': stage, 'statuses': [], 'bytes': 0, 'ok': True, 'latency': None}
+        previous_sample = getattr(self._tls, 'sample', None)
+        self._tls.sample = sample
+        if controller:
+            # Thời gian chờ slot AIMD hiện riêng trên timeline
+            with self.tracer.span(f"{stage}.wait"):
+                controller.semaphore.acquire()
+        started_at = time.monotonic()
+        self.metrics.inc('pixabay_active_workers', stage=stage)
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.enter(stage)
+        memory = self.memory
+        if memory is not None:
+            memory.stage_enter(stage)
+        try:
+            with self.tracer.span(stage) as span:
+                yield sample
+                if span is not None:
+                    span['attrs'].update(ok=sample['ok'], bytes=sample['bytes'])
+        except Exception:
+            sample['ok'] = False
+            raise
+        finally:
+            if profiler is not None:
+                profiler.exit()
+            if memory is not None:
+                memory.stage_exit(stage)
+            self._tls.sample = previous_sample
+            elapsed = time.monotonic() - started_at
+            self.metrics.inc('pixabay_active_workers', -1, stage=stage)
+            self.metrics.observe('pixabay_stage_seconds', elapsed, stage=stage)
+            self.metrics.inc('pixabay_stage_total', stage=stage, result='ok' if sample['ok'] else 'error')
+            if controller:
+                controller.semaphore.release()
+                latency = elapsed if sample['latency'] is None else sample['latency']
+                controller.record(latency, sample['statuses'], sample['bytes'], sample['ok'])
+
+    def _record_status(self, status_code: int):
+        """
+        Ghi status HTTP vào metrics và mẫu đo của stage hiện tại (nếu có)
+        """
+        self.metrics.inc('pixabay_http_responses_total', code=status_code)
+        sample = getattr(self._tls, 'sample', None)
+        if sample is not None:
+            sample['statuses'].append(status_code)
+
+    def _record_first_byte(self, seconds: float):
+        """
+        Ghi time-to-first-byte (request -> có headers) vào metrics và làm latency của mẫu đo stage hiện tại
+        """
+        self.metrics.observe('pixabay_download_ttfb_seconds', seconds)
+        sample = getattr(self._tls, 'sample', None)
+        if sample is not None and sample['latency'] is None:
+            sample['latency'] = seconds
+        
+    def set_bandwidth_limit(self, bytes_per_second: float):
+        """
+        Đổi giới hạn băng thông tổng (bytes/giây, 0 = không giới hạn) - áp dụng ngay cả khi đang download
+        """
+        self.bandwidth_limiter.set_rate(bytes_per_second)
+
+    def set_host_limit(self, host: str, max_connections: int):
+        """
+        Đổi số request đồng thời tối đa tới một host - áp dụng ngay cả khi đang chạy
+        """
+        self.host_limiter.set_limit(host, max_connections)
+
+    def enable_profiling(self, mode: str = 'cprofile', interval: float = 0.01) -> StageProfiler:
+        """
+        Bật profile CPU theo stage - ghi kết quả bằng self.profiler.write(thư_mục)
+        """
+        self.profiler = StageProfiler(mode, interval)
+        self.profiler.start()
+        return self.profiler
+
+    def enable_memory_monitor(self, budget_mb: float = 0) -> MemoryMonitor:
+        """
+        Bật đo bộ nhớ theo stage/trang; budget_mb > 0 thì giới hạn số trang crawl đồng thời theo bộ nhớ
+        """
+        self.memory = MemoryMonitor(int(budget_mb * 1024 * 1024))
+        return self.memory
+
+    def open_catalog(self, path: str) -> TrackCatalog:
+        """
+        Lưu kết quả crawl vào catalog SQLite và cho phép download_music_range chọn tracks từ catalog
+        """
+        self.catalog = TrackCatalog(path)
+        return self.catalog
+
+    def save_to_catalog(self, source: Optional[str] = None, items: Optional[List[Track]] = None):
+        """
+        Ghi items (mặc định self.music_list) vào catalog (nếu đã mở)
+        """
+        items = self.music_list if items is None else items
+        if self.catalog is None or not items:
+            return
+        added, updated = self.catalog.add_tracks(items, source)
+        print(f"🗃️  Catalog {self.catalog.describe()}: +{added} tracks mới, {updated} cập nhật "
+              f"(tổng {self.catalog.count()})")
+
+    def prewarm_connections(self, urls: Optional[List[str]] = None, connections: int = 2,
+                            keepalive: float = 30.0, include_cdn: bool = True) -> ConnectionWarmer:
+        """
+        Bật DNS cache và mở sẵn `connections` kết nối keep-alive tới host của các URL (mặc định pixabay.com
+        và cdn.pixabay.com) ở thread nền, giữ sống mỗi `keepalive` giây - stage đầu tiên không phải chờ bắt tay
+        """
+        self.stop_prewarm()
+        origins = []
+        for url in (urls or [self.SITE_ORIGIN]) + ([self.CDN_ORIGIN] if include_cdn else []):
+            parsed = urllib.parse.urlparse(url)
+            if parsed.scheme and parsed.netloc:
+                origins.append(f"{parsed.scheme}://{parsed.netloc}/")
+        # Chỉ cache DNS của các host được mở sẵn - request khác trong process vẫn resolve như bình thường
+        self.dns_cache = DNSCache(hosts=[urllib.parse.urlparse(origin).hostname for origin in origins])
+        self.dns_cache.install()
+        self.warmer = ConnectionWarmer(self._warm_request, origins, connections, keepalive,
+                                       self.dns_cache, self.host_limiter).start()
+        print(f"🔥 Mở sẵn {connections} kết nối/host tới {', '.join(self.warmer.origins)} "
+              f"(keep-alive mỗi {keepalive:.0f}s)")
+        return self.warmer
+
+    def stop_prewarm(self):
+        if self.warmer is not None:
+            self.warmer.stop()
+            self.warmer = None
+        if self.dns_cache is not None:
+            self.dns_cache.uninstall()
+            self.dns_cache = None
+
+    def _warm_request(self, url: str):
+        """
+        HEAD nhẹ để mở/giữ một kết nối trong pool - lỗi chỉ in ra, không ảnh hưởng crawl/download
+        """
+        started_at = time.monotonic()
+        try:
+            with self.host_limiter.slot(url):
+                if self.http2_client is not None:
+                    self.http2_client.head(url, timeout=10)
+                else:
+                    self.session.head(url, timeout=10, allow_redirects=False)
+        except Exception as e:
+            # Mỗi host chỉ in một lần - ping keep-alive lặp lại liên tục
+            with self.print_lock:
+                if url not in self._prewarm_errors:
+                    self._prewarm_errors.add(url)
+                    print(f"⚠️  Không mở sẵn được kết nối tới {url}: {e}")
+            return
+        self.metrics.observe('pixabay_prewarm_seconds', time.monotonic() - started_at,
+                             host=urllib.parse.urlparse(url).hostname)
+
+    def build_index(self, path: Optional[str] = None) -> TrackIndex:
+        """
+        Tạo index tìm kiếm trên catalog (nếu đã mở, path = file index lưu lại giữa các lần chạy)
+        hoặc trên self.music_list. Track download xong được đánh dấu downloaded trong index
+        """
+        started_at = time.monotonic()
+        if self.catalog is not None and self.catalog.count():
+            self.index = TrackIndex.from_catalog(self.catalog, path)
+        else:
+            self.index = TrackIndex(self.music_list)
+        print(f"🔎 Index: {len(self.index)} tracks, {self.index.token_count()} từ "
+              f"({(time.monotonic() - started_at) * 1000:.0f}ms)")
+        return self.index
+
+    def browse_tracks(self, page_size: int = 20) -> Optional[SearchResult]:
+        """
+        Tìm kiếm và xem tracks theo từng trang (tương tác) thay vì in cả danh sách
+        Returns: kết quả để chọn range download, None nếu người dùng thoát
+        """
+        index = self.index or self.build_index()
+        result = index.search()
+        page = 1
+        result.print_page(page, page_size)
+        while True:
+            command = input("\n🔎 Enter = trang tiếp | p = trang trước | <số> = tới trang | "
+                            "/từ khóa = tìm (vd: /piano relax* page:1-3 duration:<180 downloaded:no)\n"
+                            "   d = chọn range để download | q = thoát\n> ").strip()
+            if command == 'q':
+                return None
+            if command == 'd':
+                if result:
+                    return result
+                print("📭 Không có track nào trong kết quả - tìm lại")
+                continue
+            if command.startswith('/'):
+                try:
+                    result = index.search(command[1:].strip())
+                except ValueError as e:
+                    print(f"❌ {e}")
+                    continue
+                page = 1
+            elif command == 'p':
+                page = max(page - 1, 1)
+            elif command.isdigit():
+                page = min(max(int(command), 1), result.page_count(page_size))
+            elif command == '':
+                if page >= result.page_count(page_size):
+                    print("📄 Đã ở trang cuối - 'd' để chọn range, /từ khóa để tìm lại")
+                    continue
+                page += 1
+            else:
+                print("❌ Lệnh không hợp lệ")
+                continue
+            result.print_page(page, page_size)
+
+    def enable_tracing(self):
+        """
+        Bật ghi span cho mọi stage - xuất bằng self.tracer.dump_chrome() / export_otlp()
+        """
+        self.tracer.enabled = True
+
+    def serve_metrics(self, port: int, host: str = '127.0.0.1') -> int:
+        """
+        Mở endpoint Prometheus /metrics (port 0 = chọn port trống), trả về port thực
+        """
+        return self.metrics.serve(port, host)
+
+    def _http_get(self, url: str, session=None, method: str = 'GET', **kwargs):
+        """
+        Request không stream đi qua giới hạn concurrency theo host
+        """
+        with self.tracer.span('http', method=method, url=url) as span, self.host_limiter.slot(url):
+            if self.http2_client is not None and session is None:
+                # requests dùng allow_redirects, httpx dùng follow_redirects
+                kwargs['follow_redirects'] = kwargs.pop('allow_redirects', True)
+                response = self.http2_client.request(method, url, **kwargs)
+                self._log_http_version(url, response.http_version)
+            else:
+                response = (session or self.session).request(method, url, **kwargs)
+            if span is not None:
+                span['attrs']['status'] = response.status_code
+        self._record_status(response.status_code)
+        return response
+
+    @contextmanager
+    def _open_download_stream(self, url: str):
+        """
+        Mở response stream cho download - qua client HTTP/2 nếu đã bật,
+        không thì dùng session requests riêng của thread (kết nối keep-alive lấy từ pool chung, kể cả kết nối đã mở sẵn)
+        """
+        started_at = time.monotonic()
+        if self.http2_client is not None:
+            with self.http2_client.stream('GET', url, follow_redirects=True) as response:
+                self._record_first_byte(time.monotonic() - started_at)
+                self._log_http_version(url, response.http_version)
+                yield HttpxStreamResponse(response)
+            return
         
-    def parse_pixabay_page(self, url: str) -> List[Dict]:
+        # Pool của urllib3 thread-safe: mỗi response giữ riêng một kết nối, xong thì trả về pool
+        response = self._thread_session().get(url, stream=True, timeout=30)
+        self._record_first_byte(time.monotonic() - started_at)
+        try:
+            yield response
+        finally:
+            response.close()
+        
+    @contextmanager
+    def _http_stream(self, url: str, timeout: float = 30):
+        """
+        GET stream (body chưa đọc) đi qua giới hạn concurrency theo host - giữ slot tới khi đọc xong body
+        """
+        with self.tracer.span('http', method='GET', url=url, stream=True) as span, \
+                self.host_limiter.slot(url), contextlib.ExitStack() as stack:
+            if self.http2_client is not None:
+                raw_response = stack.enter_context(
+                    self.http2_client.stream('GET', url, follow_redirects=True, timeout=timeout))
+                self._log_http_version(url, raw_response.http_version)
+                response = HttpxStreamResponse(raw_response)
+            else:
+                response = self.session.get(url, stream=True, timeout=timeout, allow_redirects=True)
+                stack.callback(response.close)
+            if span is not None:
+                span['attrs']['status'] = response.status_code
+            self._record_status(response.status_code)
+            yield response
+
+    def parse_pixabay_page(self, url: str) -> List[Track]:
         """
         Parse trang Pixabay để lấy danh sách nhạc
         """
@@ -47,26 +3451,61 @@ class PixabayMusicDownloader:
         
         try:
             # Thử với delay và timeout để tránh bị block
-            time.sleep(2)
-            response = self.session.get(url, timeout=30, allow_redirects=True)
+            with self.tracer.span('sleep'):
+                time.sleep(self.request_delay)
+            request_started_at = time.monotonic()
+            if self.stream_parse and lxml_etree.available():
+                return self._parse_pixabay_page_streaming(url, request_started_at)
+            response = self._http_get(url, timeout=30, allow_redirects=True)
             
             print(f"📊 Status code: {response.status_code}")
             print(f"📊 Content length: {len(response.content):,} bytes")
             
             if response.status_code == 403:
                 print("⚠️  403 Forbidden - Thử phương pháp khác...")
+                self.metrics.inc('pixabay_retries_total', stage='crawl')
                 return self._try_alternative_methods(url)
             
             response.raise_for_status()
             
-            music_items = self._parse_response_content(response.content, url)
+            parse_started_at = time.monotonic()
+            page_memory = getattr(self._tls, 'page_memory', None)
+            if page_memory is not None:
+                page_memory['html_bytes'] = len(response.content)
+            with self.tracer.span('parse', bytes=len(response.content)):
+                music_items = self._parse_response_content(response.content, url)
+            self.metrics.observe('pixabay_page_parse_seconds', time.monotonic() - parse_started_at)
+            if music_items:
+                self.metrics.observe('pixabay_page_first_track_seconds', time.monotonic() - request_started_at)
             self.music_list = music_items
             return music_items
             
         except Exception as e:
             print(f"❌ Lỗi khi tải trang: {e}")
             print("💡 Thử phương pháp thay thế...")
+            self.metrics.inc('pixabay_retries_total', stage='crawl')
+            return self._try_alternative_methods(url)
+
+    def _parse_pixabay_page_streaming(self, url: str, request_started_at: float) -> List[Track]:
+        """
+        Như parse_pixabay_page nhưng parse body theo từng chunk trong lúc đang tải (xem _parse_stream)
+        """
+        with self._http_stream(url, timeout=30) as response:
+            print(f"📊 Status code: {response.status_code}")
+            forbidden = response.status_code == 403
+            if not forbidden:
+                response.raise_for_status()
+                charset = re.search(r'charset=([\w-]+)', response.headers.get('Content-Type', ''))
+                with self.tracer.span('parse', streaming=True):
+                    music_items = self._parse_stream(response.iter_content(self.STREAM_CHUNK_SIZE), url,
+                                                     charset.group(1) if charset else None, request_started_at)
+        # Ra khỏi _http_stream trước (trả slot của host) rồi mới thử cách khác
+        if forbidden:
+            print("⚠️  403 Forbidden - Thử phương pháp khác...")
+            self.metrics.inc('pixabay_retries_total', stage='crawl')
             return self._try_alternative_methods(url)
+        self.music_list = music_items
+        return music_items
     
     def _parse_single_page(self, page_url: str, page_num: int) -> Dict:
         """
@@ -78,15 +3517,27 @@ class PixabayMusicDownloader:
             'success': False,
             'items': [],
             'error': None,
-            'url': page_url
+            'url': page_url,
+            # True = items là kết quả dự phòng (trang khác / demo), không phải của page_url
+            'fallback': False
         }
         
         try:
             with self.print_lock:
                 print(f"📄 [{threading.current_thread().name}] Đang crawl trang {page_num}: {page_url}")
+            self._tls.fallback = False
             
-            # Parse trang hiện tại
-            page_items = self.parse_pixabay_page(page_url)
+            # Parse trang hiện tại (chờ nếu bắt đầu thêm trang sẽ vượt memory budget)
+            page_memory = {'page': page_num, 'html_bytes': 0, 'tree_bytes': 0}
+            self._tls.page_memory = page_memory
+            memory_slot = self.memory.page_slot() if self.memory is not None else contextlib.nullcontext()
+            with memory_slot, self.tracer.span('page', page=page_num, url=page_url), self._stage('crawl') as sample:
+                page_items = self.parse_pixabay_page(page_url)
+                sample['ok'] = bool(page_items)
+            self._tls.page_memory = None
+            if self.memory is not None:
+                self.memory.record_page({**page_memory, 'items': len(page_items or []),
+                                         'items_bytes': MemoryMonitor.items_size(page_items or [])})
             
             if page_items:
                 # Thêm page number vào từng item
@@ -95,9 +3546,14 @@ class PixabayMusicDownloader:
                 
                 result['items'] = page_items
                 result['success'] = True
+                result['fallback'] = getattr(self._tls, 'fallback', False)
                 
                 with self.print_lock:
-                    print(f"✅ [{threading.current_thread().name}] Trang {page_num}: Thêm {len(page_items)} tracks")
+                    if result['fallback']:
+                        print(f"⚠️  [{threading.current_thread().name}] Trang {page_num}: {len(page_items)} tracks "
+                              f"dự phòng (không phải của trang này) - không lưu journal/catalog")
+                    else:
+                        print(f"✅ [{threading.current_thread().name}] Trang {page_num}: Thêm {len(page_items)} tracks")
             else:
                 result['error'] = "Không tìm thấy tracks"
                 with self.print_lock:
@@ -108,45 +3564,76 @@ class PixabayMusicDownloader:
             with self.print_lock:
                 print(f"❌ [{threading.current_thread().name}] Lỗi khi crawl trang {page_num}: {e}")
         
+        self.metrics.inc('pixabay_pages_fetched_total', result='ok' if result['success'] else 'failed')
+        self.metrics.observe('pixabay_items_per_page', len(result['items']))
         return result
 
-    def parse_multiple_pages(self, base_url: str, start_page: int = 1, end_page: int = 3, max_workers: int = 3) -> List[Dict]:
+    def _build_page_url(self, base_url: str, page_num: int) -> str:
+        """
+        Tạo URL cho từng trang với parameter pagi
+        """
+        if page_num == 1 and 'pagi=' not in base_url:
+            return base_url
+        
+        # Thêm parameter pagi cho trang tiếp theo
+        separator = '&' if '?' in base_url else '?'
+        if 'pagi=' in base_url:
+            # Replace existing pagi parameter
+            return re.sub(r'pagi=\d+', f'pagi={page_num}', base_url)
+        return f"{base_url}{separator}pagi={page_num}"
+
+    def parse_multiple_pages(self, base_url: str, start_page: int = 1, end_page: int = 3, max_workers: int = 3,
+                             journal: Optional[CheckpointJournal] = None) -> List[Track]:
         """
         Parse nhiều trang Pixabay với pagination từ start_page đến end_page sử dụng multi-threading
         max_workers: Số thread tối đa cho parsing (mặc định 3 để không làm quá tải server)
+        journal: nếu có, trang đã crawl xong được ghi lại và lần chạy sau lấy từ journal thay vì fetch lại
         """
         all_music_items = []
         total_pages = end_page - start_page + 1
         
+        # Chế độ auto: pool có đủ thread tối đa, AIMD quyết định bao nhiêu thread thực sự chạy
+        if 'crawl' in self.aimd_controllers:
+            max_workers = self.aimd_controllers['crawl'].maximum
+        
         print(f"📚 Bắt đầu crawl từ trang {start_page} đến trang {end_page} ({total_pages} trang)...")
-        print(f"🧵 Sử dụng {max_workers} threads song song cho parsing")
+        if 'crawl' in self.aimd_controllers:
+            print(f"🎛️  Auto concurrency (AIMD): tối đa {max_workers} threads, bắt đầu với {self.aimd_controllers['crawl'].limit}")
+        else:
+            print(f"🧵 Sử dụng {max_workers} threads song song cho parsing")
         print("=" * 70)
         
         # Chuẩn bị danh sách parse jobs
         parse_jobs = []
+        page_results = {}
         for page_num in range(start_page, end_page + 1):
-            # Tạo URL cho từng trang
-            if page_num == 1 and 'pagi=' not in base_url:
-                page_url = base_url
-            else:
-                # Thêm parameter pagi cho trang tiếp theo
-                separator = '&' if '?' in base_url else '?'
-                if 'pagi=' in base_url:
-                    # Replace existing pagi parameter
-                    page_url = re.sub(r'pagi=\d+', f'pagi={page_num}', base_url)
-                else:
-                    page_url = f"{base_url}{separator}pagi={page_num}"
+            page_url = self._build_page_url(base_url, page_num)
+            
+            # Trang đã crawl xong trong lần chạy trước - lấy items từ journal
+            if journal is not None and page_url in journal.pages:
+                page_results[page_num] = {
+                    'page_num': page_num,
+                    'success': True,
+                    'items': [Track.from_dict(item) for item in journal.pages[page_url]['items']],
+                    'error': None,
+                    'url': page_url,
+                    'fallback': False
+                }
+                continue
             
             parse_jobs.append((page_url, page_num))
         
+        if page_results:
+            print(f"📓 Resume: {len(page_results)} trang lấy từ journal, không fetch lại")
         print(f"📋 Đã chuẩn bị {len(parse_jobs)} jobs parsing...")
         
         # Khởi tạo counters
-        successful_pages = 0
+        successful_pages = len(page_results)
         failed_pages = 0
         completed_pages = 0
         
         # Sử dụng ThreadPoolExecutor để parse song song
+        from concurrent.futures import ThreadPoolExecutor, as_completed
         with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="Parser") as executor:
             # Submit tất cả jobs
             future_to_job = {
@@ -159,8 +3646,6 @@ class PixabayMusicDownloader:
             print("-" * 70)
             
             # Thu thập kết quả theo thứ tự hoàn thành
-            page_results = {}
-            
             for future in as_completed(future_to_job):
                 page_url, page_num = future_to_job[future]
                 completed_pages += 1
@@ -168,6 +3653,8 @@ class PixabayMusicDownloader:
                 try:
                     result = future.result()
                     page_results[page_num] = result
+                    if journal is not None and result['success'] and not result['fallback']:
+                        journal.page_done(page_url, page_num, result['items'])
                     
                     with self.progress_lock:
                         if result['success']:
@@ -189,6 +3676,8 @@ class PixabayMusicDownloader:
         print(f"\n🔗 Đang ghép kết quả từ {len(page_results)} trang...")
         
         current_index = 1
+        # Chỉ tracks thật của các trang mới vào catalog - bỏ kết quả dự phòng
+        catalog_items = []
         for page_num in sorted(page_results.keys()):
             result = page_results[page_num]
             if result['success'] and result['items']:
@@ -198,6 +3687,8 @@ class PixabayMusicDownloader:
                     current_index += 1
                 
                 all_music_items.extend(result['items'])
+                if not result.get('fallback'):
+                    catalog_items.extend(result['items'])
                 print(f"📄 Trang {page_num}: Đã thêm {len(result['items'])} tracks")
         
         print(f"\n📊 TỔNG KẾT CRAWLING:")
@@ -209,12 +3700,74 @@ class PixabayMusicDownloader:
         print("=" * 70)
         
         self.music_list = all_music_items
+        self.save_to_catalog(base_url, catalog_items)
         return all_music_items
     
-    def _try_alternative_methods(self, url: str) -> List[Dict]:
+    def _newest_first_url(self, base_url: str) -> str:
+        """
+        Ép trang tìm kiếm sắp xếp mới nhất trước (order=latest)
+        """
+        if 'order=' in base_url:
+            return re.sub(r'order=[^&]*', 'order=latest', base_url)
+        separator = '&' if '?' in base_url else '?'
+        return f"{base_url}{separator}order=latest"
+
+    def crawl_new_tracks(self, base_url: str, seen: SeenTracks, stop_after: int = 20, max_pages: int = 20) -> List[Track]:
+        """
+        Chế độ sync: crawl tuần tự từ trang mới nhất, chỉ giữ track chưa có trong seen
+        và dừng khi gặp stop_after track đã biết liên tiếp (đã bắt kịp lần sync trước)
         """
-        Thử các phương pháp thay thế khi gặp lỗi 403 hoặc blocked
+        url = self._newest_first_url(base_url)
+        new_items = []
+        consecutive_known = 0
+        pages_crawled = 0
+        
+        print(f"🔁 Sync: {len(seen)} tracks đã biết, dừng sau {stop_after} tracks cũ liên tiếp (tối đa {max_pages} trang)")
+        print("=" * 70)
+        for page_num in range(1, max_pages + 1):
+            result = self._parse_single_page(self._build_page_url(url, page_num), page_num)
+            pages_crawled += 1
+            if not result['success']:
+                print(f"⏹️  Trang {page_num} không có tracks - dừng")
+                break
+            if result['fallback']:
+                # Tracks dự phòng không phải track mới của nguồn này - không ghi vào seen/catalog
+                print(f"⏹️  Trang {page_num} lỗi, chỉ có kết quả dự phòng - dừng sync")
+                break
+            
+            for item in result['items']:
+                if item in seen:
+                    consecutive_known += 1
+                    if consecutive_known >= stop_after:
+                        break
+                else:
+                    consecutive_known = 0
+                    new_items.append(item)
+            if consecutive_known >= stop_after:
+                print(f"⏹️  Gặp {consecutive_known} tracks đã biết liên tiếp ở trang {page_num} - dừng")
+                break
+        
+        for index, item in enumerate(new_items, 1):
+            item['index'] = index
+        
+        print(f"\n📊 TỔNG KẾT SYNC:")
+        print(f"📄 Đã crawl: {pages_crawled} trang")
+        print(f"🆕 Tracks mới: {len(new_items)}")
+        print("=" * 70)
+        
+        self.music_list = new_items
+        self.save_to_catalog(base_url)
+        return new_items
+
+    def _try_alternative_methods(self, url: str) -> List[Track]:
+        """
+        Thử các phương pháp thay thế khi gặp lỗi 403 hoặc blocked.
+        Kết quả từ trang dự phòng (URL khác / danh sách demo) đặt self._tls.fallback = True - xem _parse_single_page
         """
+        if not self.allow_fallback:
+            print("⛔ Fallback đã tắt - trang này tính là lỗi")
+            return []
+        
         print("🔄 Đang thử các phương pháp thay thế...")
         
         # Method 1: Thử với session mới và headers khác
@@ -229,8 +3782,8 @@ class PixabayMusicDownloader:
                 'Origin': 'https://pixabay.com'
             })
             
-            time.sleep(3)
-            response = new_session.get(url, timeout=30)
+            time.sleep(self.request_delay + 1)
+            response = self._http_get(url, session=new_session, timeout=30)
             if response.status_code == 200:
                 print("✅ Thành công với phương pháp 1!")
                 return self._parse_response_content(response.content, url)
@@ -242,9 +3795,11 @@ class PixabayMusicDownloader:
         try:
             print("📋 Phương pháp 2: URL đơn giản...")
             simple_url = "https://pixabay.com/music/search/piano/"
-            response = self.session.get(simple_url, timeout=30)
+            response = self._http_get(simple_url, timeout=30)
             if response.status_code == 200:
                 print("✅ Thành công với URL đơn giản!")
+                # Tracks của trang khác, không phải của url - caller không được coi là kết quả thật
+                self._tls.fallback = True
                 return self._parse_response_content(response.content, simple_url)
                 
         except Exception as e:
@@ -262,13 +3817,15 @@ Hãy thử:
 
 Hoặc nhập URL khác để thử:""".format(url=url))
         
+        self._tls.fallback = True
         return self._create_demo_list()
     
-    def _parse_response_content(self, content: bytes, url: str) -> List[Dict]:
+    def _parse_response_content(self, content: bytes, url: str) -> List[Track]:
         """
         Parse nội dung response thành danh sách nhạc
         """
-        soup = BeautifulSoup(content, 'html.parser')
+        memory_before = MemoryMonitor.current() if self.memory is not None else 0
+        soup = bs4.BeautifulSoup(content, 'html.parser')
         music_items = []
         
         # Debug: Tìm hiểu cấu trúc HTML thực tế
@@ -322,113 +3879,9 @@ Hoặc nhập URL khác để thử:""".format(url=url))
         print(f"📋 Cuối cùng tìm thấy {len(items)} items để parse")
         
         for idx, item in enumerate(items):
-            try:
-                print(f"\n🔍 Đang parse item {idx + 1}...")
-                
-                # Debug: In ra thông tin cơ bản của item
-                item_classes = item.get('class', [])
-                item_id = item.get('id', '')
-                print(f"   Classes: {item_classes}")
-                print(f"   ID: {item_id}")
-                
-                # Tìm title theo cấu trúc Pixabay cụ thể
-                title = "Unknown Track"
-                
-                # Pixabay có class title--xxxxx trong structure
-                title_selectors = [
-                    'a[class*="title"]',  # a.title--7N7Nr
-                    '[class*="title"]',   # Các element khác có title
-                    'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
-                    '[title]', '[alt]', 
-                    '.nameAndTitle a:first-child',  # Link đầu tiên trong nameAndTitle
-                    'a[href*="/music/"]',  # Links đến trang music
-                    'span', 'div', 'p'
-                ]
-                
-                for selector in title_selectors:
-                    title_elem = item.select_one(selector)
-                    if title_elem:
-                        candidate_title = title_elem.get_text(strip=True) or title_elem.get('title', '') or title_elem.get('alt', '')
-                        if candidate_title and len(candidate_title) > 2 and candidate_title != 'Unknown Track':
-                            title = candidate_title
-                            print(f"   ✅ Tìm thấy title với selector '{selector}': {title}")
-                            break
-                
-                # Tìm download link - Pixabay sử dụng JavaScript cho download
-                download_link = None
-                
-                # 1. Tìm URL trang chi tiết (để có thể fetch sau)
-                detail_link = None
-                detail_links = item.find_all('a', href=True)
-                for link in detail_links:
-                    href = link.get('href', '')
-                    if '/music/' in href and any(word in href for word in ['/', '-']):
-                        detail_link = urljoin(url, href)
-                        print(f"   ✅ Tìm thấy detail page: {detail_link}")
-                        break
-                
-                # 2. Tìm audio elements (ít khả năng có)
-                audio_elem = item.find('audio')
-                if audio_elem and audio_elem.get('src'):
-                    download_link = urljoin(url, audio_elem['src'])
-                    print(f"   ✅ Tìm thấy audio src: {download_link}")
-                
-                # 3. Tìm data attributes có thể chứa track ID
-                track_id = None
-                if not download_link:
-                    for attr, value in item.attrs.items():
-                        if 'data' in attr.lower() and ('id' in attr.lower() or 'track' in attr.lower()):
-                            track_id = str(value)
-                            print(f"   ✅ Tìm thấy track ID: {track_id}")
-                            break
-                
-                # 4. Extract ID từ detail link nếu có
-                if not track_id and detail_link:
-                    # Pixabay URLs thường có format: /music/title-123456/
-                    id_match = re.search(r'-(\d+)/?$', detail_link)
-                    if id_match:
-                        track_id = id_match.group(1)
-                        print(f"   ✅ Extract track ID từ URL: {track_id}")
-                
-                # 5. Ưu tiên dùng detail page để fetch URL thực
-                if detail_link:
-                    download_link = detail_link
-                    print(f"   🔗 Sẽ fetch URL thực từ detail page: {detail_link}")
-                elif track_id:
-                    # Backup: thử các format khả dĩ
-                    possible_formats = [
-                        f"https://cdn.pixabay.com/audio/2023/{track_id}.mp3",
-                        f"https://cdn.pixabay.com/audio/2024/{track_id}.mp3", 
-                        f"https://pixabay.com/get/{track_id}.mp3",
-                        f"https://pixabay.com/music/download/{track_id}.mp3"
-                    ]
-                    download_link = possible_formats[0]
-                    print(f"   🔗 Tạo download link giả định: {download_link}")
-                
-                # 6. Tìm trong child elements nếu vẫn chưa có
-                if not download_link:
-                    for child in item.find_all(recursive=True):
-                        for attr, value in child.attrs.items():
-                            if any(ext in str(value).lower() for ext in ['.mp3', '.wav', '.m4a']) and 'http' in str(value):
-                                download_link = urljoin(url, str(value))
-                                print(f"   ✅ Tìm thấy trong child: {download_link}")
-                                break
-                        if download_link:
-                            break
-                
-                if download_link:
-                    music_items.append({
-                        'title': title,
-                        'download_url': download_link,
-                        'index': len(music_items) + 1
-                    })
-                    print(f"   ✅ Đã thêm vào danh sách: {title}")
-                else:
-                    print(f"   ❌ Không tìm thấy download link cho item này")
-                    
-            except Exception as e:
-                print(f"⚠️  Lỗi khi parse item {idx}: {e}")
-                continue
+            track = self._parse_item(item, url, idx, len(music_items) + 1)
+            if track is not None:
+                music_items.append(track)
         
         # Nếu không tìm thấy gì, thử tìm trong JavaScript/JSON data
         if not music_items:
@@ -457,11 +3910,11 @@ Hoặc nhập URL khác để thử:""".format(url=url))
                             for url_match in urls:
                                 if url_match and len(url_match) > 10:  # Filter out short false matches
                                     full_url = urljoin(url, url_match)
-                                    music_items.append({
-                                        'title': f"JS Track {len(music_items) + 1}",
-                                        'download_url': full_url,
-                                        'index': len(music_items) + 1
-                                    })
+                                    music_items.append(Track(
+                                        title=f"JS Track {len(music_items) + 1}",
+                                        download_url=full_url,
+                                        index=len(music_items) + 1
+                                    ))
                                     print(f"   ✅ Tìm thấy URL trong JS: {url_match}")
                         
                         # Tìm thông tin JSON
@@ -480,39 +3933,298 @@ Hoặc nhập URL khác để thử:""".format(url=url))
                                         title_match = re.search(r'"title":\s*"([^"]*)"', match)
                                         url_match = re.search(r'"url":\s*"([^"]*)"', match)
                                         if title_match and url_match:
-                                            music_items.append({
-                                                'title': title_match.group(1),
-                                                'download_url': urljoin(url, url_match.group(1)),
-                                                'index': len(music_items) + 1
-                                            })
+                                            music_items.append(Track(
+                                                title=title_match.group(1),
+                                                download_url=urljoin(url, url_match.group(1)),
+                                                index=len(music_items) + 1
+                                            ))
                                             print(f"   ✅ Tìm thấy JSON track: {title_match.group(1)}")
                                 except Exception as e:
                                     print(f"   ⚠️  Lỗi parse JSON: {e}")
         
         print(f"\n📊 Tổng cộng tìm thấy {len(music_items)} tracks")
+        page_memory = getattr(self._tls, 'page_memory', None)
+        if self.memory is not None and page_memory is not None:
+            page_memory['tree_bytes'] = MemoryMonitor.current() - memory_before
+        # Cây soup có tham chiếu vòng - phá cây ngay để giải phóng không phải chờ GC
+        soup.decompose()
         return music_items
     
-    def _create_demo_list(self) -> List[Dict]:
+    def _parse_stream(self, chunks, url: str, encoding: Optional[str] = None,
+                      started_at: Optional[float] = None) -> List[Track]:
+        """
+        Parse trang tìm kiếm trong lúc body còn đang tải: feed từng chunk vào HTMLPullParser của lxml,
+        mỗi row audioRow đóng thẻ là parse thành track ngay rồi xóa khỏi cây - không giữ cả trang trong bộ nhớ.
+        Trang không có row audioRow (layout khác) thì parse lại cả body bằng _parse_response_content.
+        """
+        started_at = time.monotonic() if started_at is None else started_at
+        memory_before = MemoryMonitor.current() if self.memory is not None else 0
+        parser = lxml_etree.HTMLPullParser(events=('start', 'end'), encoding=encoding or 'utf-8')
+        music_items = []
+        # Raw body chỉ giữ tới khi thấy row audioRow đầu tiên (để fallback nếu trang không có audioRow)
+        body = []
+        html_bytes = 0
+        parse_seconds = 0.0
+        # Rows theo thứ tự thẻ mở (giống soup.select) - [element, đã đóng thẻ chưa]
+        pending = []
+        open_rows = 0
+        row_count = 0
+
+        def is_row(element) -> bool:
+            return element.tag == 'div' and self.STREAM_ROW_CLASS in (element.get('class') or '')
+
+        def emit(element):
+            nonlocal row_count
+            track = self._parse_row_element(element, url, row_count, len(music_items) + 1)
+            row_count += 1
+            if track is not None:
+                if not music_items:
+                    self.metrics.observe('pixabay_page_first_track_seconds', time.monotonic() - started_at)
+                music_items.append(track)
+
+        def drain():
+            nonlocal open_rows, body
+            for event, element in parser.read_events():
+                if event == 'start':
+                    if is_row(element):
+                        pending.append([element, False])
+                        open_rows += 1
+                        # Đã thấy layout audioRow - không cần giữ raw body để parse lại nữa
+                        body = None
+                    continue
+                if is_row(element):
+                    for entry in reversed(pending):
+                        if entry[0] is element:
+                            entry[1] = True
+                            break
+                    open_rows -= 1
+                    # Row lồng nhau: chỉ emit khi mọi row mở trước nó đã đóng
+                    while pending and pending[0][1]:
+                        emit(pending.pop(0)[0])
+                if open_rows == 0:
+                    # Phần đã đóng ngoài row (và row vừa emit) không cần nữa - xóa để cây chỉ chứa phần đang mở
+                    element.clear()
+                    parent = element.getparent()
+                    while parent is not None and element.getprevious() is not None:
+                        del parent[0]
+
+        for chunk in chunks:
+            if not chunk:
+                continue
+            html_bytes += len(chunk)
+            if body is not None:
+                body.append(chunk)
+            parse_started_at = time.monotonic()
+            parser.feed(chunk)
+            drain()
+            parse_seconds += time.monotonic() - parse_started_at
+        parse_started_at = time.monotonic()
+        parser.close()
+        drain()
+        parse_seconds += time.monotonic() - parse_started_at
+
+        print(f"📊 Content length: {html_bytes:,} bytes (parse streaming)")
+        page_memory = getattr(self._tls, 'page_memory', None)
+        if page_memory is not None:
+            page_memory['html_bytes'] = html_bytes
+            if self.memory is not None:
+                page_memory['tree_bytes'] = MemoryMonitor.current() - memory_before
+        if not music_items:
+            if body is None:
+                print("❌ Có row audioRow nhưng không row nào có track")
+            else:
+                print("🔄 Không có row audioRow khi parse streaming - parse lại cả trang...")
+                parse_started_at = time.monotonic()
+                music_items = self._parse_response_content(b''.join(body), url)
+                parse_seconds += time.monotonic() - parse_started_at
+                if music_items:
+                    self.metrics.observe('pixabay_page_first_track_seconds', time.monotonic() - started_at)
+        else:
+            print(f"\n📊 Tổng cộng tìm thấy {len(music_items)} tracks (streaming)")
+        self.metrics.observe('pixabay_page_parse_seconds', parse_seconds)
+        return music_items
+
+    # Text của row như bs4 stripped_strings: bỏ comment và nội dung script/style/template
+    _ROW_TEXT_XPATH = None
+
+    def _parse_row_element(self, element, url: str, idx: int, index: int) -> Optional[Track]:
+        """
+        Lấy track thẳng từ element lxml của row audioRow (parse streaming) - không serialize rồi parse lại.
+        Row có title trong a[class*="title"] và link /music/ (layout hiện tại) đọc trực tiếp;
+        row khác layout mới serialize sang BeautifulSoup và đi qua _parse_item.
+        """
+        title_elem = next((link for link in element.iter('a') if 'title' in (link.get('class') or '')), None)
+        title = None
+        if title_elem is not None:
+            title = (''.join(text.strip() for text in title_elem.itertext())
+                     or title_elem.get('title', '') or title_elem.get('alt', ''))
+        detail_link = next((link.get('href') for link in element.iter('a')
+                            if '/music/' in (link.get('href') or '')), None)
+        if not title or len(title) <= 2 or title == 'Unknown Track' or detail_link is None:
+            fragment = lxml_etree.tostring(element, method='html', encoding='unicode', with_tail=False)
+            soup = bs4.BeautifulSoup(fragment, 'html.parser')
+            track = self._parse_item(soup.find('div'), url, idx, index)
+            soup.decompose()
+            return track
+
+        print(f"\n🔍 Đang parse item {idx + 1}...")
+        print(f"   ✅ Tìm thấy title với selector 'a[class*=\"title\"]': {title}")
+        detail_link = urljoin(url, detail_link)
+        print(f"   🔗 Sẽ fetch URL thực từ detail page: {detail_link}")
+
+        # Thời lượng: cùng thứ tự với _parse_item - data-duration, [class*="duration"]/time, chuỗi m:ss đầu tiên
+        duration = parse_duration(element.get('data-duration'))
+        if duration is None:
+            duration_elem = next((child for child in element.iterdescendants()
+                                  if isinstance(child.tag, str)
+                                  and ('duration' in (child.get('class') or '') or child.tag == 'time'
+                                       or child.get('data-duration') is not None)), None)
+            if duration_elem is not None:
+                duration = parse_duration(duration_elem.get('data-duration') or duration_elem.get('datetime')
+                                          or ''.join(text.strip() for text in duration_elem.itertext()))
+        if duration is None:
+            if self._ROW_TEXT_XPATH is None:
+                PixabayMusicDownloader._ROW_TEXT_XPATH = lxml_etree.XPath(
+                    './/text()[not(ancestor::script or ancestor::style or ancestor::template)]',
+                    smart_strings=False)
+            texts = (text.strip() for text in self._ROW_TEXT_XPATH(element))
+            duration = next((parse_duration(text) for text in texts
+                             if ':' in text and text != title and parse_duration(text) is not None), None)
+        if duration is not None:
+            print(f"   ⏱️  Thời lượng: {duration // 60}:{duration % 60:02d}")
+        print(f"   ✅ Đã thêm vào danh sách: {title}")
+        return Track(title=title, download_url=detail_link, index=index, duration=duration)
+
+    def _parse_item(self, item, url: str, idx: int, index: int) -> Optional[Track]:
+        """
+        Lấy một track từ một item (row kết quả tìm kiếm) - dùng chung cho parse cả trang và parse streaming
+        """
+        try:
+            print(f"\n🔍 Đang parse item {idx + 1}...")
+            
+            # Debug: In ra thông tin cơ bản của item
+            item_classes = item.get('class', [])
+            item_id = item.get('id', '')
+            print(f"   Classes: {item_classes}")
+            print(f"   ID: {item_id}")
+            
+            # Tìm title theo cấu trúc Pixabay cụ thể
+            title = "Unknown Track"
+            
+            # Pixabay có class title--xxxxx trong structure
+            title_selectors = [
+                'a[class*="title"]',  # a.title--7N7Nr
+                '[class*="title"]',   # Các element khác có title
+                'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+                '[title]', '[alt]', 
+                '.nameAndTitle a:first-child',  # Link đầu tiên trong nameAndTitle
+                'a[href*="/music/"]',  # Links đến trang music
+                'span', 'div', 'p'
+            ]
+            
+            for selector in title_selectors:
+                title_elem = item.select_one(selector)
+                if title_elem:
+                    candidate_title = title_elem.get_text(strip=True) or title_elem.get('title', '') or title_elem.get('alt', '')
+                    if candidate_title and len(candidate_title) > 2 and candidate_title != 'Unknown Track':
+                        title = candidate_title
+                        print(f"   ✅ Tìm thấy title với selector '{selector}': {title}")
+                        break
+            
+            # Tìm download link - Pixabay sử dụng JavaScript cho download
+            download_link = None
+            
+            # 1. Tìm URL trang chi tiết (để có thể fetch sau)
+            detail_link = None
+            detail_links = item.find_all('a', href=True)
+            for link in detail_links:
+                href = link.get('href', '')
+                if '/music/' in href and any(word in href for word in ['/', '-']):
+                    detail_link = urljoin(url, href)
+                    print(f"   ✅ Tìm thấy detail page: {detail_link}")
+                    break
+            
+            # 2. Tìm audio elements (ít khả năng có)
+            audio_elem = item.find('audio')
+            if audio_elem and audio_elem.get('src'):
+                download_link = urljoin(url, audio_elem['src'])
+                print(f"   ✅ Tìm thấy audio src: {download_link}")
+            
+            # 3. Tìm data attributes có thể chứa track ID
+            track_id = None
+            if not download_link:
+                for attr, value in item.attrs.items():
+                    if 'data' in attr.lower() and ('id' in attr.lower() or 'track' in attr.lower()):
+                        track_id = str(value)
+                        print(f"   ✅ Tìm thấy track ID: {track_id}")
+                        break
+            
+            # 4. Extract ID từ detail link nếu có
+            if not track_id and detail_link:
+                # Pixabay URLs thường có format: /music/title-123456/
+                id_match = re.search(r'-(\d+)/?$', detail_link)
+                if id_match:
+                    track_id = id_match.group(1)
+                    print(f"   ✅ Extract track ID từ URL: {track_id}")
+            
+            # 5. Ưu tiên dùng detail page để fetch URL thực
+            if detail_link:
+                download_link = detail_link
+                print(f"   🔗 Sẽ fetch URL thực từ detail page: {detail_link}")
+            elif track_id:
+                # Backup: thử các format khả dĩ
+                possible_formats = [
+                    f"https://cdn.pixabay.com/audio/2023/{track_id}.mp3",
+                    f"https://cdn.pixabay.com/audio/2024/{track_id}.mp3", 
+                    f"https://pixabay.com/get/{track_id}.mp3",
+                    f"https://pixabay.com/music/download/{track_id}.mp3"
+                ]
+                download_link = possible_formats[0]
+                print(f"   🔗 Tạo download link giả định: {download_link}")
+            
+            # 6. Thời lượng: div.duration--xxxxx "4:03", thẻ time hoặc data-duration (giây)
+            duration = parse_duration(item.get('data-duration'))
+            if duration is None:
+                duration_elem = item.select_one('[class*="duration"], time, [data-duration]')
+                if duration_elem is not None:
+                    duration = parse_duration(duration_elem.get('data-duration') or duration_elem.get('datetime')
+                                              or duration_elem.get_text(strip=True))
+            if duration is None:
+                # Layout cũ chỉ có chữ "Musik · 2:08" / span "4:53" - lấy chuỗi m:ss đầu tiên ngoài title
+                duration = next((parse_duration(text) for text in item.stripped_strings
+                                 if ':' in text and text != title and parse_duration(text) is not None), None)
+            if duration is not None:
+                print(f"   ⏱️  Thời lượng: {duration // 60}:{duration % 60:02d}")
+            
+            # 7. Tìm trong child elements nếu vẫn chưa có
+            if not download_link:
+                for child in item.find_all(recursive=True):
+                    for attr, value in child.attrs.items():
+                        if any(ext in str(value).lower() for ext in ['.mp3', '.wav', '.m4a']) and 'http' in str(value):
+                            download_link = urljoin(url, str(value))
+                            print(f"   ✅ Tìm thấy trong child: {download_link}")
+                            break
+                    if download_link:
+                        break
+            
+            if download_link:
+                print(f"   ✅ Đã thêm vào danh sách: {title}")
+                return Track(title=title, download_url=download_link, index=index, duration=duration)
+            print(f"   ❌ Không tìm thấy download link cho item này")
+                
+        except Exception as e:
+            print(f"⚠️  Lỗi khi parse item {idx}: {e}")
+        return None
+
+    def _create_demo_list(self) -> List[Track]:
         """
         Tạo danh sách demo để test tool
         """
         print("🎵 Tạo danh sách demo để test...")
         return [
-            {
-                'title': 'Demo Piano Track 1',
-                'download_url': 'https://pixabay.com/music/download/demo1.mp3',
-                'index': 1
-            },
-            {
-                'title': 'Demo Piano Track 2', 
-                'download_url': 'https://pixabay.com/music/download/demo2.mp3',
-                'index': 2
-            },
-            {
-                'title': 'Demo Piano Track 3',
-                'download_url': 'https://pixabay.com/music/download/demo3.mp3', 
-                'index': 3
-            }
+            Track(title='Demo Piano Track 1', download_url='https://pixabay.com/music/download/demo1.mp3', index=1),
+            Track(title='Demo Piano Track 2', download_url='https://pixabay.com/music/download/demo2.mp3', index=2),
+            Track(title='Demo Piano Track 3', download_url='https://pixabay.com/music/download/demo3.mp3', index=3)
         ]
     
     def display_music_list(self):
@@ -540,6 +4252,61 @@ Hoặc nhập URL khác để thử:""".format(url=url))
             print(f"     URL: {item['download_url'][:60]}...")
             print()
     
+    def _extract_real_url_from_detail(self, content: bytes, page_url: str) -> Optional[str]:
+        """
+        Tìm URL MP3 thực trong HTML của detail page (JavaScript data, audio elements, nút download)
+        """
+        soup = bs4.BeautifulSoup(content, 'html.parser')
+        
+        # Tìm trong JavaScript data
+        scripts = soup.find_all('script')
+        for script in scripts:
+            if script.string:
+                script_content = script.string
+                
+                # Tìm URLs MP3 trong JavaScript với patterns mạnh hơn
+                patterns = [
+                    r'"download"[^"]*"([^"]*\.mp3[^"]*)"',
+                    r'"url"[^"]*"([^"]*\.mp3[^"]*)"',
+                    r'"src"[^"]*"([^"]*\.mp3[^"]*)"',
+                    r'cdn\.pixabay\.com/audio/[^"\']*\.mp3',
+                    r'https://[^"\']*\.mp3',
+                    r'["\']([^"\']*cdn\.pixabay\.com[^"\']*\.mp3)["\']'
+                ]
+                
+                for pattern in patterns:
+                    matches = re.findall(pattern, script_content, re.IGNORECASE)
+                    for match in matches:
+                        if match and len(match) > 20 and '.mp3' in match:
+                            if not match.startswith('http'):
+                                match = 'https:' + match if match.startswith('//') else 'https://' + match
+                            print(f"   ✅ Tìm thấy URL trong JS: {match}")
+                            return match
+        
+        # Tìm audio elements và download buttons
+        download_patterns = [
+            'audio[src]',
+            'source[src]',
+            'a[href*=".mp3"]',
+            '[data-url*=".mp3"]',
+            '[onclick*=".mp3"]'
+        ]
+        
+        for pattern in download_patterns:
+            elements = soup.select(pattern)
+            for elem in elements:
+                url_attrs = ['src', 'href', 'data-url', 'onclick']
+                for attr in url_attrs:
+                    href = elem.get(attr, '')
+                    if href and '.mp3' in href:
+                        if 'javascript:' not in href.lower():
+                            real_url = urljoin(page_url, href)
+                            print(f"   ✅ Tìm thấy URL từ {pattern}: {real_url}")
+                            return real_url
+        
+        return None
+
+    @traced('resolve_url', lambda fake_url, title: {'url': fake_url})
     def _try_get_real_download_url(self, fake_url: str, title: str) -> str:
         """
         Thử lấy URL download thực từ Pixabay
@@ -557,57 +4324,16 @@ Hoặc nhập URL khác để thử:""".format(url=url))
                     'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8'
                 }
                 
-                response = self.session.get(fake_url, timeout=15, headers=headers)
+                with self._stage('resolve') as sample:
+                    response = self._http_get(fake_url, timeout=15, headers=headers)
+                    sample['ok'] = response.status_code == 200
                 if response.status_code == 200:
-                    soup = BeautifulSoup(response.content, 'html.parser')
-                    
                     print(f"   📊 Detail page size: {len(response.content):,} bytes")
                     
-                    # Tìm trong JavaScript data
-                    scripts = soup.find_all('script')
-                    for script in scripts:
-                        if script.string:
-                            script_content = script.string
-                            
-                            # Tìm URLs MP3 trong JavaScript với patterns mạnh hơn
-                            patterns = [
-                                r'"download"[^"]*"([^"]*\.mp3[^"]*)"',
-                                r'"url"[^"]*"([^"]*\.mp3[^"]*)"',
-                                r'"src"[^"]*"([^"]*\.mp3[^"]*)"',
-                                r'cdn\.pixabay\.com/audio/[^"\']*\.mp3',
-                                r'https://[^"\']*\.mp3',
-                                r'["\']([^"\']*cdn\.pixabay\.com[^"\']*\.mp3)["\']'
-                            ]
-                            
-                            for pattern in patterns:
-                                matches = re.findall(pattern, script_content, re.IGNORECASE)
-                                for match in matches:
-                                    if match and len(match) > 20 and '.mp3' in match:
-                                        if not match.startswith('http'):
-                                            match = 'https:' + match if match.startswith('//') else 'https://' + match
-                                        print(f"   ✅ Tìm thấy URL trong JS: {match}")
-                                        return match
-                    
-                    # Tìm audio elements và download buttons
-                    download_patterns = [
-                        'audio[src]',
-                        'source[src]',
-                        'a[href*=".mp3"]',
-                        '[data-url*=".mp3"]',
-                        '[onclick*=".mp3"]'
-                    ]
-                    
-                    for pattern in download_patterns:
-                        elements = soup.select(pattern)
-                        for elem in elements:
-                            url_attrs = ['src', 'href', 'data-url', 'onclick']
-                            for attr in url_attrs:
-                                href = elem.get(attr, '')
-                                if href and '.mp3' in href:
-                                    if 'javascript:' not in href.lower():
-                                        real_url = urljoin(fake_url, href)
-                                        print(f"   ✅ Tìm thấy URL từ {pattern}: {real_url}")
-                                        return real_url
+                    with self.tracer.span('extract'):
+                        real_url = self._extract_real_url_from_detail(response.content, fake_url)
+                    if real_url:
+                        return real_url
                     
                     print(f"   ❌ Không tìm thấy URL download trong detail page")
             
@@ -615,7 +4341,7 @@ Hoặc nhập URL khác để thử:""".format(url=url))
             elif fake_url.endswith('.mp3'):
                 print(f"   🧪 Test URL giả định: {fake_url}")
                 try:
-                    head_response = self.session.head(fake_url, timeout=8)
+                    head_response = self._http_get(fake_url, method='HEAD', timeout=8, allow_redirects=False)
                     if head_response.status_code == 200:
                         content_type = head_response.headers.get('content-type', '')
                         if 'audio' in content_type.lower() or 'mpeg' in content_type.lower():
@@ -632,25 +4358,29 @@ Hoặc nhập URL khác để thử:""".format(url=url))
         print(f"   🔄 Fallback: sử dụng detail page")
         return fake_url
 
-    def _get_next_file_index(self, download_folder: str) -> int:
+    def _get_next_file_index(self, sink, manifest: Optional[LibraryManifest] = None) -> int:
         """
-        Kiểm tra thư mục và trả về số thứ tự tiếp theo để tránh ghi đè file cũ
+        Kiểm tra nơi lưu và trả về số thứ tự tiếp theo để tránh ghi đè file cũ.
+        Có manifest thì đọc manifest, không cần liệt kê thư mục.
         """
-        if not os.path.exists(download_folder):
-            return 1
+        if manifest is not None and manifest.entries:
+            max_index = manifest.max_index()
+            print(f"📒 Manifest có {len(manifest.entries)} tracks, số thứ tự cao nhất: {max_index}")
+            return max_index + 1
         
         max_index = 0
         try:
-            files = os.listdir(download_folder)
+            files = sink.list_names()
             for filename in files:
                 if filename.endswith('.mp3'):
-                    # Tìm pattern 001_, 002_, etc.
-                    match = re.match(r'^(\d{3})_', filename)
+                    # Tìm pattern 001_, 002_, ..., 1000_
+                    match = re.match(r'^(\d{3,})_', filename)
                     if match:
                         index = int(match.group(1))
                         max_index = max(max_index, index)
             
-            print(f"📂 Tìm thấy {len([f for f in files if f.endswith('.mp3')])} file MP3 trong thư mục")
+            if files:
+                print(f"📂 Tìm thấy {len([f for f in files if f.endswith('.mp3')])} file MP3 trong thư mục")
             if max_index > 0:
                 print(f"📊 Số thứ tự cao nhất hiện tại: {max_index}")
                 print(f"🆕 File mới sẽ bắt đầu từ: {max_index + 1}")
@@ -660,7 +4390,36 @@ Hoặc nhập URL khác để thử:""".format(url=url))
         
         return max_index + 1
 
-    def _download_single_file(self, item: Dict, download_folder: str, file_number: int) -> Dict:
+    def _open_manifest(self, sink, layout: DirectoryLayout) -> Optional[LibraryManifest]:
+        """
+        Manifest nằm ở gốc thư mục download - bắt buộc với layout page/hash,
+        với layout flat thì chỉ dùng khi đã có sẵn.
+        Sink không có thư mục local (S3) không có manifest: manifest append từng dòng, object S3 thì không append được
+        """
+        folder = getattr(sink, 'folder', None)
+        if folder is None:
+            if layout.strategy != 'flat':
+                raise ValueError(f"Layout {layout.strategy} cần manifest.jsonl local - "
+                                 f"{sink.describe()} chỉ dùng được layout flat")
+            return None
+        path = os.path.join(folder, MANIFEST_FILENAME)
+        if layout.strategy == 'flat' and not os.path.exists(path):
+            return None
+        os.makedirs(folder, exist_ok=True)
+        return LibraryManifest(path)
+
+    def _make_filename(self, item: Track, file_number: int) -> str:
+        """
+        Tên file an toàn dạng NNN_title.mp3
+        """
+        # Làm sạch tên file
+        safe_title = re.sub(r'[<>:"/\\|?*]', '_', item['title'])
+        return f"{file_number:03d}_{safe_title}.mp3"
+
+    @traced('track', lambda item, sink, file_number, *args, **kwargs: {'index': item.get('index'),
+                                                                        'file_number': file_number})
+    def _download_single_file(self, item: Track, sink, file_number: int, layout: Optional[DirectoryLayout] = None,
+                              manifest: Optional[LibraryManifest] = None) -> Dict:
         """
         Download một file nhạc đơn lẻ - dùng cho threading
         Returns: Dict với thông tin kết quả download
@@ -670,46 +4429,83 @@ Hoặc nhập URL khác để thử:""".format(url=url))
             'success': False,
             'error': None,
             'filename': None,
-            'file_size': 0
+            'file_size': 0,
+            'sha256': None,
+            'duplicate_of': None,
+            'elapsed': 0.0
         }
+        started_at = time.monotonic()
         
         try:
-            # Làm sạch tên file
-            safe_title = re.sub(r'[<>:"/\\|?*]', '_', item['title'])
-            filename = f"{file_number:03d}_{safe_title}.mp3"
-            filepath = os.path.join(download_folder, filename)
+            filename = self._make_filename(item, file_number)
+            if layout is not None:
+                filename = layout.relative_path(item, file_number, filename)
             result['filename'] = filename
             
             with self.print_lock:
                 print(f"⬇️  [{threading.current_thread().name}] Đang download {item['index']}: {item['title']}")
             
-            # Thử lấy URL thực trước khi download
-            real_url = self._try_get_real_download_url(item['download_url'], item['title'])
-            
-            # Tạo session riêng cho thread này để tránh xung đột
-            thread_session = requests.Session()
-            thread_session.headers.update(self.session.headers)
+            # Thử lấy URL thực trước khi download (scheduler có thể đã resolve sẵn)
+            real_url = item.get('resolved_url') or self._try_get_real_download_url(item['download_url'], item['title'])
             
             # Download file
             with self.print_lock:
                 print(f"   🌐 [{threading.current_thread().name}] Downloading từ: {real_url}")
             
-            response = thread_session.get(real_url, stream=True, timeout=30)
-            response.raise_for_status()
+            # Giữ slot của stage và host trong suốt quá trình stream body
+            with self._stage('download') as sample, self.host_limiter.slot(real_url), \
+                    self._open_download_stream(real_url) as response:
+                self._record_status(response.status_code)
+                response.raise_for_status()
+            
+                # Kiểm tra content type - HTML/JSON là trang lỗi, dừng ngay không tải body
+                content_type = response.headers.get('content-type', '')
+                if any(error_type in content_type.lower() for error_type in ERROR_CONTENT_TYPES):
+                    response.close()
+                    raise DownloadIntegrityError(f"Server trả về {content_type} thay vì audio")
+                if 'audio' not in content_type.lower() and 'mpeg' not in content_type.lower():
+                    with self.print_lock:
+                        print(f"⚠️  [{threading.current_thread().name}] Cảnh báo: File có thể không phải MP3 (Content-Type: {content_type})")
+            
+                # Lưu file - verify ngay trong vòng lặp stream, sink chỉ commit khi file hợp lệ
+                verifier = StreamVerifier(StreamVerifier.expected_length_from(response.headers))
+                writer = sink.open_writer(filename)
+                try:
+                    for chunk in response.iter_content(chunk_size=8192):
+                        if chunk:
+                            verifier.feed(chunk)
+                            self.bandwidth_limiter.consume(len(chunk))
+                            writer.write(chunk)
+                    digest = verifier.finalize()
+                    sample['bytes'] = verifier.bytes_received
+                    writer.commit()
+                except Exception:
+                    response.close()
+                    writer.abort()
+                    raise
+            result['sha256'] = digest
+            
+            if verifier.kind == 'unknown':
+                with self.print_lock:
+                    print(f"⚠️  [{threading.current_thread().name}] Không nhận diện được header MP3 (ID3/frame sync): {filename}")
             
-            # Kiểm tra content type
-            content_type = response.headers.get('content-type', '')
-            if 'audio' not in content_type.lower() and 'mpeg' not in content_type.lower():
+            # Dedupe theo hash - cùng nội dung đã tải trong phiên này thì bỏ file mới
+            with self.progress_lock:
+                duplicate_of = self.known_hashes.get(digest)
+                if not duplicate_of:
+                    self.known_hashes[digest] = filename
+            if duplicate_of:
+                sink.delete(filename)
+                result['duplicate_of'] = duplicate_of
+                result['success'] = True
                 with self.print_lock:
-                    print(f"⚠️  [{threading.current_thread().name}] Cảnh báo: File có thể không phải MP3 (Content-Type: {content_type})")
+                    print(f"♻️  [{threading.current_thread().name}] Trùng nội dung với {duplicate_of}, bỏ qua {filename}")
+                return result
             
-            # Lưu file
-            with open(filepath, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
+            if manifest is not None:
+                manifest.record(file_number, filename, item, digest, verifier.bytes_received)
             
-            file_size = os.path.getsize(filepath)
+            file_size = verifier.bytes_received
             result['file_size'] = file_size
             
             if file_size > 1024 * 1024:  # > 1MB
@@ -721,66 +4517,268 @@ Hoặc nhập URL khác để thử:""".format(url=url))
                 print(f"✅ [{threading.current_thread().name}] Hoàn thành: {filename} ({size_str})")
             
             result['success'] = True
+            if self.index is not None:
+                self.index.mark_downloaded(item)
+            if self.catalog is not None:
+                import sqlite3
+                # Lưu URL thực vào catalog (lần sau download lại không phải fetch trang detail) và đánh dấu đã tải
+                try:
+                    self.catalog.set_downloaded(item, real_url, file_size)
+                except sqlite3.Error as e:
+                    with self.print_lock:
+                        print(f"⚠️  Không ghi được catalog cho {item['title']}: {e}")
             
         except Exception as e:
-            result['error'] = str(e)
+            result['error'] = str(e)
+            with self.print_lock:
+                print(f"❌ [{threading.current_thread().name}] Lỗi download {item['title']}: {e}")
+        
+        result['elapsed'] = time.monotonic() - started_at
+        self._observe_download(result)
+        return result
+
+    def _observe_download(self, result: Dict):
+        """
+        Ghi metrics cho một file download xong (thành công, trùng hoặc lỗi)
+        """
+        if not result['success']:
+            self.metrics.inc('pixabay_downloads_total', result='failed')
+            return
+        self.metrics.inc('pixabay_downloads_total', result='duplicate' if result['duplicate_of'] else 'ok')
+        self.metrics.inc('pixabay_download_bytes_total', result['file_size'])
+        if result['elapsed'] > 0:
+            self.metrics.observe('pixabay_download_throughput_bytes_per_second', result['file_size'] / result['elapsed'])
+
+    def _probe_download_size(self, item: Track) -> Optional[int]:
+        """
+        Resolve URL thực (bỏ qua nếu item đã có resolved_url, vd. từ catalog) và HEAD để lấy Content-Length.
+        Chỉ lưu item['resolved_url'] khi URL trả về audio - không lưu URL trang detail (fallback của resolve)
+        """
+        real_url = item.get('resolved_url') or self._try_get_real_download_url(item['download_url'], item['title'])
+        try:
+            head_response = self._http_get(real_url, method='HEAD', timeout=10, allow_redirects=True)
+            content_type = head_response.headers.get('content-type', '').lower()
+            if head_response.status_code == 200 and ('audio' in content_type or 'mpeg' in content_type):
+                item['resolved_url'] = real_url
+                size = StreamVerifier.expected_length_from(head_response.headers)
+                if size:
+                    item['size'] = size
+                    return size
+        except Exception as e:
             with self.print_lock:
-                print(f"❌ [{threading.current_thread().name}] Lỗi download {item['title']}: {e}")
+                print(f"   ⚠️  Không lấy được kích thước {item['title']}: {e}")
+        return None
+
+    def _schedule_download_jobs(self, download_jobs: List, max_workers: int) -> List:
+        """
+        Sắp xếp jobs theo kích thước giảm dần (LPT) để giảm thời gian chờ cuối batch.
+        file_number vẫn gắn với item nên tên file không đổi.
+        """
+        print(f"📏 Đang lấy kích thước {len(download_jobs)} files (resolve + HEAD)...")
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="Resolver") as executor:
+            list(executor.map(lambda job: self._probe_download_size(job[0]), download_jobs))
         
-        return result
+        sizes = self._estimated_job_sizes(download_jobs)
+        print(f"📏 Biết kích thước {sum(1 for item, _ in download_jobs if item.get('size'))}/{len(download_jobs)} files")
+        
+        order = sorted(range(len(download_jobs)), key=lambda i: sizes[i], reverse=True)
+        return [download_jobs[i] for i in order]
 
-    def download_music_range(self, start_idx: int, end_idx: int, download_folder: str = "downloads", max_workers: int = 4):
+    @staticmethod
+    def _estimated_job_sizes(download_jobs: List) -> List[int]:
         """
-        Download nhạc theo range từ start_idx đến end_idx sử dụng multi-threading
-        max_workers: Số thread tối đa (mặc định 4)
+        Kích thước của từng job (cùng thứ tự với download_jobs) - file không rõ kích thước
+        được coi như kích thước trung bình của các file đã biết
+        """
+        known_sizes = [item['size'] for item, _ in download_jobs if item.get('size')]
+        default_size = int(sum(known_sizes) / len(known_sizes)) if known_sizes else 0
+        return [item.get('size') or default_size for item, _ in download_jobs]
+
+    def _validate_download_range(self, start_idx: int, end_idx: int) -> bool:
+        """
+        Kiểm tra đã có danh sách nhạc và range hợp lệ
         """
         if not self.music_list:
             print("❌ Chưa có danh sách nhạc. Vui lòng parse trang trước.")
-            return
+            return False
         
-        # Validate range
         if start_idx < 1 or end_idx > len(self.music_list) or start_idx > end_idx:
             print(f"❌ Range không hợp lệ. Vui lòng chọn từ 1 đến {len(self.music_list)}")
+            return False
+        return True
+
+    def _select_from_catalog(self, catalog: TrackCatalog, start_idx: int, end_idx: int,
+                             track_ids: Optional[List[str]] = None) -> tuple:
+        """
+        Lấy tracks từ catalog (theo số thứ tự hoặc theo ID) làm music_list - không fetch HTML nào
+        Returns: (start_idx, end_idx, batch_range) - range mới trên music_list và khóa batch cho journal
+        """
+        if track_ids:
+            self.music_list = catalog.select_ids(track_ids)
+            batch_range = 'catalog-ids:' + hashlib.sha1(','.join(map(str, track_ids)).encode('utf-8')).hexdigest()[:12]
+            missing = len(set(map(str, track_ids))) - len(self.music_list)
+            print(f"🗃️  Catalog: {len(self.music_list)} tracks theo ID" + (f" ({missing} ID không có)" if missing else ""))
+        else:
+            self.music_list = catalog.select_range(start_idx, end_idx)
+            batch_range = f"catalog:{start_idx}-{end_idx}"
+            print(f"🗃️  Catalog: {len(self.music_list)} tracks (số {start_idx}-{end_idx} / {catalog.count()})")
+        return 1, len(self.music_list), batch_range
+
+    def _select_from_query(self, query: SearchResult, start_idx: int, end_idx: int) -> tuple:
+        """
+        Lấy tracks số start_idx-end_idx trong kết quả tìm kiếm làm music_list (chỉ lấy phần được chọn)
+        Returns: (start_idx, end_idx, batch_range) - như _select_from_catalog
+        """
+        self.music_list = query[max(start_idx, 1) - 1:end_idx]
+        batch_range = f"query:{query.key()}:{start_idx}-{end_idx}"
+        print(f"🔎 Query '{query.query}': {len(self.music_list)} tracks (số {start_idx}-{end_idx} / {len(query)} kết quả)")
+        return 1, len(self.music_list), batch_range
+
+    def _list_batch_range(self, start_idx: int, end_idx: int) -> str:
+        """
+        Batch key của range trên music_list: kèm digest các track trong range - music_list crawl lại
+        (sync, trang đổi) có cùng range nhưng tracks khác thì không khớp journal cũ
+        """
+        return f"{start_idx}-{end_idx}:{tracks_digest(self.music_list[start_idx - 1:end_idx])}"
+
+    def _build_download_jobs(self, start_idx: int, end_idx: int, next_file_index: int) -> List:
+        """
+        Tạo danh sách jobs (item, file_number) - file_number cố định theo vị trí trong range
+        """
+        download_jobs = []
+        for i in range(start_idx - 1, end_idx):
+            if i >= len(self.music_list):
+                break
+            
+            item = self.music_list[i]
+            file_number = next_file_index + (i - (start_idx - 1))
+            download_jobs.append((item, file_number))
+        return download_jobs
+
+    def _skip_journaled_jobs(self, download_jobs: List, journal: CheckpointJournal, batch_key: str) -> List:
+        """
+        Bỏ các job đã download xong theo journal và nạp lại hash của chúng để dedupe vẫn đúng
+        """
+        remaining = []
+        for item, file_number in download_jobs:
+            if journal.is_downloaded(batch_key, file_number):
+                event = journal.downloads[(batch_key, file_number)]
+                if event['sha256'] and not event['duplicate_of']:
+                    self.known_hashes.setdefault(event['sha256'], event['filename'])
+            else:
+                remaining.append((item, file_number))
+        skipped = len(download_jobs) - len(remaining)
+        if skipped:
+            print(f"📓 Resume: bỏ qua {skipped} file đã download xong theo journal")
+        return remaining
+
+    def download_music_range(self, start_idx: int, end_idx: int, download_folder: str = "downloads", max_workers: int = 4,
+                             schedule: str = 'index', sink=None, layout: str = 'flat',
+                             journal: Optional[CheckpointJournal] = None, catalog: Optional[TrackCatalog] = None,
+                             track_ids: Optional[List[str]] = None, query: Optional[SearchResult] = None):
+        """
+        Download nhạc theo range từ start_idx đến end_idx sử dụng multi-threading
+        Returns: Dict tổng kết (total/success/failed/...), None nếu range không hợp lệ
+        max_workers: Số thread tối đa (mặc định 4)
+        schedule: 'index' (theo số thứ tự) hoặc 'largest_first' (file lớn trước, giảm tail latency)
+        sink: nơi ghi file (LocalFileSink, S3MultipartSink...) - mặc định là thư mục download_folder
+        layout: 'flat' | 'page' | 'hash' - cách xếp file trong thư mục (page/hash ghi kèm manifest.jsonl)
+        journal: nếu có, file đã xong được ghi lại và lần chạy sau (resume) bỏ qua, giữ nguyên số thứ tự file
+        catalog: chọn tracks từ catalog (start_idx/end_idx là số thứ tự trong catalog, hoặc track_ids) - không crawl
+        query: kết quả TrackIndex.search - start_idx/end_idx là số thứ tự trong kết quả
+        """
+        batch_range = f"{start_idx}-{end_idx}"
+        if query is not None:
+            start_idx, end_idx, batch_range = self._select_from_query(query, start_idx, end_idx)
+        elif catalog is not None:
+            start_idx, end_idx, batch_range = self._select_from_catalog(catalog, start_idx, end_idx, track_ids)
+        if not self._validate_download_range(start_idx, end_idx):
             return
+        if query is None and catalog is None:
+            batch_range = self._list_batch_range(start_idx, end_idx)
         
-        # Tạo folder download
-        os.makedirs(download_folder, exist_ok=True)
+        # Tạo nơi lưu (folder download hoặc sink được truyền vào)
+        sink = sink or LocalFileSink(download_folder)
+        sink.prepare()
+        directory_layout = DirectoryLayout(layout)
+        manifest = self._open_manifest(sink, directory_layout)
         
         # Kiểm tra thư mục và lấy số thứ tự tiếp theo
-        next_file_index = self._get_next_file_index(download_folder)
+        next_file_index = self._get_next_file_index(sink, manifest)
+        
+        # Resume: dùng lại số thứ tự bắt đầu của lần chạy trước để tên file giữ nguyên
+        batch_key = f"{sink.describe()}:{batch_range}"
+        if journal is not None:
+            next_file_index = journal.batch_start(batch_key, next_file_index)
+        
+        # Chế độ auto: pool có đủ thread tối đa, AIMD quyết định bao nhiêu thread thực sự chạy
+        if 'download' in self.aimd_controllers:
+            max_workers = self.aimd_controllers['download'].maximum
         
         # Tính toán số file cần download
         total_files = end_idx - start_idx + 1
         
         print(f"\n🚀 Bắt đầu download từ {start_idx} đến {end_idx} ({total_files} files)")
-        print(f"📁 Thư mục lưu: {download_folder}")
-        print(f"🧵 Sử dụng {max_workers} threads song song")
+        print(f"📁 Thư mục lưu: {sink.describe()}")
+        if layout != 'flat':
+            print(f"🗂️  Layout: {layout} (manifest: {manifest.path})")
+        if 'download' in self.aimd_controllers:
+            print(f"🎛️  Auto concurrency (AIMD): tối đa {max_workers} threads, bắt đầu với {self.aimd_controllers['download'].limit}")
+        else:
+            print(f"🧵 Sử dụng {max_workers} threads song song")
+        if self.bandwidth_limiter.rate > 0:
+            print(f"🚦 Giới hạn băng thông: {self.bandwidth_limiter.rate / 1024:,.0f} KB/s (dùng chung)")
+        host_limits = ', '.join(f"{host}={limit}" for host, limit in self.host_limiter.limits().items())
+        print(f"🔌 Giới hạn kết nối theo host: {host_limits}")
         if next_file_index > 1:
             print(f"🔢 Số thứ tự file sẽ bắt đầu từ: {next_file_index}")
         print("-" * 60)
         
         # Chuẩn bị danh sách download jobs
-        download_jobs = []
-        for i in range(start_idx - 1, end_idx):
-            if i >= len(self.music_list):
-                break
-            
-            item = self.music_list[i]
-            file_number = next_file_index + (i - (start_idx - 1))
-            download_jobs.append((item, file_number))
+        download_jobs = self._build_download_jobs(start_idx, end_idx, next_file_index)
+        
+        if journal is not None:
+            download_jobs = self._skip_journaled_jobs(download_jobs, journal, batch_key)
         
         print(f"📋 Đã chuẩn bị {len(download_jobs)} jobs download...")
         
+        # Dự đoán thời gian hoàn thành theo kích thước file
+        predicted_time = None
+        probe_time = None
+        if schedule == 'largest_first':
+            # Resolve + HEAD chạy trước mọi transfer - đo riêng, không tính vào thời gian thực tế so với dự đoán
+            probe_started_at = time.monotonic()
+            download_jobs = self._schedule_download_jobs(download_jobs, max_workers)
+            probe_time = time.monotonic() - probe_started_at
+            sizes = self._estimated_job_sizes(download_jobs)
+            index_order_sizes = [size for _, size in sorted(zip(download_jobs, sizes), key=lambda pair: pair[0][1])]
+            
+            per_worker_throughput = self.throughput_estimate
+            if self.bandwidth_limiter.rate > 0:
+                per_worker_throughput = min(per_worker_throughput, self.bandwidth_limiter.rate / max_workers)
+            predicted_time = predict_makespan(sizes, max_workers, per_worker_throughput)
+            index_order_time = predict_makespan(index_order_sizes, max_workers, per_worker_throughput)
+            print(f"🗓️  Scheduler: file lớn trước ({sum(sizes) / (1024*1024):.1f}MB tổng)")
+            print(f"⏱️  Dự đoán hoàn thành: {predicted_time:.1f}s (theo số thứ tự: {index_order_time:.1f}s)")
+        
+        batch_started_at = time.monotonic()
+        total_bytes = 0
+        total_transfer_time = 0.0
+        
         # Khởi tạo counters
         success_count = 0
         failed_count = 0
         completed_count = 0
+        duplicate_count = 0
+        failures = []
         
         # Sử dụng ThreadPoolExecutor để download song song
+        from concurrent.futures import ThreadPoolExecutor, as_completed
         with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="Downloader") as executor:
             # Submit tất cả jobs
             future_to_job = {
-                executor.submit(self._download_single_file, item, download_folder, file_number): (item, file_number) 
+                executor.submit(self._download_single_file, item, sink, file_number, directory_layout, manifest): (item, file_number) 
                 for item, file_number in download_jobs
             }
             
@@ -795,12 +4793,22 @@ Hoặc nhập URL khác để thử:""".format(url=url))
                 
                 try:
                     result = future.result()
+                    if journal is not None:
+                        if result['success']:
+                            journal.download_done(batch_key, file_number, result)
+                        else:
+                            journal.download_failed(batch_key, file_number, result['error'])
                     
                     with self.progress_lock:
                         if result['success']:
                             success_count += 1
+                            total_bytes += result['file_size']
+                            total_transfer_time += result['elapsed']
+                            if result.get('duplicate_of'):
+                                duplicate_count += 1
                         else:
                             failed_count += 1
+                            failures.append({'index': item['index'], 'title': item['title'], 'error': result['error']})
                         
                         # Hiển thị tiến độ
                         progress = (completed_count / len(download_jobs)) * 100
@@ -811,15 +4819,319 @@ Hoặc nhập URL khác để thử:""".format(url=url))
                     with self.print_lock:
                         print(f"❌ Lỗi unexpected khi xử lý {item['title']}: {e}")
                     failed_count += 1
+                    failures.append({'index': item['index'], 'title': item['title'], 'error': str(e)})
+        
+        actual_time = time.monotonic() - batch_started_at
+        # Cập nhật ước lượng throughput mỗi worker cho lần dự đoán sau
+        if total_bytes > 0 and total_transfer_time > 0:
+            self.throughput_estimate = total_bytes / total_transfer_time
         
         print(f"\n" + "="*60)
         print(f"🏁 HOÀN THÀNH DOWNLOAD")
         print(f"📊 KẾT QUẢ CUỐI CÙNG:")
         print(f"   ✅ Thành công: {success_count}/{len(download_jobs)}")
         print(f"   ❌ Thất bại: {failed_count}/{len(download_jobs)}")
-        print(f"   📊 Tỷ lệ thành công: {(success_count/len(download_jobs)*100):.1f}%")
-        print(f"📁 Thư mục: {os.path.abspath(download_folder)}")
+        if duplicate_count:
+            print(f"   ♻️  Trùng lặp (đã bỏ): {duplicate_count}")
+        if predicted_time is not None:
+            print(f"   📏 Lấy kích thước (resolve + HEAD): {probe_time:.1f}s")
+            print(f"   ⏱️  Thời gian download: dự đoán {predicted_time:.1f}s | thực tế {actual_time:.1f}s")
+        else:
+            print(f"   ⏱️  Thời gian thực tế: {actual_time:.1f}s")
+        print(f"   📊 Tỷ lệ thành công: {(success_count/max(len(download_jobs), 1)*100):.1f}%")
+        print(f"📁 Thư mục: {sink.describe()}")
         print("="*60)
+        
+        return {
+            'total': len(download_jobs),
+            'success': success_count,
+            'failed': failed_count,
+            'duplicates': duplicate_count,
+            'bytes': total_bytes,
+            'elapsed': actual_time,
+            'predicted': predicted_time,
+            'probe_elapsed': probe_time,
+            'failures': failures,
+        }
+
+    def download_music_range_async(self, start_idx: int, end_idx: int, download_folder: str = "downloads",
+                                   concurrency: int = 200, max_connections: int = 100, sink=None,
+                                   layout: str = 'flat', journal: Optional[CheckpointJournal] = None,
+                                   catalog: Optional[TrackCatalog] = None,
+                                   track_ids: Optional[List[str]] = None,
+                                   query: Optional[SearchResult] = None) -> Optional[Dict]:
+        """
+        Download theo range bằng engine asyncio (httpx.AsyncClient) thay cho thread pool.
+        Dùng cùng job model (item, file_number) với download_music_range nhưng một thread
+        có thể giữ hàng trăm/hàng nghìn transfer cùng lúc.
+        concurrency: số coroutine download - số kết nối thực tới mỗi host vẫn theo host_limiter
+        (và AIMD nếu bật), mỗi transfer đang chạy giữ tối đa ASYNC_WRITE_BATCH bytes chờ ghi
+        max_connections: số kết nối TCP tối đa trong pool
+        sink: nơi ghi file - mặc định là thư mục download_folder
+        layout: 'flat' | 'page' | 'hash' - như download_music_range
+        journal: checkpoint journal để resume - như download_music_range
+        catalog/track_ids: chọn tracks từ catalog - như download_music_range
+        query: chọn tracks từ kết quả tìm kiếm - như download_music_range
+        """
+        if not httpx.available():
+            print("❌ Engine async cần httpx - chạy: pip install 'httpx[http2]'")
+            return None
+        
+        batch_range = f"{start_idx}-{end_idx}"
+        if query is not None:
+            start_idx, end_idx, batch_range = self._select_from_query(query, start_idx, end_idx)
+        elif catalog is not None:
+            start_idx, end_idx, batch_range = self._select_from_catalog(catalog, start_idx, end_idx, track_ids)
+        if not self._validate_download_range(start_idx, end_idx):
+            return None
+        if query is None and catalog is None:
+            batch_range = self._list_batch_range(start_idx, end_idx)
+        
+        sink = sink or LocalFileSink(download_folder)
+        sink.prepare()
+        directory_layout = DirectoryLayout(layout)
+        manifest = self._open_manifest(sink, directory_layout)
+        next_file_index = self._get_next_file_index(sink, manifest)
+        batch_key = f"{sink.describe()}:{batch_range}"
+        if journal is not None:
+            next_file_index = journal.batch_start(batch_key, next_file_index)
+        download_jobs = self._build_download_jobs(start_idx, end_idx, next_file_index)
+        if journal is not None:
+            download_jobs = self._skip_journaled_jobs(download_jobs, journal, batch_key)
+        
+        print(f"\n🚀 [async] Bắt đầu download từ {start_idx} đến {end_idx} ({len(download_jobs)} files)")
+        print(f"📁 Thư mục lưu: {sink.describe()}")
+        print(f"⚡ {concurrency} transfers đồng thời, tối đa {max_connections} kết nối")
+        print("-" * 60)
+        
+        summary = asyncio.run(self._run_async_downloads(download_jobs, sink, concurrency, max_connections,
+                                                       directory_layout, manifest, journal, batch_key))
+        
+        print(f"\n" + "="*60)
+        print(f"🏁 HOÀN THÀNH DOWNLOAD (async)")
+        print(f"   ✅ Thành công: {summary['success']}/{summary['total']}")
+        print(f"   ❌ Thất bại: {summary['failed']}/{summary['total']}")
+        if summary['duplicates']:
+            print(f"   ♻️  Trùng lặp (đã bỏ): {summary['duplicates']}")
+        print(f"   📦 Tổng: {summary['bytes'] / (1024*1024):.1f}MB trong {summary['elapsed']:.1f}s")
+        print(f"📁 Thư mục: {sink.describe()}")
+        print("="*60)
+        return summary
+
+    async def _run_async_downloads(self, download_jobs: List, sink, concurrency: int, max_connections: int,
+                                   layout: Optional[DirectoryLayout] = None,
+                                   manifest: Optional[LibraryManifest] = None,
+                                   journal: Optional[CheckpointJournal] = None, batch_key: str = '') -> Dict:
+        """
+        Chạy `concurrency` worker coroutines cùng rút job từ một iterator -
+        bộ nhớ chỉ tỉ lệ với concurrency chứ không với tổng số job
+        """
+        summary = {'total': len(download_jobs), 'success': 0, 'failed': 0, 'duplicates': 0,
+                   'bytes': 0, 'elapsed': 0.0, 'predicted': None, 'probe_elapsed': None, 'failures': []}
+        started_at = time.monotonic()
+        report_every = max(1, len(download_jobs) // 20)
+        if not download_jobs:
+            return summary
+        jobs = iter(download_jobs)
+        self._async_host_slots = {}
+        controller = self.aimd_controllers.get('download')
+        aimd_slot = AsyncLimit(lambda: controller.limit) if controller else None
+        
+        headers = dict(self.session.headers)
+        headers['Accept-Encoding'] = 'gzip, deflate'
+        headers.pop('Connection', None)
+        limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        
+        async with httpx.AsyncClient(http2=self.http2_client is not None, headers=headers, limits=limits,
+                                     timeout=30, follow_redirects=True) as client:
+            async def worker():
+                # Event loop chỉ có một thread nên next() trên iterator chung là an toàn
+                for item, file_number in jobs:
+                    self.metrics.inc('pixabay_active_workers', stage='download')
+                    try:
+                        result = await self._async_download_single_file(client, item, sink, file_number,
+                                                                       layout, manifest, aimd_slot)
+                    finally:
+                        self.metrics.inc('pixabay_active_workers', -1, stage='download')
+                    if journal is not None:
+                        if result['success']:
+                            await asyncio.to_thread(journal.download_done, batch_key, file_number, result)
+                        else:
+                            await asyncio.to_thread(journal.download_failed, batch_key, file_number, result['error'])
+                    if result['success']:
+                        summary['success'] += 1
+                        summary['bytes'] += result['file_size']
+                        if result['duplicate_of']:
+                            summary['duplicates'] += 1
+                    else:
+                        summary['failed'] += 1
+                        summary['failures'].append({'index': item['index'], 'title': item['title'],
+                                                    'error': result['error']})
+                    
+                    completed = summary['success'] + summary['failed']
+                    if completed % report_every == 0 or completed == summary['total']:
+                        elapsed = time.monotonic() - started_at
+                        print(f"📊 [async] Tiến độ: {completed}/{summary['total']} "
+                              f"({completed / summary['total'] * 100:.1f}%) | ✅ {summary['success']} | "
+                              f"❌ {summary['failed']} | {summary['bytes'] / (1024*1024) / max(elapsed, 1e-6):.1f}MB/s")
+            
+            await asyncio.gather(*(worker() for _ in range(max(1, min(concurrency, len(download_jobs))))))
+        
+        summary['elapsed'] = time.monotonic() - started_at
+        return summary
+
+    async def _async_resolve_url(self, client, item: Track) -> str:
+        """
+        Bản async của _try_get_real_download_url - parse HTML chạy trong thread riêng
+        để không chặn event loop
+        """
+        url = item['download_url']
+        if '/music/' not in url or url.endswith('.mp3'):
+            return url
+        
+        started_at = time.monotonic()
+        try:
+            async with self._async_host_slot(url), self.tracer.span('resolve', url=url):
+                response = await client.get(url, timeout=15, headers={'Referer': 'https://pixabay.com/'})
+            self.metrics.inc('pixabay_http_responses_total', code=response.status_code)
+            self.metrics.observe('pixabay_stage_seconds', time.monotonic() - started_at, stage='resolve')
+            if response.status_code == 200:
+                real_url = await asyncio.to_thread(self._extract_real_url_from_detail, response.content, url)
+                if real_url:
+                    return real_url
+        except Exception as e:
+            print(f"   ⚠️  [async] Lỗi khi lấy URL thực cho {item['title']}: {e}")
+        return url
+
+    def _async_host_slot(self, url: str) -> AsyncLimit:
+        """
+        Slot theo host cho engine async - cùng giới hạn với host_limiter của engine thread
+        (vd. cdn.pixabay.com=6) thay vì mở `concurrency` kết nối tới một host
+        """
+        host = (urllib.parse.urlparse(url).hostname or '').lower()
+        slot = self._async_host_slots.get(host)
+        if slot is None:
+            slot = self._async_host_slots[host] = AsyncLimit(lambda: self.host_limiter.slot(url).limit)
+        return slot
+
+    @contextlib.asynccontextmanager
+    async def _async_download_stream(self, client, url: str):
+        """
+        Response stream của engine async, nằm trong span download và giữ slot của host đến khi đọc xong body
+        """
+        async with self._async_host_slot(url):
+            with self.tracer.span('download', url=url):
+                async with client.stream('GET', url) as response:
+                    yield response
+
+    @traced_async('track', lambda client, item, sink, file_number, *args, **kwargs: {'index': item.get('index'),
+                                                                                    'file_number': file_number})
+    async def _async_download_single_file(self, client, item: Track, sink, file_number: int,
+                                          layout: Optional[DirectoryLayout] = None,
+                                          manifest: Optional[LibraryManifest] = None,
+                                          aimd_slot: Optional[AsyncLimit] = None) -> Dict:
+        """
+        Download một file trong engine async: resolve, stream + verify, ghi file qua thread offload
+        theo lô ASYNC_WRITE_BATCH bytes. aimd_slot: giới hạn của AIMD download (nếu bật) - transfer
+        giữ slot và ghi time-to-first-byte/status/bytes cho controller như engine thread
+        """
+        result = {
+            'item': item,
+            'success': False,
+            'error': None,
+            'filename': None,
+            'file_size': 0,
+            'sha256': None,
+            'duplicate_of': None,
+            'elapsed': 0.0
+        }
+        started_at = time.monotonic()
+        
+        filename = self._make_filename(item, file_number)
+        if layout is not None:
+            filename = layout.relative_path(item, file_number, filename)
+        result['filename'] = filename
+        writer = None
+        
+        try:
+            real_url = item.get('resolved_url') or await self._async_resolve_url(client, item)
+            
+            async with contextlib.AsyncExitStack() as stack:
+                if aimd_slot is not None:
+                    await stack.enter_async_context(aimd_slot)
+                sample = {'statuses': [], 'latency': None, 'ok': False}
+                transfer_started_at = time.monotonic()
+                try:
+                    response = await stack.enter_async_context(self._async_download_stream(client, real_url))
+                    sample['latency'] = time.monotonic() - transfer_started_at
+                    self.metrics.observe('pixabay_download_ttfb_seconds', sample['latency'])
+                    sample['statuses'].append(response.status_code)
+                    self.metrics.inc('pixabay_http_responses_total', code=response.status_code)
+                    response.raise_for_status()
+                    content_type = response.headers.get('content-type', '')
+                    if any(error_type in content_type.lower() for error_type in ERROR_CONTENT_TYPES):
+                        raise DownloadIntegrityError(f"Server trả về {content_type} thay vì audio")
+                    
+                    verifier = StreamVerifier(StreamVerifier.expected_length_from(response.headers))
+                    # Sink có thể block (ghi đĩa, chờ part S3) nên ghi chạy trong thread - gom chunk thành lô
+                    # để mỗi file chỉ offload vài lần thay vì một lần mỗi 64KB
+                    writer = await asyncio.to_thread(sink.open_writer, filename)
+                    buffer = bytearray()
+                    async for chunk in response.aiter_bytes(65536):
+                        verifier.feed(chunk)
+                        delay = self.bandwidth_limiter.reserve(len(chunk))
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+                        buffer += chunk
+                        if len(buffer) >= ASYNC_WRITE_BATCH:
+                            await asyncio.to_thread(writer.write, bytes(buffer))
+                            buffer.clear()
+                    if buffer:
+                        await asyncio.to_thread(writer.write, bytes(buffer))
+                    digest = verifier.finalize()
+                    sample['ok'] = True
+                finally:
+                    if aimd_slot is not None:
+                        latency = sample['latency'] if sample['latency'] is not None else \
+                            time.monotonic() - transfer_started_at
+                        self.aimd_controllers['download'].record(latency, sample['statuses'],
+                                                                 verifier.bytes_received if sample['ok'] else 0,
+                                                                 sample['ok'])
+            
+            await asyncio.to_thread(writer.commit)
+            writer = None
+            result['sha256'] = digest
+            result['file_size'] = verifier.bytes_received
+            
+            with self.progress_lock:
+                duplicate_of = self.known_hashes.get(digest)
+                if not duplicate_of:
+                    self.known_hashes[digest] = filename
+            if duplicate_of:
+                await asyncio.to_thread(sink.delete, filename)
+                result['duplicate_of'] = duplicate_of
+            elif manifest is not None:
+                await asyncio.to_thread(manifest.record, file_number, filename, item, digest, verifier.bytes_received)
+            
+            result['success'] = True
+            if self.index is not None:
+                self.index.mark_downloaded(item)
+            if self.catalog is not None:
+                import sqlite3
+                try:
+                    await asyncio.to_thread(self.catalog.set_downloaded, item, real_url, result['file_size'])
+                except sqlite3.Error as e:
+                    print(f"⚠️  [async] Không ghi được catalog cho {item['title']}: {e}")
+            
+        except Exception as e:
+            result['error'] = str(e) or type(e).__name__
+            if writer is not None:
+                await asyncio.to_thread(writer.abort)
+            print(f"❌ [async] Lỗi download {item['title']}: {result['error']}")
+        
+        result['elapsed'] = time.monotonic() - started_at
+        self._observe_download(result)
+        return result
 
 def handle_direct_urls():
     """
@@ -845,11 +5157,8 @@ def handle_direct_urls():
     # Tạo downloader và fake music list
     downloader = PixabayMusicDownloader()
     downloader.music_list = [
-        {
-            'title': f'Direct Download {i+1}',
-            'download_url': url,
-            'index': i + 1
-        } for i, url in enumerate(urls)
+        Track(title=f'Direct Download {i+1}', download_url=url, index=i + 1)
+        for i, url in enumerate(urls)
     ]
     
     # Hiển thị và download
@@ -877,7 +5186,17 @@ def main():
     Hàm main để chạy tool
     """
     downloader = PixabayMusicDownloader()
-    
+    try:
+        interactive_session(downloader)
+    finally:
+        # Dừng thread giữ kết nối và trả lại socket.getaddrinfo gốc (DNS cache của prewarm)
+        downloader.stop_prewarm()
+
+
+def interactive_session(downloader: PixabayMusicDownloader):
+    """
+    Chế độ tương tác: nhập URL, crawl, tìm kiếm/chọn range rồi download
+    """
     print("🎵 PIXABAY MUSIC DOWNLOADER")
     print("=" * 50)
     
@@ -887,6 +5206,8 @@ def main():
     # Nhập URL (hoặc dùng mặc định)
     url_input = input(f"Nhập URL Pixabay (Enter để dùng mặc định):\n{default_url}\n> ").strip()
     url = url_input if url_input else default_url
+    # Mở sẵn kết nối tới trang + CDN trong lúc user chọn trang/range
+    downloader.prewarm_connections([url])
     
     # Hỏi về pagination
     print("\n🔄 TÙY CHỌN CRAWLING:")
@@ -911,13 +5232,17 @@ def main():
             
             # Tùy chọn threads cho parsing
             if total_pages > 1:
-                parse_threads_input = input(f"Số threads cho parsing (Enter = 3, tối đa 5): ").strip()
-                try:
-                    parse_threads = int(parse_threads_input) if parse_threads_input else 3
-                    parse_threads = min(max(parse_threads, 1), 5)  # Giới hạn từ 1-5
-                except ValueError:
-                    parse_threads = 3
-                    print("❌ Số không hợp lệ, dùng mặc định 3 threads")
+                parse_threads_input = input(f"Số threads cho parsing (Enter = 3, tối đa 5, 'auto' = tự điều chỉnh): ").strip()
+                if parse_threads_input.lower() == 'auto':
+                    parse_threads = 5
+                    downloader.enable_auto_concurrency(crawl_max=5, resolve_max=0, download_max=0)
+                else:
+                    try:
+                        parse_threads = int(parse_threads_input) if parse_threads_input else 3
+                        parse_threads = min(max(parse_threads, 1), 5)  # Giới hạn từ 1-5
+                    except ValueError:
+                        parse_threads = 3
+                        print("❌ Số không hợp lệ, dùng mặc định 3 threads")
                 
                 print(f"🚀 Sẽ crawl từ trang {start_page} đến trang {end_page} ({total_pages} trang) với {parse_threads} threads...")
                 music_list = downloader.parse_multiple_pages(url, start_page, end_page, parse_threads)
@@ -960,40 +5285,71 @@ Chọn (1/2/3): """).strip()
         if not music_list:
             return
     
-    # Hiển thị danh sách
-    downloader.display_music_list()
-    
     # Nhập range để download
     try:
-        print(f"\n📝 Nhập range để download (1-{len(music_list)}):")
+        # Tìm kiếm + xem danh sách theo trang (không in hết hàng nghìn tracks một lúc)
+        downloader.build_index()
+        selection = downloader.browse_tracks()
+        if selection is None:
+            print("👋 Tạm biệt!")
+            return
+        print(f"\n📝 Nhập range trong kết quả để download (1-{len(selection)}):")
         start = int(input("Từ số: ").strip())
         end = int(input("Đến số: ").strip())
         
-        # Nhập thư mục lưu (optional)
-        folder_input = input("Thư mục lưu (Enter = 'downloads'): ").strip()
+        # Nhập thư mục lưu (optional) - hỗ trợ s3://bucket/prefix (endpoint qua S3_ENDPOINT_URL)
+        # và tar:// / zip:// để gom track vào archive xoay vòng
+        folder_input = input("Thư mục lưu (Enter = 'downloads', hoặc s3://bucket/prefix, tar://thư_mục, zip://thư_mục): ").strip()
         folder = folder_input if folder_input else "downloads"
         
         # Tùy chọn số threads
         print(f"\n⚙️  TÙY CHỌN THREADING:")
-        threads_input = input("Số threads download (Enter = 4, tối đa 8): ").strip()
+        threads_input = input("Số threads download (Enter = 4, tối đa 8, 'auto' = tự điều chỉnh): ").strip()
+        if threads_input.lower() == 'auto':
+            max_threads = 8
+            downloader.enable_auto_concurrency(crawl_max=0, resolve_max=8, download_max=8)
+        else:
+            try:
+                max_threads = int(threads_input) if threads_input else 4
+                max_threads = min(max(max_threads, 1), 8)  # Giới hạn từ 1-8
+            except ValueError:
+                max_threads = 4
+                print("❌ Số không hợp lệ, dùng mặc định 4 threads")
+        
+        # Giới hạn băng thông tổng (chia đều cho mọi thread)
+        bandwidth_input = input("Giới hạn băng thông KB/s (Enter = không giới hạn): ").strip()
         try:
-            max_threads = int(threads_input) if threads_input else 4
-            max_threads = min(max(max_threads, 1), 8)  # Giới hạn từ 1-8
+            bandwidth_kb = float(bandwidth_input) if bandwidth_input else 0
         except ValueError:
-            max_threads = 4
-            print("❌ Số không hợp lệ, dùng mặc định 4 threads")
+            bandwidth_kb = 0
+            print("❌ Số không hợp lệ, không giới hạn băng thông")
+        downloader.set_bandwidth_limit(bandwidth_kb * 1024)
+        
+        # Cấu trúc thư mục
+        layout_input = input("Cấu trúc thư mục (1 = phẳng, 2 = theo trang, 3 = shard theo hash; Enter = 1): ").strip()
+        layout = {'2': 'page', '3': 'hash'}.get(layout_input, 'flat')
+        
+        # Thứ tự download
+        schedule_input = input("Thứ tự download (1 = theo số thứ tự, 2 = file lớn trước; Enter = 1): ").strip()
+        schedule = 'largest_first' if schedule_input == '2' else 'index'
         
         # Xác nhận
         print(f"\n🔍 SẼ DOWNLOAD:")
         print(f"   - Từ bài {start} đến bài {end}")
         print(f"   - Tổng cộng: {end - start + 1} bài")
         print(f"   - Thư mục: {folder}")
-        print(f"   - Threads: {max_threads}")
+        print(f"   - Threads: {'auto (AIMD, tối đa 8)' if 'download' in downloader.aimd_controllers else max_threads}")
+        print(f"   - Băng thông: {f'{bandwidth_kb:,.0f} KB/s' if bandwidth_kb > 0 else 'không giới hạn'}")
         
         confirm = input("\nXác nhận download? (y/N): ").strip().lower()
         
         if confirm in ['y', 'yes']:
-            downloader.download_music_range(start, end, folder, max_threads)
+            sink = open_sink(folder)
+            try:
+                downloader.download_music_range(start, end, folder, max_threads, schedule, sink=sink, layout=layout,
+                                                query=selection)
+            finally:
+                sink.close()
         else:
             print("❌ Đã hủy download.")
             
@@ -1004,5 +5360,725 @@ Chọn (1/2/3): """).strip()
     except Exception as e:
         print(f"❌ Lỗi: {e}")
 
-if __name__ == "__main__":
+
+def parse_range(value, default_end: int) -> tuple:
+    """
+    Đọc range từ job spec: "1-20", 5, [1, 20] hoặc "all"
+    """
+    if value is None or value == 'all':
+        return 1, default_end
+    if isinstance(value, int):
+        return value, value
+    if isinstance(value, (list, tuple)) and len(value) == 2:
+        return int(value[0]), int(value[1])
+    text = str(value).strip()
+    if '-' in text:
+        start, end = text.split('-', 1)
+        return int(start), int(end) if end.strip() else default_end
+    return int(text), int(text)
+
+
+# Các key hợp lệ của một job (xem run_jobs)
+JOB_KEYS = frozenset({
+    'name', 'url', 'urls', 'pages', 'tracks', 'folder', 'parse_threads', 'threads', 'schedule', 'layout',
+    'engine', 'concurrency', 'sync', 'seen_file', 'stop_after', 'max_pages', 'from_catalog', 'ids', 'query',
+})
+
+
+def validate_job(job, number: int):
+    """
+    Kiểm tra một job trước khi chạy: phải là dict, không có key lạ và có nguồn tracks
+    (url, urls, from_catalog, ids hoặc query). Raises ValueError
+    """
+    if not isinstance(job, dict):
+        raise ValueError(f"Job {number}: phải là object, không phải {type(job).__name__}")
+    unknown = sorted(set(job) - JOB_KEYS)
+    if unknown:
+        raise ValueError(f"Job {number}: key không hợp lệ: {', '.join(map(str, unknown))}")
+    if not any(job.get(key) for key in ('url', 'urls', 'from_catalog', 'ids', 'query')):
+        raise ValueError(f"Job {number}: cần url, urls, from_catalog, ids hoặc query")
+    if job.get('urls') and not isinstance(job['urls'], list):
+        raise ValueError(f"Job {number}: urls phải là list")
+    if job.get('sync') and not job.get('url'):
+        raise ValueError(f"Job {number}: sync cần url")
+
+
+def load_job_file(path: str) -> Dict:
+    """
+    Đọc job file JSON hoặc YAML (cần PyYAML). Hỗ trợ:
+    {"settings": {...}, "defaults": {...}, "jobs": [{...}, ...]} hoặc một list jobs.
+    Job spec sai (kiểu, thiếu nguồn tracks, key lạ) raise ValueError trước khi chạy job nào
+    """
+    with open(path, encoding='utf-8') as f:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise RuntimeError("Job file YAML cần PyYAML - chạy: pip install pyyaml")
+            spec = yaml.safe_load(f)
+        else:
+            spec = json.load(f)
+    if isinstance(spec, list):
+        spec = {'jobs': spec}
+    if not isinstance(spec, dict):
+        raise ValueError("Job file phải là object hoặc list jobs")
+    unknown = sorted(set(spec) - {'settings', 'defaults', 'jobs'})
+    if unknown:
+        raise ValueError(f"Job file: key không hợp lệ: {', '.join(map(str, unknown))}")
+    for key, kind in (('settings', dict), ('defaults', dict), ('jobs', list)):
+        if not isinstance(spec.get(key, kind()), kind):
+            raise ValueError(f"Job file: {key} phải là {'object' if kind is dict else 'list'}")
+    defaults = spec.get('defaults', {})
+    # Job không phải dict giữ nguyên để validate_job báo lỗi đúng kiểu
+    spec['jobs'] = [{**defaults, **job} if isinstance(job, dict) else job for job in spec.get('jobs', [])]
+    for number, job in enumerate(spec['jobs'], 1):
+        validate_job(job, number)
+    return spec
+
+
+def run_jobs(jobs: List[Dict], settings: Optional[Dict] = None) -> Dict:
+    """
+    Chạy nhiều job liên tiếp trong cùng một process, dùng chung một downloader
+    (session, kết nối keep-alive, HTTP/2 client, hash dedupe, ước lượng throughput).
+    Job: url | urls, pages, tracks, folder, parse_threads, threads, schedule, layout, engine, concurrency
+    Job sync: sync=true (+ seen_file, stop_after, max_pages) - chỉ crawl/download track mới so với lần trước
+    settings['checkpoint_dir'] bật journal cho từng job, settings['resume'] để tiếp tục từ journal cũ
+    settings['metrics_port'] mở endpoint Prometheus, settings['metrics_json'] ghi metrics JSON khi xong
+    settings['trace'] ghi Chrome trace JSON, settings['otlp_endpoint'] gửi spans tới OTLP collector
+    settings['profile'] (thư mục) bật profile CPU theo stage, settings['profile_mode'] = 'cprofile' | 'sample'
+    settings['memory_report'] ('' = chỉ in, hoặc đường dẫn JSON), settings['memory_budget_mb'] giới hạn bộ nhớ khi crawl
+    settings['catalog'] lưu kết quả crawl vào catalog SQLite; job from_catalog=true (hoặc ids) download từ catalog, không crawl
+    Job query: chọn tracks bằng TrackIndex.search (vd. "piano* page:1-3 downloaded:no") - tracks là range trong kết quả,
+    job chỉ có query (không url) tìm trên catalog,
+    settings['index'] là file lưu index của catalog
+    settings['prewarm'] (số kết nối mỗi host, 0 = tắt) mở sẵn kết nối tới host của các job và CDN, giữ sống mỗi
+    settings['keepalive'] giây
+    Returns: Dict trạng thái có thể đọc bằng máy
+    """
+    settings = settings or {}
+    downloader = PixabayMusicDownloader()
+    if settings.get('http2'):
+        downloader.enable_http2(max_connections=settings.get('http2_connections', 4))
+    if settings.get('bandwidth_kb'):
+        downloader.set_bandwidth_limit(float(settings['bandwidth_kb']) * 1024)
+    for host, limit in settings.get('host_limits', {}).items():
+        downloader.set_host_limit(host, int(limit))
+    if settings.get('auto_concurrency'):
+        downloader.enable_auto_concurrency()
+    if settings.get('request_delay') is not None:
+        downloader.request_delay = float(settings['request_delay'])
+    downloader.stream_parse = settings.get('stream_parse', True)
+    if settings.get('metrics_port') is not None:
+        downloader.serve_metrics(int(settings['metrics_port']))
+    if settings.get('trace') or settings.get('otlp_endpoint'):
+        downloader.enable_tracing()
+    if settings.get('memory_report') is not None or settings.get('memory_budget_mb'):
+        downloader.enable_memory_monitor(float(settings.get('memory_budget_mb') or 0))
+    if settings.get('profile'):
+        downloader.enable_profiling(settings.get('profile_mode', 'cprofile'),
+                                    float(settings.get('profile_interval', 0.01)))
+    if settings.get('catalog'):
+        downloader.open_catalog(settings['catalog'])
+    if settings.get('prewarm'):
+        urls = [url for job in jobs for url in ([job.get('url')] + list(job.get('urls') or [])) if url]
+        downloader.prewarm_connections(urls or None, int(settings['prewarm']), float(settings.get('keepalive', 30)))
+    
+    started_at = time.time()
+    job_statuses = []
+    for number, job in enumerate(jobs, 1):
+        name = job.get('name') or f"job-{number}"
+        job_status = {'name': name, 'status': 'failed', 'tracks_found': 0, 'download': None, 'error': None}
+        job_statuses.append(job_status)
+        print(f"\n🗂️  JOB {number}/{len(jobs)}: {name}")
+        print("=" * 70)
+        safe_name = re.sub(r'[^\w.-]', '_', name)
+        journal = None
+        if settings.get('checkpoint_dir'):
+            journal = CheckpointJournal(os.path.join(settings['checkpoint_dir'], f"{safe_name}.jsonl"),
+                                        resume=settings.get('resume', False))
+        try:
+            # Crawl: catalog đã lưu (không fetch HTML), danh sách URL MP3 trực tiếp, sync (chỉ track mới) hoặc trang tìm kiếm
+            seen = None
+            track_ids = job.get('ids')
+            if isinstance(track_ids, str):
+                track_ids = [track_id.strip() for track_id in track_ids.split(',') if track_id.strip()]
+            # Job chỉ có query (không url/urls) tìm trên catalog
+            catalog_job = bool(job.get('from_catalog') or track_ids
+                               or (job.get('query') and not job.get('url') and not job.get('urls')))
+            if catalog_job:
+                if downloader.catalog is None:
+                    raise RuntimeError("Job from_catalog/ids/query cần catalog (--catalog hoặc settings.catalog)")
+            elif job.get('urls'):
+                downloader.music_list = [
+                    Track(title=f'Direct Download {i + 1}', download_url=url, index=i + 1)
+                    for i, url in enumerate(job['urls'])
+                ]
+            elif job.get('sync'):
+                seen = SeenTracks(job.get('seen_file') or os.path.join('.sync', f"{safe_name}.txt"))
+                downloader.crawl_new_tracks(job['url'], seen, int(job.get('stop_after', 20)),
+                                            int(job.get('max_pages', 20)))
+                if journal is not None:
+                    # Resume sau crash: track đã tải xong ở lần trước chưa kịp vào seen - đánh dấu luôn, không tải lại
+                    done = [item for item in downloader.music_list if journal.is_track_done(item)]
+                    if done:
+                        seen.add_many(done)
+                        downloader.music_list = [item for item in downloader.music_list
+                                                 if not journal.is_track_done(item)]
+                        for index, item in enumerate(downloader.music_list, 1):
+                            item['index'] = index
+                        print(f"📓 Resume: {len(done)} tracks đã tải xong ở lần trước - bỏ qua")
+                if not downloader.music_list:
+                    print("✅ Không có track mới")
+                    job_status['download'] = {'total': 0, 'success': 0, 'failed': 0, 'duplicates': 0, 'bytes': 0,
+                                              'elapsed': 0.0, 'predicted': None, 'probe_elapsed': None, 'failures': []}
+                    job_status['status'] = 'ok'
+                    continue  # finally vẫn đóng journal
+            else:
+                start_page, end_page = parse_range(job.get('pages', '1-1'), 1)
+                downloader.parse_multiple_pages(job['url'], start_page, end_page,
+                                                min(max(int(job.get('parse_threads', 3)), 1), 5), journal=journal)
+            query = None
+            if job.get('query'):
+                # Chọn tracks bằng tìm kiếm trên catalog (nếu có) hoặc danh sách vừa crawl - tracks là range trong kết quả
+                query = downloader.build_index(settings.get('index')).search(job['query'])
+                job_status['tracks_found'] = len(query)
+            else:
+                job_status['tracks_found'] = downloader.catalog.count() if catalog_job else len(downloader.music_list)
+            if not job_status['tracks_found']:
+                raise RuntimeError(f"Không có track nào khớp query: {job['query']}" if query is not None
+                                   else "Không lấy được danh sách nhạc")
+            
+            # Download
+            start, end = parse_range(job.get('tracks', 'all'), job_status['tracks_found'])
+            end = min(end, job_status['tracks_found'])
+            catalog = downloader.catalog if catalog_job else None
+            folder = job.get('folder', 'downloads')
+            sink = open_sink(folder)
+            try:
+                if job.get('engine') == 'async':
+                    summary = downloader.download_music_range_async(
+                        start, end, folder, concurrency=int(job.get('concurrency', 200)),
+                        sink=sink, layout=job.get('layout', 'flat'), journal=journal, catalog=catalog,
+                        track_ids=track_ids, query=query)
+                else:
+                    summary = downloader.download_music_range(
+                        start, end, folder, min(max(int(job.get('threads', 4)), 1), 8),
+                        job.get('schedule', 'index'), sink=sink, layout=job.get('layout', 'flat'), journal=journal,
+                        catalog=catalog, track_ids=track_ids, query=query)
+            finally:
+                sink.close()
+            if summary is None:
+                raise RuntimeError(f"Range track không hợp lệ: {start}-{end}")
+            if seen is not None:
+                # Chỉ đánh dấu đã biết các track tải xong - track lỗi sẽ được thử lại ở lần sync sau
+                failed_indexes = {failure['index'] for failure in summary['failures']}
+                seen.add_many([item for item in downloader.music_list[start - 1:end]
+                               if item['index'] not in failed_indexes])
+            
+            job_status['download'] = summary
+            job_status['status'] = 'ok' if summary['failed'] == 0 else ('partial' if summary['success'] else 'failed')
+        except Exception as e:
+            job_status['error'] = str(e)
+            print(f"❌ Job {name} lỗi: {e}")
+        finally:
+            if journal is not None:
+                journal.close()
+    
+    downloader.stop_prewarm()
+    if settings.get('metrics_json'):
+        downloader.metrics.dump_json(settings['metrics_json'])
+    downloader.metrics.close()
+    if settings.get('trace'):
+        downloader.tracer.dump_chrome(settings['trace'])
+    if settings.get('otlp_endpoint'):
+        downloader.tracer.export_otlp(settings['otlp_endpoint'])
+    if downloader.profiler is not None:
+        downloader.profiler.write(settings['profile'])
+    if downloader.memory is not None:
+        downloader.memory.report(settings.get('memory_report') or None)
+        downloader.memory.close()
+    if downloader.catalog is not None:
+        downloader.catalog.close()
+    
+    states = {job_status['status'] for job_status in job_statuses}
+    overall = 'ok' if states <= {'ok'} else ('failed' if states == {'failed'} else 'partial')
+    return {
+        'status': overall,
+        'started_at': started_at,
+        'elapsed': time.time() - started_at,
+        'jobs': job_statuses,
+    }
+
+
+# Exit code của runner: 0 = tất cả ok, 1 = một phần lỗi, 2 = tất cả lỗi, 3 = job spec sai
+RUN_EXIT_CODES = {'ok': 0, 'partial': 1, 'failed': 2}
+
+
+def build_run_parser():
+    """
+    Tham số dòng lệnh của `python a.py run`
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog='a.py run', description='Chạy download không tương tác (cron/scheduler)')
+    parser.add_argument('--job', help='Job file JSON/YAML (nhiều jobs)')
+    parser.add_argument('--url', help='URL trang tìm kiếm Pixabay')
+    parser.add_argument('--pages', default='1-1', help="Range trang, vd. 1-3")
+    parser.add_argument('--tracks', default='all', help="Range track, vd. 1-20 hoặc all")
+    parser.add_argument('--folder', default='downloads', help="Thư mục, s3://bucket/prefix, tar://thư_mục, zip://thư_mục")
+    parser.add_argument('--parse-threads', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--schedule', choices=['index', 'largest_first'], default='index')
+    parser.add_argument('--layout', choices=DirectoryLayout.STRATEGIES, default='flat')
+    parser.add_argument('--engine', choices=['threads', 'async'], default='threads')
+    parser.add_argument('--concurrency', type=int, default=200, help='Số transfer đồng thời cho engine async')
+    parser.add_argument('--http2', action='store_true', help='Dùng HTTP/2 (cần httpx[http2])')
+    parser.add_argument('--bandwidth-kb', type=float, default=0, help='Giới hạn băng thông tổng KB/s')
+    parser.add_argument('--auto-concurrency', action='store_true', help='Tự điều chỉnh số worker (AIMD)')
+    parser.add_argument('--request-delay', type=float, help='Delay trước mỗi request trang (giây, mặc định 2)')
+    parser.add_argument('--prewarm', type=int, default=0, metavar='N',
+                        help='Mở sẵn N kết nối keep-alive mỗi host (trang + CDN) trước khi cần, 0 = tắt')
+    parser.add_argument('--keepalive', type=float, default=30, help='Chu kỳ ping giữ kết nối mở sẵn (giây)')
+    parser.add_argument('--no-stream-parse', action='store_true',
+                        help='Tải hết trang tìm kiếm rồi mới parse (mặc định parse streaming nếu có lxml)')
+    parser.add_argument('--status-file', help='Ghi trạng thái JSON ra file')
+    parser.add_argument('--checkpoint-dir', help='Thư mục journal checkpoint (mỗi job một file)')
+    parser.add_argument('--resume', action='store_true',
+                        help='Tiếp tục từ journal của lần chạy trước (mặc định --checkpoint-dir .checkpoints)')
+    parser.add_argument('--sync', action='store_true', help='Chỉ lấy track mới (crawl mới nhất trước, dừng ở track đã biết)')
+    parser.add_argument('--seen-file', help='File lưu track đã biết cho --sync (mặc định .sync/<job>.txt)')
+    parser.add_argument('--stop-after', type=int, default=20, help='Dừng sync sau N track đã biết liên tiếp')
+    parser.add_argument('--max-pages', type=int, default=20, help='Số trang tối đa mỗi lần sync')
+    parser.add_argument('--metrics-port', type=int, help='Mở endpoint Prometheus /metrics tại port này')
+    parser.add_argument('--metrics-json', help='Ghi metrics JSON ra file khi chạy xong')
+    parser.add_argument('--trace', help='Ghi trace theo stage ra file Chrome trace JSON (mở bằng Perfetto)')
+    parser.add_argument('--otlp-endpoint', help='Gửi trace tới OTLP/HTTP collector, vd. http://localhost:4318')
+    parser.add_argument('--profile', metavar='DIR', help='Profile CPU theo stage, ghi pstats + collapsed stacks vào DIR')
+    parser.add_argument('--profile-mode', choices=StageProfiler.MODES, default='cprofile',
+                        help='cprofile (chi tiết) hoặc sample (overhead thấp cho lần chạy dài)')
+    parser.add_argument('--profile-interval', type=float, default=0.01, help='Chu kỳ chụp stack của chế độ sample (giây)')
+    parser.add_argument('--memory-report', nargs='?', const='', metavar='JSON',
+                        help='Báo cáo bộ nhớ theo stage/trang (tracemalloc), có đường dẫn thì ghi JSON')
+    parser.add_argument('--memory-budget-mb', type=float, default=0,
+                        help='Giới hạn bộ nhớ (MB) - crawl giảm số trang đồng thời khi sắp vượt')
+    parser.add_argument('--catalog', help='Catalog SQLite: lưu kết quả crawl (và URL thực) để lần sau không crawl lại')
+    parser.add_argument('--from-catalog', action='store_true',
+                        help='Download từ catalog (--tracks là số thứ tự trong catalog), không crawl')
+    parser.add_argument('--ids', help='Download các track ID này từ catalog, vd. 123456,234567')
+    parser.add_argument('--query', help='Chỉ download tracks khớp tìm kiếm (trên catalog nếu có; không có --url thì '
+                                        'tìm trên --catalog, không crawl), '
+                                        'vd. "piano relax* page:1-3 duration:<180 downloaded:no"')
+    parser.add_argument('--index', help='File lưu index tìm kiếm của catalog (dùng lại nếu catalog không đổi)')
+    return parser
+
+
+def run_cli(argv: List[str]) -> int:
+    """
+    python a.py run --job jobs.json | python a.py run --url URL --pages 1-3 --tracks 1-20
+    In trạng thái JSON ở dòng cuối stdout và trả về exit code theo RUN_EXIT_CODES
+    """
+    args = build_run_parser().parse_args(argv)
+    settings = {
+        'http2': args.http2,
+        'bandwidth_kb': args.bandwidth_kb,
+        'auto_concurrency': args.auto_concurrency,
+        'request_delay': args.request_delay,
+        'stream_parse': not args.no_stream_parse,
+        'prewarm': args.prewarm,
+        'keepalive': args.keepalive,
+        'checkpoint_dir': args.checkpoint_dir or ('.checkpoints' if args.resume else None),
+        'resume': args.resume,
+        'metrics_port': args.metrics_port,
+        'metrics_json': args.metrics_json,
+        'trace': args.trace,
+        'otlp_endpoint': args.otlp_endpoint,
+        'profile': args.profile,
+        'profile_mode': args.profile_mode,
+        'profile_interval': args.profile_interval,
+        'memory_report': args.memory_report,
+        'memory_budget_mb': args.memory_budget_mb,
+        'catalog': args.catalog,
+        'index': args.index,
+    }
+    try:
+        if args.job:
+            spec = load_job_file(args.job)
+            settings.update(spec.get('settings', {}))
+            jobs = spec['jobs']
+        elif args.url or args.from_catalog or args.ids or args.query:
+            if not (args.url or args.catalog):
+                raise ValueError("--from-catalog / --ids / --query không có --url cần --catalog")
+            jobs = [{
+                'url': args.url, 'pages': args.pages, 'tracks': args.tracks, 'folder': args.folder,
+                'parse_threads': args.parse_threads, 'threads': args.threads, 'schedule': args.schedule,
+                'layout': args.layout, 'engine': args.engine, 'concurrency': args.concurrency,
+                'sync': args.sync, 'seen_file': args.seen_file, 'stop_after': args.stop_after,
+                'max_pages': args.max_pages, 'from_catalog': args.from_catalog, 'ids': args.ids,
+                'query': args.query,
+            }]
+            validate_job(jobs[0], 1)
+        else:
+            raise ValueError("Cần --job, --url, --from-catalog, --ids hoặc --query")
+        if not jobs:
+            raise ValueError("Job file không có job nào")
+    except (OSError, ValueError, RuntimeError) as e:
+        status = {'status': 'invalid', 'error': str(e), 'jobs': []}
+        print(json.dumps(status, ensure_ascii=False))
+        return 3
+    
+    status = run_jobs(jobs, settings)
+    if args.status_file:
+        with open(args.status_file, 'w', encoding='utf-8') as f:
+            json.dump(status, f, ensure_ascii=False, indent=2)
+    print(json.dumps(status, ensure_ascii=False))
+    return RUN_EXIT_CODES[status['status']]
+
+
+def _wait_for_queue(job_queue, queue_name: str, poll_interval: float) -> Dict[str, int]:
+    """
+    Chờ đến khi queue không còn job pending/leased, in tiến độ khi số liệu thay đổi
+    """
+    last_counts = None
+    while True:
+        counts = job_queue.counts(queue_name)
+        if counts != last_counts:
+            total = sum(counts.values())
+            print(f"📊 [{queue_name}] done {counts.get('done', 0)}/{total} | "
+                  f"đang chạy {counts.get('leased', 0)} | chờ {counts.get('pending', 0)} | lỗi {counts.get('failed', 0)}")
+            last_counts = counts
+        if not counts.get('pending') and not counts.get('leased'):
+            return counts
+        time.sleep(poll_interval)
+
+
+def run_coordinator(job_queue, base_url: str, start_page: int, end_page: int, tracks='all',
+                    folder: str = 'downloads', layout: str = 'flat', poll_interval: float = 1.0) -> Dict:
+    """
+    Coordinator: đưa page jobs vào queue, chờ worker crawl xong, đánh số track rồi đưa track jobs vào queue.
+    Coordinator không tự crawl/download - chỉ chia việc và tổng hợp kết quả.
+    Returns: Dict tổng kết như download_music_range
+    """
+    downloader = PixabayMusicDownloader()
+    started_at = time.monotonic()
+    job_queue.reset()
+    job_queue.set_meta('state', 'crawling')
+    try:
+        print(f"🧭 Coordinator - queue: {job_queue.describe()}")
+        page_jobs = [{'url': downloader._build_page_url(base_url, page_num), 'page_num': page_num}
+                     for page_num in range(start_page, end_page + 1)]
+        job_queue.put_many('pages', page_jobs)
+        print(f"📋 Đã đưa {len(page_jobs)} page jobs vào queue, chờ workers...")
+        _wait_for_queue(job_queue, 'pages', poll_interval)
+        
+        # Ghép items theo thứ tự trang và đánh số như parse_multiple_pages
+        page_items = {}
+        for payload, status, result in job_queue.results('pages'):
+            if status == 'done' and result and result.get('items'):
+                page_items[payload['page_num']] = result['items']
+        music_list = []
+        for page_num in sorted(page_items):
+            for item in page_items[page_num]:
+                item = Track.from_dict(item)
+                item['index'] = len(music_list) + 1
+                music_list.append(item)
+        print(f"🎵 Tổng tracks: {len(music_list)} từ {len(page_items)}/{len(page_jobs)} trang")
+        downloader.music_list = music_list
+        
+        start_idx, end_idx = parse_range(tracks, len(music_list))
+        end_idx = min(end_idx, len(music_list))
+        if not downloader._validate_download_range(start_idx, end_idx):
+            return {'total': 0, 'success': 0, 'failed': 0, 'duplicates': 0, 'bytes': 0,
+                    'elapsed': time.monotonic() - started_at, 'predicted': None, 'probe_elapsed': None, 'failures': []}
+        
+        # Số thứ tự file do coordinator quyết định một lần - worker chỉ ghi đúng tên được giao
+        sink = open_sink(folder)
+        try:
+            sink.prepare()
+            directory_layout = DirectoryLayout(layout)
+            manifest = downloader._open_manifest(sink, directory_layout)
+            next_file_index = downloader._get_next_file_index(sink, manifest)
+        finally:
+            sink.close()
+        download_jobs = downloader._build_download_jobs(start_idx, end_idx, next_file_index)
+        job_queue.put_many('tracks', [
+            {'item': item.to_dict(), 'file_number': file_number, 'folder': folder, 'layout': layout}
+            for item, file_number in download_jobs
+        ])
+        job_queue.set_meta('state', 'downloading')
+        print(f"📋 Đã đưa {len(download_jobs)} track jobs vào queue (tracks {start_idx}-{end_idx})")
+        _wait_for_queue(job_queue, 'tracks', poll_interval)
+    finally:
+        # Báo cho workers thoát khi queue trống
+        job_queue.set_meta('state', 'finished')
+    
+    success_count = 0
+    duplicate_count = 0
+    total_bytes = 0
+    failures = []
+    track_results = job_queue.results('tracks')
+    for payload, status, result in track_results:
+        if status == 'done':
+            success_count += 1
+            total_bytes += result.get('file_size', 0)
+            if result.get('duplicate_of'):
+                duplicate_count += 1
+        else:
+            failures.append({'index': payload['item']['index'], 'title': payload['item']['title'],
+                             'error': (result or {}).get('error')})
+    actual_time = time.monotonic() - started_at
+    
+    print(f"\n" + "="*60)
+    print(f"🏁 HOÀN THÀNH (coordinator)")
+    print(f"   ✅ Thành công: {success_count}/{len(track_results)}")
+    print(f"   ❌ Thất bại: {len(failures)}/{len(track_results)}")
+    if duplicate_count:
+        print(f"   ♻️  Trùng lặp (đã bỏ): {duplicate_count}")
+    print(f"   ⏱️  Thời gian thực tế: {actual_time:.1f}s")
+    print("="*60)
+    return {
+        'total': len(track_results),
+        'success': success_count,
+        'failed': len(failures),
+        'duplicates': duplicate_count,
+        'bytes': total_bytes,
+        'elapsed': actual_time,
+        'predicted': None,
+        'probe_elapsed': None,
+        'failures': failures,
+    }
+
+
+def run_worker(job_queue, threads: int = 4, worker_id: Optional[str] = None, poll_interval: float = 1.0,
+               metrics_port: Optional[int] = None, metrics_json: Optional[str] = None,
+               trace: Optional[str] = None, otlp_endpoint: Optional[str] = None) -> Dict:
+    """
+    Worker: nhiều thread claim job từ queue (page trước, track sau), gia hạn lease trong lúc chạy
+    và báo kết quả về queue. Thoát khi coordinator báo finished và queue đã trống.
+    Có thể chạy nhiều worker trên nhiều process/máy với cùng một queue.
+    """
+    downloader = PixabayMusicDownloader()
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    targets = {}
+    targets_lock = Lock()
+    stats = {'pages': 0, 'tracks': 0, 'failed': 0}
+    if metrics_port is not None:
+        downloader.serve_metrics(metrics_port)
+    if trace or otlp_endpoint:
+        downloader.enable_tracing()
+    
+    def open_target(folder: str, layout: str):
+        # Mỗi (folder, layout) một sink + manifest dùng chung cho mọi thread của worker
+        with targets_lock:
+            key = (folder, layout)
+            if key not in targets:
+                sink = open_sink(folder)
+                sink.prepare()
+                directory_layout = DirectoryLayout(layout)
+                targets[key] = (sink, directory_layout, downloader._open_manifest(sink, directory_layout))
+            return targets[key]
+    
+    def run_job(queue_name: str, payload: Dict) -> Dict:
+        if queue_name == 'pages':
+            result = downloader._parse_single_page(payload['url'], payload['page_num'])
+            if not result['success']:
+                raise RuntimeError(result['error'])
+            if result['fallback']:
+                # Để job retry thay vì lưu tracks dự phòng làm kết quả của trang
+                raise RuntimeError("chỉ có kết quả dự phòng")
+            return {'items': [item.to_dict() for item in result['items']]}
+        sink, directory_layout, manifest = open_target(payload['folder'], payload['layout'])
+        result = downloader._download_single_file(Track.from_dict(payload['item']), sink, payload['file_number'],
+                                                  directory_layout, manifest)
+        if not result['success']:
+            raise RuntimeError(result['error'])
+        return {key: result[key] for key in ('filename', 'file_size', 'sha256', 'duplicate_of')}
+    
+    def heartbeat(job_id: int, owner: str, done: threading.Event):
+        while not done.wait(job_queue.lease_seconds / 3):
+            try:
+                if not job_queue.extend_lease(job_id, owner):
+                    return
+            except Exception as e:
+                with downloader.print_lock:
+                    print(f"⚠️  Không gia hạn được lease job {job_id}: {e}")
+    
+    def lost_lease(job_id: int):
+        with downloader.print_lock:
+            print(f"⚠️  Job {job_id} đã hết lease và về worker khác - bỏ kết quả của lần chạy này")
+    
+    def loop():
+        # Lease gắn với từng thread - job hết hạn rồi về thread khác của cùng worker thì thread cũ cũng không ghi đè
+        owner = f"{worker_id}/{threading.current_thread().name}"
+        while True:
+            claimed = None
+            for queue_name in ('pages', 'tracks'):
+                job = job_queue.claim(queue_name, owner)
+                if job is not None:
+                    claimed = (queue_name,) + job
+                    break
+            if claimed is None:
+                if job_queue.get_meta('state') == 'finished':
+                    return
+                time.sleep(poll_interval)
+                continue
+            
+            queue_name, job_id, payload = claimed
+            done = threading.Event()
+            keeper = threading.Thread(target=heartbeat, args=(job_id, owner, done), daemon=True)
+            keeper.start()
+            try:
+                if job_queue.complete(job_id, owner, run_job(queue_name, payload)):
+                    with downloader.progress_lock:
+                        stats[queue_name] += 1
+                else:
+                    lost_lease(job_id)
+            except Exception as e:
+                if job_queue.fail(job_id, owner, str(e)):
+                    with downloader.progress_lock:
+                        stats['failed'] += 1
+                else:
+                    lost_lease(job_id)
+            finally:
+                done.set()
+    
+    print(f"👷 Worker {worker_id} - queue: {job_queue.describe()} - {threads} threads")
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="Worker") as executor:
+        for future in [executor.submit(loop) for _ in range(threads)]:
+            future.result()
+    for sink, _, _ in targets.values():
+        sink.close()
+    if metrics_json:
+        downloader.metrics.dump_json(metrics_json)
+    downloader.metrics.close()
+    if trace:
+        downloader.tracer.dump_chrome(trace)
+    if otlp_endpoint:
+        downloader.tracer.export_otlp(otlp_endpoint)
+    
+    print(f"👷 Worker {worker_id} xong: {stats['pages']} trang, {stats['tracks']} tracks, {stats['failed']} job lỗi")
+    return {'worker': worker_id, **stats}
+
+
+def coordinator_cli(argv: List[str]):
+    """
+    python a.py coordinator --queue sqlite:///queue.db --url URL --pages 1-10 --tracks all
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog='a.py coordinator', description='Chia page/track jobs cho các worker')
+    parser.add_argument('--queue', required=True, help='sqlite:///đường/dẫn.db hoặc redis://host:6379/0')
+    parser.add_argument('--url', required=True, help='URL trang tìm kiếm Pixabay')
+    parser.add_argument('--pages', default='1-1', help="Range trang, vd. 1-10")
+    parser.add_argument('--tracks', default='all', help="Range track, vd. 1-200 hoặc all")
+    parser.add_argument('--folder', default='downloads', help="Thư mục dùng chung hoặc s3://bucket/prefix")
+    parser.add_argument('--layout', choices=DirectoryLayout.STRATEGIES, default='flat')
+    parser.add_argument('--lease', type=float, default=120, help='Thời gian lease job (giây)')
+    args = parser.parse_args(argv)
+    start_page, end_page = parse_range(args.pages, 1)
+    summary = run_coordinator(open_job_queue(args.queue, args.lease), args.url, start_page, end_page,
+                              args.tracks, args.folder, args.layout)
+    print(json.dumps(summary, ensure_ascii=False))
+
+
+def worker_cli(argv: List[str]):
+    """
+    python a.py worker --queue sqlite:///queue.db --threads 4
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog='a.py worker', description='Nhận job từ queue và crawl/download')
+    parser.add_argument('--queue', required=True, help='sqlite:///đường/dẫn.db hoặc redis://host:6379/0')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--id', help='Tên worker (mặc định hostname-pid)')
+    parser.add_argument('--lease', type=float, default=120, help='Thời gian lease job (giây)')
+    parser.add_argument('--metrics-port', type=int, help='Mở endpoint Prometheus /metrics tại port này')
+    parser.add_argument('--metrics-json', help='Ghi metrics JSON ra file khi worker thoát')
+    parser.add_argument('--trace', help='Ghi Chrome trace JSON khi worker thoát')
+    parser.add_argument('--otlp-endpoint', help='Gửi trace tới OTLP/HTTP collector khi worker thoát')
+    args = parser.parse_args(argv)
+    run_worker(open_job_queue(args.queue, args.lease), max(args.threads, 1), args.id,
+               metrics_port=args.metrics_port, metrics_json=args.metrics_json,
+               trace=args.trace, otlp_endpoint=args.otlp_endpoint)
+
+
+def catalog_cli(argv: List[str]):
+    """
+    python a.py catalog catalog.db stats | list --tracks 1-20 | export catalog.jsonl | import catalog.jsonl
+    python a.py catalog catalog.db search "piano relax* page:1-3 downloaded:no" --page 2 --index catalog.idx.json
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog='a.py catalog', description='Xem / tìm / export / import catalog tracks')
+    parser.add_argument('catalog', help='File catalog SQLite')
+    parser.add_argument('action', choices=['stats', 'list', 'search', 'export', 'import'])
+    parser.add_argument('file', nargs='?', help='File JSONL cho export/import, query cho search')
+    parser.add_argument('--tracks', default='all', help="Range số thứ tự cho list, vd. 1-20")
+    parser.add_argument('--page', type=int, default=1, help='Trang kết quả của search')
+    parser.add_argument('--page-size', type=int, default=20, help='Số tracks mỗi trang kết quả')
+    parser.add_argument('--index', help='File lưu index tìm kiếm (dùng lại nếu catalog không đổi)')
+    args = parser.parse_args(argv)
+    if args.action in ('export', 'import') and not args.file:
+        parser.error(f"{args.action} cần đường dẫn file JSONL")
+    
+    catalog = TrackCatalog(args.catalog)
+    try:
+        if args.action == 'export':
+            print(f"💾 Đã export {catalog.export_jsonl(args.file)} tracks ra {args.file}")
+        elif args.action == 'import':
+            added, updated = catalog.import_jsonl(args.file)
+            print(f"📥 Import {args.file}: +{added} tracks mới, {updated} cập nhật (tổng {catalog.count()})")
+        elif args.action == 'search':
+            try:
+                result = TrackIndex.from_catalog(catalog, args.index).search(args.file or '')
+            except ValueError as e:
+                print(f"❌ {e}")
+                return 3
+            result.print_page(min(max(args.page, 1), result.page_count(args.page_size)), args.page_size)
+        elif args.action == 'list':
+            start, end = parse_range(args.tracks, catalog.count())
+            for item in catalog.select_range(start, end):
+                resolved = '✅' if item.get('resolved_url') else '  '
+                print(f"{item['index']:5d}. {resolved} [{item.get('id', '-')}] {item['title']} (Trang {item.get('page', '?')})")
+        else:
+            stats = catalog.stats()
+            print(f"🗃️  Catalog {catalog.describe()}")
+            print(f"   🎵 Tracks: {stats['tracks']} ({stats['resolved']} đã có URL thực)")
+            print(f"   🔎 Nguồn crawl: {stats['sources']}")
+            if stats['last_crawl']:
+                print(f"   🕒 Crawl gần nhất: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stats['last_crawl']))}")
+    finally:
+        catalog.close()
+
+# Subcommand -> (hàm CLI nhận argv còn lại, mô tả). Không có subcommand thì chạy chế độ tương tác main()
+COMMANDS = {
+    'run': (run_cli, 'chạy không tương tác (cron/scheduler)'),
+    'coordinator': (coordinator_cli, 'chia page/track jobs vào queue dùng chung'),
+    'worker': (worker_cli, 'nhận job từ queue và crawl/download'),
+    'catalog': (catalog_cli, 'xem / tìm / export / import catalog tracks'),
+    'migrate-layout': (migrate_layout_cli, 'chuyển thư mục download sang layout khác'),
+}
+
+
+def print_usage():
+    print("🎵 Pixabay Music Downloader")
+    print(f"   {'python a.py':<33} chế độ tương tác")
+    for name, (_, description) in COMMANDS.items():
+        print(f"   {'python a.py ' + name:<33} {description}")
+    print(f"   {'python a.py <lệnh> --help':<33} tham số của từng lệnh")
+    print("   Script/cron: dùng `python cli.py <lệnh>` (dùng bytecode cache, khởi động nhanh hơn python a.py)")
+
+
+def cli_main(argv: List[str]) -> int:
+    """
+    Entry point dòng lệnh (a.py và cli.py): chỉ import những gì lệnh cần -
+    --help / catalog không đụng tới requests, bs4, httpx
+    """
+    if argv and argv[0] in ('-h', '--help'):
+        print_usage()
+        return 0
+    if argv and argv[0] in COMMANDS:
+        exit_code = COMMANDS[argv[0]][0](argv[1:])
+        return exit_code if isinstance(exit_code, int) else 0
     main()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(cli_main(sys.argv[1:]))
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+"""
+Benchmark crawl / resolve / download với mock Pixabay server chạy local
+Không cần mạng, kết quả lặp lại được (seed cố định) - dùng để so sánh trước/sau khi tối ưu
+
+    python benchmark.py --pages 10 --concurrency 1,4,8 --latency 0.05 --bandwidth-kb 2048
+    python benchmark.py --recorded pages/ --json result.json
+    python benchmark.py --connect-latency 0.1 --prewarm 4     # kết nối mới tốn 100ms (DNS + TLS), mở sẵn 4 kết nối
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+from a import PixabayMusicDownloader
+
+
+class MockPixabayServer:
+    """
+    Server giả lập Pixabay:
+    - /music/search/...?pagi=N: trang tìm kiếm (synthetic hoặc file HTML đã ghi lại page_N.html)
+    - /music/<slug>-<id>/: detail page có URL MP3 trong JavaScript
+    - /download/audio/<id>.mp3: CDN có latency, giới hạn băng thông mỗi kết nối, lỗi ngẫu nhiên, hỗ trợ Range
+    - connect_latency: mỗi kết nối mới chờ thêm chừng đó giây trước request đầu tiên (giả lập DNS + TCP + TLS)
+    """
+    def __init__(self, pages: int = 10, per_page: int = 20, latency: float = 0.0, bandwidth: float = 0,
+                 error_rate: float = 0.0, min_size_kb: int = 200, max_size_kb: int = 2000,
+                 recorded_dir: Optional[str] = None, seed: int = 42, connect_latency: float = 0.0):
+        self.pages = pages
+        self.connect_latency = connect_latency
+        self.per_page = per_page
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.recorded_dir = recorded_dir
+        self.seed = seed
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        # Kích thước mỗi file cố định theo seed để các lần chạy so sánh được
+        size_random = random.Random(seed)
+        self.sizes = {
+            self.track_id(page, position): size_random.randint(min_size_kb, max_size_kb) * 1024
+            for page in range(1, pages + 1) for position in range(per_page)
+        }
+        self.requests = 0
+        self.connections = 0
+        self._server = None
+
+    @staticmethod
+    def track_id(page: int, position: int) -> int:
+        return 100000 + page * 1000 + position
+
+    @staticmethod
+    def duration(page: int, position: int) -> int:
+        # Thời lượng cố định theo vị trí (60-239 giây) - để test bộ lọc duration:
+        return 60 + (page * 37 + position * 53) % 180
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def search_page(self, page: int) -> bytes:
+        if self.recorded_dir:
+            path = os.path.join(self.recorded_dir, f"page_{page}.html")
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    return f.read()
+        if page > self.pages:
+            return b'<html><body></body></html>'
+        rows = ''.join(
+            f'<div class="audioRow--x"><a class="title--7N7Nr" '
+            f'href="/music/beats-track-{self.track_id(page, position)}/">Track {page}-{position}</a>'
+            f'<div class="duration--bLi2C">{self.duration(page, position) // 60}:{self.duration(page, position) % 60:02d}'
+            f'</div></div>'
+            for position in range(self.per_page)
+        )
+        return f'<html><body>{rows}</body></html>'.encode()
+
+    def audio_body(self, track_id: int) -> bytes:
+        size = self.sizes.get(track_id, 256 * 1024)
+        pattern = track_id.to_bytes(4, 'big') * 256
+        body = b'ID3\x03\x00\x00\x00\x00\x00\x00' + pattern * (size // len(pattern) + 1)
+        return body[:size]
+
+    def should_fail(self) -> bool:
+        if self.error_rate <= 0:
+            return False
+        with self._random_lock:
+            return self._random.random() < self.error_rate
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                server.connections += 1
+                if server.connect_latency > 0:
+                    time.sleep(server.connect_latency)
+
+            def send_body(self, status: int, body: bytes, content_type: str, headers: Optional[Dict] = None):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                if self.command == 'HEAD':
+                    return
+                if server.bandwidth <= 0:
+                    self.wfile.write(body)
+                    return
+                # Giới hạn băng thông mỗi kết nối: ghi từng chunk 16KB rồi ngủ
+                chunk_size = 16 * 1024
+                for offset in range(0, len(body), chunk_size):
+                    self.wfile.write(body[offset:offset + chunk_size])
+                    time.sleep(min(chunk_size, len(body) - offset) / server.bandwidth)
+
+            def do_HEAD(self):
+                self.do_GET()
+
+            def do_GET(self):
+                server.requests += 1
+                if server.latency > 0:
+                    time.sleep(server.latency)
+                parsed = urllib.parse.urlparse(self.path)
+                query = urllib.parse.parse_qs(parsed.query)
+                if server.should_fail():
+                    self.send_body(503, b'Service Unavailable', 'text/plain')
+                    return
+
+                if parsed.path.startswith('/music/search'):
+                    page = int(query.get('pagi', ['1'])[0])
+                    self.send_body(200, server.search_page(page), 'text/html; charset=utf-8')
+                elif parsed.path.startswith('/music/'):
+                    id_match = re.search(r'-(\d+)/?$', parsed.path)
+                    if not id_match:
+                        self.send_body(404, b'Not Found', 'text/plain')
+                        return
+                    audio_url = f"{server.base_url}/download/audio/{id_match.group(1)}.mp3"
+                    html = f'<html><script>window.data = {{"download":"{audio_url}"}};</script></html>'
+                    self.send_body(200, html.encode(), 'text/html; charset=utf-8')
+                elif parsed.path.startswith('/download/audio/'):
+                    body = server.audio_body(int(re.search(r'(\d+)\.mp3', parsed.path).group(1)))
+                    range_match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+                    if range_match:
+                        start = int(range_match.group(1))
+                        end = int(range_match.group(2)) if range_match.group(2) else len(body) - 1
+                        if start >= len(body):
+                            self.send_body(416, b'', 'text/plain', {'Content-Range': f"bytes */{len(body)}"})
+                            return
+                        end = min(end, len(body) - 1)
+                        self.send_body(206, body[start:end + 1], 'audio/mpeg', {
+                            'Content-Range': f"bytes {start}-{end}/{len(body)}", 'Accept-Ranges': 'bytes'})
+                    else:
+                        self.send_body(200, body, 'audio/mpeg', {'Accept-Ranges': 'bytes'})
+                else:
+                    self.send_body(404, b'Not Found', 'text/plain')
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='MockPixabay', daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    # Nearest-rank
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+def span_durations(downloader: PixabayMusicDownloader, name: str) -> List[float]:
+    return [(span['end_ns'] - span['start_ns']) / 1e9 for span in downloader.tracer.spans if span['name'] == name]
+
+
+def make_downloader(concurrency: int, request_delay: float, stream_parse: bool = True, prewarm: int = 0,
+                    base_url: Optional[str] = None) -> PixabayMusicDownloader:
+    downloader = PixabayMusicDownloader()
+    downloader.request_delay = request_delay
+    downloader.stream_parse = stream_parse
+    # Trang mock lỗi phải tính là lỗi, không được chạy sang pixabay.com thật hay danh sách demo
+    downloader.allow_fallback = False
+    downloader.set_host_limit('127.0.0.1', max(concurrency, 1))
+    if prewarm and base_url:
+        # Như khi user còn đang chọn range: kết nối đã mở sẵn trước khi stage bắt đầu
+        with contextlib.redirect_stdout(io.StringIO()):
+            downloader.prewarm_connections([base_url], prewarm, include_cdn=False).wait_warm(30)
+    # Latency lấy từ span của tracer
+    downloader.enable_tracing()
+    return downloader
+
+
+def first_request_latency(downloader: PixabayMusicDownloader) -> float:
+    """
+    Latency của request HTTP đầu tiên trong stage (gồm cả thời gian mở kết nối nếu kết nối còn nguội)
+    """
+    spans = [span for span in downloader.tracer.spans if span['name'] == 'http']
+    if not spans:
+        return 0.0
+    first = min(spans, key=lambda span: span['start_ns'])
+    return (first['end_ns'] - first['start_ns']) / 1e9
+
+
+def histogram_mean(downloader: PixabayMusicDownloader, name: str) -> float:
+    samples = downloader.metrics.to_dict().get(name, [])
+    count = sum(sample['count'] for sample in samples)
+    return sum(sample['sum'] for sample in samples) / count if count else 0.0
+
+
+def stage_result(stage: str, concurrency: int, items: int, elapsed: float, latencies: List[float],
+                 bytes_total: int = 0, failed: int = 0) -> Dict:
+    return {
+        'stage': stage,
+        'concurrency': concurrency,
+        'items': items,
+        'failed': failed,
+        'elapsed': elapsed,
+        'rate': items / elapsed if elapsed > 0 else 0.0,
+        'mb_per_s': bytes_total / (1024 * 1024) / elapsed if elapsed > 0 else 0.0,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+    }
+
+
+def run_benchmark(server: MockPixabayServer, concurrency_levels: List[int], pages: int,
+                  tracks: Optional[int] = None, request_delay: float = 0.0, verbose: bool = False,
+                  stream_parse: bool = True, prewarm: int = 0) -> List[Dict]:
+    """
+    Chạy 3 stage ở từng mức concurrency, mỗi mức một downloader mới (không dùng lại cache/kết nối)
+    """
+    search_url = f"{server.base_url}/music/search/?q=benchmark"
+    results = []
+    for concurrency in concurrency_levels:
+        print(f"🏁 Concurrency {concurrency}...")
+        output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+        download_folder = tempfile.mkdtemp(prefix='pixabay_bench_')
+        try:
+            with output:
+                # Crawl
+                downloader = make_downloader(concurrency, request_delay, stream_parse, prewarm, server.base_url)
+                started_at = time.perf_counter()
+                music_list = downloader.parse_multiple_pages(search_url, 1, pages, max_workers=concurrency)
+                crawl_elapsed = time.perf_counter() - started_at
+                page_latencies = span_durations(downloader, 'page')
+                crawl = stage_result('crawl', concurrency, len(page_latencies), crawl_elapsed, page_latencies,
+                                     failed=pages - len({item['page'] for item in music_list}))
+                # Từ lúc gửi request trang tới track đầu tiên (giảm khi parse streaming)
+                crawl['first_track'] = histogram_mean(downloader, 'pixabay_page_first_track_seconds')
+                crawl['first_request'] = first_request_latency(downloader)
+                downloader.stop_prewarm()
+
+                # Resolve detail page -> URL MP3
+                selected = music_list[:tracks] if tracks else music_list
+                downloader = make_downloader(concurrency, request_delay, prewarm=prewarm, base_url=server.base_url)
+                started_at = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                    resolved = list(executor.map(
+                        lambda item: downloader._try_get_real_download_url(item['download_url'], item['title']),
+                        selected))
+                resolve_elapsed = time.perf_counter() - started_at
+                resolve = stage_result('resolve', concurrency, len(selected), resolve_elapsed,
+                                       span_durations(downloader, 'resolve_url'),
+                                       failed=sum(1 for url in resolved if not url.endswith('.mp3')))
+                resolve['first_request'] = first_request_latency(downloader)
+                downloader.stop_prewarm()
+
+                # Download (resolve + transfer cho từng track, như khi chạy thật)
+                downloader = make_downloader(concurrency, request_delay, prewarm=prewarm, base_url=server.base_url)
+                downloader.music_list = [item.copy() for item in selected]
+                started_at = time.perf_counter()
+                summary = downloader.download_music_range(1, len(selected), download_folder, max_workers=concurrency)
+                download_elapsed = time.perf_counter() - started_at
+                download = stage_result('download', concurrency, summary['success'], download_elapsed,
+                                        span_durations(downloader, 'track'), summary['bytes'], summary['failed'])
+                download['first_request'] = first_request_latency(downloader)
+                downloader.stop_prewarm()
+        finally:
+            shutil.rmtree(download_folder, ignore_errors=True)
+        results.extend([crawl, resolve, download])
+    return results
+
+
+def print_report(results: List[Dict]):
+    units = {'crawl': 'pages/s', 'resolve': 'tracks/s', 'download': 'tracks/s'}
+    print("\n" + "=" * 103)
+    print(f"{'stage':<9}{'conc':>5}{'items':>7}{'lỗi':>6}{'time(s)':>9}{'rate':>10} {'unit':<9}"
+          f"{'MB/s':>8}{'p50(ms)':>10}{'p95(ms)':>10}{'1st(ms)':>11}")
+    print("-" * 103)
+    for result in results:
+        print(f"{result['stage']:<9}{result['concurrency']:>5}{result['items']:>7}{result['failed']:>6}"
+              f"{result['elapsed']:>9.2f}{result['rate']:>10.1f} {units[result['stage']]:<9}"
+              f"{result['mb_per_s']:>8.1f}{result['p50'] * 1000:>10.0f}{result['p95'] * 1000:>10.0f}"
+              f"{result.get('first_request', 0) * 1000:>11.0f}")
+    print("=" * 103)
+    for result in results:
+        if result['stage'] == 'crawl':
+            print(f"⏱️  Concurrency {result['concurrency']}: track đầu tiên sau {result['first_track'] * 1000:.0f}ms "
+                  f"(trung bình mỗi trang)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark crawl/resolve/download với mock Pixabay server')
+    parser.add_argument('--pages', type=int, default=5, help='Số trang tìm kiếm')
+    parser.add_argument('--per-page', type=int, default=20, help='Số tracks mỗi trang')
+    parser.add_argument('--tracks', type=int, help='Chỉ resolve/download N tracks đầu (mặc định tất cả)')
+    parser.add_argument('--concurrency', default='1,4,8', help='Các mức concurrency, vd. 1,4,8,16')
+    parser.add_argument('--latency', type=float, default=0.02, help='Latency mỗi request (giây)')
+    parser.add_argument('--bandwidth-kb', type=float, default=0, help='Băng thông mỗi kết nối KB/s (0 = không giới hạn)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Tỉ lệ request trả 503 (0-1)')
+    parser.add_argument('--min-size-kb', type=int, default=200)
+    parser.add_argument('--max-size-kb', type=int, default=2000)
+    parser.add_argument('--recorded', help='Thư mục chứa trang tìm kiếm đã ghi lại (page_1.html, page_2.html...)')
+    parser.add_argument('--request-delay', type=float, default=0.0, help='Delay trước mỗi request trang của downloader')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', help='Ghi kết quả JSON ra file để so sánh giữa các lần chạy')
+    parser.add_argument('--verbose', action='store_true', help='Hiện log của downloader')
+    parser.add_argument('--no-stream-parse', action='store_true',
+                        help='Tải hết trang tìm kiếm rồi mới parse (để so sánh với parse streaming)')
+    parser.add_argument('--connect-latency', type=float, default=0.0,
+                        help='Thời gian mở mỗi kết nối mới của mock server (giây, giả lập DNS + TLS)')
+    parser.add_argument('--prewarm', type=int, default=0, help='Mở sẵn N kết nối trước mỗi stage (0 = tắt)')
+    args = parser.parse_args()
+
+    concurrency_levels = [int(level) for level in args.concurrency.split(',') if level.strip()]
+    server = MockPixabayServer(args.pages, args.per_page, args.latency, args.bandwidth_kb * 1024, args.error_rate,
+                               args.min_size_kb, args.max_size_kb, args.recorded, args.seed,
+                               args.connect_latency).start()
+    print(f"🧪 Mock server: {server.base_url} | {args.pages} trang x {args.per_page} tracks | "
+          f"latency {args.latency * 1000:.0f}ms | lỗi {args.error_rate * 100:.0f}%")
+    try:
+        results = run_benchmark(server, concurrency_levels, args.pages, args.tracks, args.request_delay,
+                                args.verbose, not args.no_stream_parse, args.prewarm)
+    finally:
+        server.stop()
+
+    print_report(results)
+    if args.json:
+        config = {key: value for key, value in vars(args).items() if key not in ('json', 'verbose')}
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'config': config, 'results': results}, f, ensure_ascii=False, indent=2)
+        print(f"💾 Đã ghi kết quả: {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,12 @@
+#!/usr/bin/env python3
+"""
+Entry point nhẹ cho script/cron: python cli.py <lệnh> ... (giống python a.py <lệnh> ...)
+Chạy `python a.py` thì Python phải compile lại cả file mỗi lần; cli.py import a nên dùng bytecode cache (.pyc)
+"""
+
+import sys
+
+from a import cli_main
+
+if __name__ == "__main__":
+    sys.exit(cli_main(sys.argv[1:]))
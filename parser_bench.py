@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark + regression gate cho parser (_parse_response_content, _extract_real_url_from_detail)
+Chạy trên corpus trong parser_corpus/ (HTML tổng hợp viết tay mô phỏng các layout Pixabay, không phải trang
+lưu từ pixabay.com), so sánh output với golden và tốc độ với baseline.
+Tốc độ đo tương đối so với một vòng calibration chạy xen kẽ trong cùng process (median / median), nên baseline
+không phụ thuộc máy và ít bị nhiễu khi máy đang bận.
+
+    python parser_bench.py                      # exit 1 nếu output khác golden hoặc chậm hơn baseline quá ngưỡng
+    python parser_bench.py --update-golden      # sau khi cố ý đổi output của parser
+    python parser_bench.py --update-baseline    # ghi lại chi phí tương đối sau khi cố ý đổi tốc độ parser
+    python parser_bench.py --stream             # trang tìm kiếm đi qua _parse_stream (feed từng chunk như khi tải)
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from html.parser import HTMLParser
+from typing import Dict, List
+
+from a import PixabayMusicDownloader
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parser_corpus')
+GOLDEN_FILE = 'golden.json'
+BASELINE_FILE = 'baseline.json'
+# Tài liệu cố định cho vòng calibration - cùng loại việc với parser (tokenize HTML, xử lý chuỗi)
+CALIBRATION_HTML = ''.join(f'<div class="row" data-id="{i}"><a href="/music/track-{i}/" title="Track {i}">'
+                           f'Track {i}</a><span>{i % 60}:{i % 59:02d}</span></div>' for i in range(150))
+
+
+class NullWriter:
+    """
+    Nuốt output của parser (parser in rất nhiều) - không giữ lại trong bộ nhớ như StringIO
+    """
+    def write(self, text):
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def load_json(path: str, default):
+    if not os.path.exists(path):
+        return default
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_json(path: str, data):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def calibration_loop():
+    parser = HTMLParser()
+    parser.feed(CALIBRATION_HTML)
+    parser.close()
+
+
+def parse_entry(downloader: PixabayMusicDownloader, entry: Dict, content: bytes, stream: bool = False):
+    if entry['kind'] == 'detail':
+        return downloader._extract_real_url_from_detail(content, entry['url'])
+    if stream:
+        chunk_size = downloader.STREAM_CHUNK_SIZE
+        chunks = (content[offset:offset + chunk_size] for offset in range(0, len(content), chunk_size))
+        return [item.to_dict() for item in downloader._parse_stream(chunks, entry['url'])]
+    return [item.to_dict() for item in downloader._parse_response_content(content, entry['url'])]
+
+
+def bench_entry(downloader: PixabayMusicDownloader, entry: Dict, corpus_dir: str, min_time: float,
+                min_iterations: int, stream: bool = False) -> Dict:
+    """
+    Chạy parser trên một trang: output, số tracks, thời gian (median), bộ nhớ cấp phát (tracemalloc).
+    Mỗi lần parse chạy xen kẽ với một lần calibration_loop - relative_cost = median parse / median calibration
+    """
+    with open(os.path.join(corpus_dir, entry['file']), 'rb') as f:
+        content = f.read()
+
+    with contextlib.redirect_stdout(NullWriter()):
+        # Lần đầu đo cấp phát bộ nhớ riêng - tracemalloc làm chậm nên không tính vào thời gian
+        tracemalloc.start()
+        output = parse_entry(downloader, entry, content, stream)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        timings = []
+        calibration_timings = []
+        started_at = time.perf_counter()
+        while len(timings) < min_iterations or time.perf_counter() - started_at < min_time:
+            call_started_at = time.perf_counter()
+            calibration_loop()
+            calibration_timings.append(time.perf_counter() - call_started_at)
+            call_started_at = time.perf_counter()
+            parse_entry(downloader, entry, content, stream)
+            timings.append(time.perf_counter() - call_started_at)
+
+    # Median của các lần chạy xen kẽ - máy chậm đi / bị chiếm CPU thì cả hai cùng chậm, tỉ lệ giữ nguyên
+    median = statistics.median(timings)
+    calibration = statistics.median(calibration_timings)
+    return {
+        'file': entry['file'],
+        'kind': entry['kind'],
+        'bytes': len(content),
+        'tracks': len(output) if isinstance(output, list) else int(output is not None),
+        'output': output,
+        'iterations': len(timings),
+        'median_ms': median * 1000,
+        'pages_per_s': 1 / median if median > 0 else 0.0,
+        'relative_cost': median / calibration if calibration > 0 else 0.0,
+        'peak_alloc_kb': peak / 1024,
+    }
+
+
+def run(corpus_dir: str, threshold: float, min_time: float, min_iterations: int, only: List[str],
+        update_golden: bool, update_baseline: bool, stream: bool = False) -> int:
+    manifest = load_json(os.path.join(corpus_dir, 'manifest.json'), [])
+    if only:
+        manifest = [entry for entry in manifest if any(name in entry['file'] for name in only)]
+    golden_path = os.path.join(corpus_dir, GOLDEN_FILE)
+    baseline_path = os.path.join(corpus_dir, BASELINE_FILE)
+    golden = load_json(golden_path, {})
+    baseline = load_json(baseline_path, {})
+
+    downloader = PixabayMusicDownloader()
+    # Warm-up: lần parse đầu tiên phải compile selector/regex - không tính vào kết quả
+    for entry in manifest:
+        with open(os.path.join(corpus_dir, entry['file']), 'rb') as f, contextlib.redirect_stdout(NullWriter()):
+            parse_entry(downloader, entry, f.read(), stream)
+    results = [bench_entry(downloader, entry, corpus_dir, min_time, min_iterations, stream) for entry in manifest]
+
+    failures = []
+    print("=" * 100)
+    print(f"{'trang':<30}{'KB':>6}{'tracks':>8}{'ms':>9}{'pages/s':>10}{'cost':>8}{'baseline':>10}{'alloc KB':>10}"
+          f"  kết quả")
+    print("-" * 100)
+    for result in results:
+        name = result['file']
+        status = []
+        if name in golden and golden[name] != result['output']:
+            status.append('❌ output khác golden')
+            failures.append(f"{name}: output khác golden")
+        elif name not in golden:
+            status.append('⚠️  chưa có golden')
+
+        # cost = bao nhiêu lần vòng calibration - so được giữa các máy, không như pages/s tuyệt đối
+        base = baseline.get(name, {}).get('relative_cost')
+        if base:
+            change = result['relative_cost'] / base - 1
+            if change > threshold:
+                status.append(f"❌ chậm hơn {change * 100:.0f}%")
+                failures.append(f"{name}: cost {result['relative_cost']:.2f} > baseline {base:.2f} (+{change * 100:.0f}%)")
+            else:
+                status.append(f"{change * 100:+.0f}%")
+        print(f"{name:<30}{result['bytes'] / 1024:>6.1f}{result['tracks']:>8}{result['median_ms']:>9.2f}"
+              f"{result['pages_per_s']:>10.0f}{result['relative_cost']:>8.2f}{base or 0:>10.2f}"
+              f"{result['peak_alloc_kb']:>10.0f}  {' '.join(status) or '✅'}")
+    print("=" * 100)
+
+    total_time = sum(result['median_ms'] for result in results)
+    print(f"📊 Tổng: {len(results)} trang, {sum(result['tracks'] for result in results)} tracks, "
+          f"{total_time:.1f}ms cho một lượt corpus")
+
+    if update_golden:
+        golden.update({result['file']: result['output'] for result in results})
+        save_json(golden_path, golden)
+        print(f"💾 Đã cập nhật golden: {golden_path}")
+        failures = [failure for failure in failures if 'golden' not in failure]
+    if update_baseline:
+        baseline.update({result['file']: {'relative_cost': round(result['relative_cost'], 3),
+                                          'peak_alloc_kb': round(result['peak_alloc_kb'], 1)}
+                         for result in results})
+        save_json(baseline_path, baseline)
+        print(f"💾 Đã cập nhật baseline: {baseline_path}")
+        failures = [failure for failure in failures if 'baseline' not in failure]
+
+    if failures:
+        print(f"\n❌ {len(failures)} lỗi regression:")
+        for failure in failures:
+            print(f"   - {failure}")
+        return 1
+    print("\n✅ Parser không có regression")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark và regression gate cho parser Pixabay')
+    parser.add_argument('--corpus', default=CORPUS_DIR, help='Thư mục corpus (có manifest.json)')
+    parser.add_argument('--threshold', type=float, default=0.3,
+                        help='Ngưỡng chi phí tương đối cao hơn baseline cho phép (0.3 = 30%%)')
+    parser.add_argument('--min-time', type=float, default=0.5, help='Thời gian đo tối thiểu mỗi trang (giây)')
+    parser.add_argument('--min-iterations', type=int, default=21)
+    parser.add_argument('--only', nargs='*', default=[], help='Chỉ chạy các trang có tên chứa chuỗi này')
+    parser.add_argument('--update-golden', action='store_true', help='Ghi output hiện tại làm golden')
+    parser.add_argument('--update-baseline', action='store_true', help='Ghi chi phí tương đối hiện tại làm baseline')
+    parser.add_argument('--stream', action='store_true',
+                        help='Parse trang tìm kiếm bằng _parse_stream (feed từng chunk) thay vì cả trang')
+    args = parser.parse_args()
+    sys.exit(run(args.corpus, args.threshold, args.min_time, args.min_iterations, args.only,
+                 args.update_golden, args.update_baseline, args.stream))
+
+
+if __name__ == "__main__":
+    main()
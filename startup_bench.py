@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Benchmark thời gian khởi động của a.py + gate cho lazy import
+Mỗi lệnh chạy trong process mới nhiều lần (lấy best/median), trừ đi thời gian khởi động của chính Python
+
+    python startup_bench.py                 # exit 1 nếu `import a` kéo theo module nặng hoặc cli.py chậm hơn --max-ms
+    python startup_bench.py --runs 20 --json startup.json
+"""
+
+import argparse
+import json
+import os
+import py_compile
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+A_PY = os.path.join(ROOT, 'a.py')
+CLI_PY = os.path.join(ROOT, 'cli.py')
+
+# Các module chỉ được import khi thật sự crawl/download (xem LazyModule trong a.py)
+HEAVY_MODULES = ('requests', 'urllib3', 'bs4', 'httpx', 'asyncio', 'cProfile', 'pstats', 'tracemalloc',
+                 'sqlite3', 'concurrent.futures')
+
+
+def time_command(argv: List[str], runs: int) -> Dict:
+    """
+    Chạy lệnh runs lần trong process mới, trả về best/median (ms)
+    """
+    timings = []
+    for _ in range(runs):
+        started_at = time.perf_counter()
+        completed = subprocess.run(argv, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, cwd=ROOT)
+        timings.append((time.perf_counter() - started_at) * 1000)
+        if completed.returncode != 0:
+            raise RuntimeError(f"{' '.join(argv)} lỗi (exit {completed.returncode}): {completed.stderr.decode()[-500:]}")
+    return {'best_ms': min(timings), 'median_ms': statistics.median(timings)}
+
+
+def import_profile(top: int) -> Dict:
+    """
+    `python -X importtime -c "import a"`: tổng thời gian import a, các module con tốn nhất,
+    module nặng bị `import a` kéo theo (không tính module site/sitecustomize đã import sẵn)
+    """
+    code = (f"import sys; before = set(sys.modules); import a; "
+            f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules and m not in before))")
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                               capture_output=True, text=True, cwd=ROOT, check=True)
+    # importtime in theo thứ tự con trước cha: module con trực tiếp của a nằm ngay trước dòng của a
+    children = []
+    total_us = 0
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, raw_name = line[len('import time:'):].split('|')
+        name = raw_name.strip()
+        depth = (len(raw_name) - len(raw_name.lstrip())) // 2
+        if depth == 0:
+            if name == 'a':
+                total_us = int(cumulative_us)
+                break
+            children = []
+        elif depth == 1:
+            children.append((name, int(cumulative_us)))
+    children.sort(key=lambda module: module[1], reverse=True)
+    heavy = [name for name in completed.stdout.strip().split(',') if name]
+    return {'import_ms': total_us / 1000, 'top_modules': [(name, us / 1000) for name, us in children[:top]],
+            'heavy_loaded': heavy}
+
+
+def run(runs: int, max_ms: float, top: int, json_path: str) -> int:
+    with tempfile.TemporaryDirectory() as temp_dir:
+        catalog_path = os.path.join(temp_dir, 'catalog.db')
+        commands = {
+            'python -c pass': [sys.executable, '-c', 'pass'],
+            'import a': [sys.executable, '-c', 'import a'],
+            'a.py --help': [sys.executable, A_PY, '--help'],
+            'a.py run --help': [sys.executable, A_PY, 'run', '--help'],
+            'a.py catalog stats': [sys.executable, A_PY, 'catalog', catalog_path, 'stats'],
+            'cli.py --help': [sys.executable, CLI_PY, '--help'],
+            'cli.py catalog stats': [sys.executable, CLI_PY, 'catalog', catalog_path, 'stats'],
+        }
+        # Như khi cài đặt bình thường: a.py đã có bytecode cache (kể cả khi đặt PYTHONDONTWRITEBYTECODE)
+        py_compile.compile(A_PY, doraise=True)
+        # Warm-up: lần đầu phải đọc .pyc từ đĩa / compile a.py - không tính
+        for argv in commands.values():
+            subprocess.run(argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=ROOT)
+        results = {name: time_command(argv, runs) for name, argv in commands.items()}
+    profile = import_profile(top)
+    interpreter_ms = results['python -c pass']['best_ms']
+
+    print("=" * 70)
+    print(f"{'lệnh':<24}{'best ms':>10}{'median ms':>12}{'- python':>12}")
+    print("-" * 70)
+    for name, result in results.items():
+        print(f"{name:<24}{result['best_ms']:>10.1f}{result['median_ms']:>12.1f}"
+              f"{result['best_ms'] - interpreter_ms:>12.1f}")
+    print("=" * 70)
+    print(f"📦 import a (-X importtime): {profile['import_ms']:.1f}ms")
+    for name, ms in profile['top_modules']:
+        print(f"   {name:<28}{ms:>8.1f}ms")
+
+    failures = []
+    if profile['heavy_loaded']:
+        failures.append(f"`import a` đã import module nặng: {', '.join(profile['heavy_loaded'])}")
+    for name in ('cli.py --help', 'cli.py catalog stats'):
+        overhead = results[name]['best_ms'] - interpreter_ms
+        if overhead > max_ms:
+            failures.append(f"{name}: {overhead:.1f}ms > {max_ms:.0f}ms (không tính khởi động Python)")
+
+    if json_path:
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump({'commands': results, 'import': profile, 'interpreter_ms': interpreter_ms}, f,
+                      ensure_ascii=False, indent=2)
+        print(f"💾 Đã ghi kết quả: {json_path}")
+
+    if failures:
+        print(f"\n❌ {len(failures)} lỗi:")
+        for failure in failures:
+            print(f"   - {failure}")
+        return 1
+    print("\n✅ Khởi động nhanh, không import module nặng")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Đo thời gian khởi động của a.py (lazy import)')
+    parser.add_argument('--runs', type=int, default=10, help='Số lần chạy mỗi lệnh')
+    parser.add_argument('--max-ms', type=float, default=60,
+                        help='Thời gian tối đa cho lệnh nhanh (--help, catalog), không tính khởi động Python')
+    parser.add_argument('--top', type=int, default=8, help='Số module con tốn thời gian nhất để in')
+    parser.add_argument('--json', help='Ghi kết quả JSON ra file')
+    args = parser.parse_args()
+    sys.exit(run(max(args.runs, 1), args.max_ms, args.top, args.json))
+
+
+if __name__ == "__main__":
+    main()
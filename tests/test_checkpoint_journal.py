@@ -0,0 +1,45 @@
+from a import CheckpointJournal
+
+RESULT = {'filename': 'b.mp3', 'sha256': 'ab', 'duplicate_of': None, 'file_size': 3}
+
+
+def test_replay_after_torn_tail(tmp_path):
+    path = str(tmp_path / 'job.jsonl')
+    journal = CheckpointJournal(path)
+    journal.download_done('a', 1, {**RESULT, 'filename': 'a.mp3'})
+    journal.close()
+    # Crash giữa lúc ghi dòng tiếp theo
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('{"event": "download_done", "batch": "a", "file_nu')
+
+    journal = CheckpointJournal(path)
+    assert journal.is_downloaded('a', 1)
+    journal.download_done('b', 5, RESULT)
+    journal.close()
+
+    journal = CheckpointJournal(path)
+    assert journal.is_downloaded('a', 1)
+    assert journal.is_downloaded('b', 5)
+    journal.close()
+
+
+def test_resume_false_starts_empty(tmp_path):
+    path = str(tmp_path / 'job.jsonl')
+    journal = CheckpointJournal(path)
+    journal.download_done('a', 1, RESULT)
+    journal.close()
+    journal = CheckpointJournal(path, resume=False)
+    assert not journal.is_downloaded('a', 1)
+    journal.close()
+
+
+def test_done_tracks_survive_replay(tmp_path):
+    path = str(tmp_path / 'job.jsonl')
+    track = {'title': 'Piano', 'download_url': 'https://pixabay.com/music/piano-123456/'}
+    journal = CheckpointJournal(path)
+    journal.download_done('1-5:abc', 3, {**RESULT, 'item': track})
+    journal.close()
+    journal = CheckpointJournal(path)
+    assert journal.is_track_done(track)
+    assert not journal.is_track_done({'title': 'Other', 'download_url': 'https://pixabay.com/music/x-654321/'})
+    journal.close()
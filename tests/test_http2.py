@@ -0,0 +1,144 @@
+import asyncio
+import datetime
+import ipaddress
+import socket
+import ssl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip('h2')
+pytest.importorskip('httpx')
+hypercorn_asyncio = pytest.importorskip('hypercorn.asyncio')
+hypercorn_config = pytest.importorskip('hypercorn.config')
+x509 = pytest.importorskip('cryptography.x509')
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from a import PixabayMusicDownloader
+
+
+def write_self_signed_cert(directory):
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(x509.NameOID.COMMON_NAME, '127.0.0.1')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1)).not_valid_after(now + datetime.timedelta(days=1))
+            .add_extension(x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address('127.0.0.1'))]),
+                           critical=False)
+            .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+            .add_extension(x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False)
+            .add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(key.public_key()), critical=False)
+            .sign(key, hashes.SHA256()))
+    cert_path, key_path = directory / 'cert.pem', directory / 'key.pem'
+    cert_path.write_bytes(cert.public_bytes(serialization.Encoding.PEM))
+    key_path.write_bytes(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                           serialization.NoEncryption()))
+    return str(cert_path), str(key_path)
+
+
+class H2Server:
+    """
+    Server hypercorn chạy trong thread riêng - ghi lại giao thức, kết nối (port client) và số request đồng thời
+    """
+    def __init__(self, cert_path, key_path, alpn):
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            self.port = probe.getsockname()[1]
+        self.config = hypercorn_config.Config()
+        self.config.bind = [f'127.0.0.1:{self.port}']
+        self.config.certfile, self.config.keyfile = cert_path, key_path
+        self.config.alpn_protocols = alpn
+        self.config.accesslog = self.config.errorlog = None
+        self._loop = self._stop = None
+        self._thread = threading.Thread(target=asyncio.run, args=(self._serve(),), daemon=True)
+
+    async def _app(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        self.requests.append((scope['http_version'], scope['client'][1]))
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(0.2)
+            if scope['path'].endswith('.mp3'):
+                body, content_type = b'ID3\x03' + b'\x01' * 50000, b'audio/mpeg'
+            else:
+                body, content_type = b'<html></html>', b'text/html'
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': [(b'content-type', content_type), (b'content-length', str(len(body)).encode())]})
+            await send({'type': 'http.response.body', 'body': body})
+        finally:
+            self.active -= 1
+
+    async def _serve(self):
+        self._loop, self._stop = asyncio.get_running_loop(), asyncio.Event()
+        await hypercorn_asyncio.serve(self._app, self.config, shutdown_trigger=self._stop.wait)
+
+    def __enter__(self):
+        self._thread.start()
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                return self
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def __exit__(self, *exc):
+        self._loop.call_soon_threadsafe(self._stop.set)
+        self._thread.join(10)
+
+
+@pytest.fixture
+def cert(tmp_path):
+    return write_self_signed_cert(tmp_path)
+
+
+def make_downloader(cert_path):
+    downloader = PixabayMusicDownloader()
+    assert downloader.enable_http2(max_connections=4, verify=ssl.create_default_context(cafile=cert_path))
+    return downloader
+
+
+def download(downloader, url):
+    with downloader._open_download_stream(url) as response:
+        return response.status_code, sum(len(chunk) for chunk in response.iter_content(16384))
+
+
+def test_concurrent_requests_share_one_h2_connection(cert):
+    with H2Server(*cert, alpn=['h2', 'http/1.1']) as server:
+        base = f'https://127.0.0.1:{server.port}'
+        downloader = make_downloader(cert[0])
+        # Request đầu mở kết nối - các request song song sau đó multiplex trên kết nối này
+        assert downloader._http_get(f'{base}/music/search/').http_version == 'HTTP/2'
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            pages = list(executor.map(lambda i: downloader._http_get(f'{base}/music/track-{i}/'), range(6)))
+            files = list(executor.map(lambda i: download(downloader, f'{base}/audio/{i}.mp3'), range(6)))
+        downloader.http2_client.close()
+    assert {response.status_code for response in pages} == {200}
+    assert files == [(200, 50004)] * 6
+    assert {version for version, _ in server.requests} == {'2'}
+    assert len({client_port for _, client_port in server.requests}) == 1
+    assert server.max_active > 1
+
+
+def test_falls_back_to_http1_without_h2_alpn(cert):
+    with H2Server(*cert, alpn=['http/1.1']) as server:
+        base = f'https://127.0.0.1:{server.port}'
+        downloader = make_downloader(cert[0])
+        response = downloader._http_get(f'{base}/music/search/')
+        status, size = download(downloader, f'{base}/audio/1.mp3')
+        downloader.http2_client.close()
+    assert response.http_version == 'HTTP/1.1'
+    assert (response.status_code, status, size) == (200, 200, 50004)
+    assert {version for version, _ in server.requests} == {'1.1'}
@@ -0,0 +1,102 @@
+import time
+
+import pytest
+
+from a import RedisJobQueue, SQLiteJobQueue
+
+LEASE = 0.3
+
+
+@pytest.fixture(params=['sqlite', 'redis'])
+def job_queue(request, tmp_path):
+    if request.param == 'sqlite':
+        return SQLiteJobQueue(str(tmp_path / 'queue.db'), lease_seconds=LEASE, max_attempts=2)
+    fakeredis = pytest.importorskip('fakeredis')
+    return RedisJobQueue(client=fakeredis.FakeRedis(), lease_seconds=LEASE, max_attempts=2)
+
+
+def expire_leases():
+    time.sleep(LEASE + 0.1)
+
+
+def test_claim_is_exclusive(job_queue):
+    job_queue.put_many('pages', [{'page_num': 1}, {'page_num': 2}])
+    first = job_queue.claim('pages', 'w1')
+    second = job_queue.claim('pages', 'w2')
+    assert first[1] == {'page_num': 1}
+    assert second[1] == {'page_num': 2}
+    assert job_queue.claim('pages', 'w3') is None
+    assert job_queue.counts('pages') == {'leased': 2}
+
+
+def test_complete_and_fail_require_lease_owner(job_queue):
+    job_queue.put_many('pages', [{'page_num': 1}])
+    job_id, _ = job_queue.claim('pages', 'w1')
+    assert not job_queue.complete(job_id, 'w2', {'items': []})
+    assert not job_queue.fail(job_id, 'w2', 'boom')
+    assert job_queue.counts('pages') == {'leased': 1}
+    assert job_queue.complete(job_id, 'w1', {'items': []})
+    assert not job_queue.complete(job_id, 'w1', {'items': []})
+    assert job_queue.counts('pages') == {'done': 1}
+
+
+def test_expired_lease_is_requeued(job_queue):
+    job_queue.put_many('pages', [{'page_num': 1}])
+    job_id, _ = job_queue.claim('pages', 'w1')
+    expire_leases()
+    assert job_queue.claim('pages', 'w2') == (job_id, {'page_num': 1})
+
+
+def test_stale_worker_cannot_finish_reclaimed_job(job_queue):
+    job_queue.put_many('pages', [{'page_num': 1}])
+    job_id, _ = job_queue.claim('pages', 'w1')
+    expire_leases()
+    assert job_queue.claim('pages', 'w2')[0] == job_id
+    assert not job_queue.extend_lease(job_id, 'w1')
+    assert not job_queue.complete(job_id, 'w1', {'stale': True})
+    assert not job_queue.fail(job_id, 'w1', 'stale')
+    assert job_queue.complete(job_id, 'w2', {'items': []})
+    assert job_queue.results('pages') == [({'page_num': 1}, 'done', {'items': []})]
+
+
+def test_heartbeat_keeps_lease(job_queue):
+    job_queue.put_many('pages', [{'page_num': 1}])
+    job_id, _ = job_queue.claim('pages', 'w1')
+    for _ in range(3):
+        time.sleep(LEASE / 2)
+        assert job_queue.extend_lease(job_id, 'w1')
+    assert job_queue.claim('pages', 'w2') is None
+    assert job_queue.complete(job_id, 'w1', {})
+
+
+def test_fail_retries_until_max_attempts(job_queue):
+    job_queue.put_many('pages', [{'page_num': 1}])
+    job_id, _ = job_queue.claim('pages', 'w1')
+    assert job_queue.fail(job_id, 'w1', 'boom')
+    assert job_queue.counts('pages') == {'pending': 1}
+    job_id, _ = job_queue.claim('pages', 'w1')
+    assert job_queue.fail(job_id, 'w1', 'boom')
+    assert job_queue.counts('pages') == {'failed': 1}
+    assert job_queue.claim('pages', 'w1') is None
+
+
+def test_expired_lease_counts_as_attempt(job_queue):
+    job_queue.put_many('pages', [{'page_num': 1}])
+    job_queue.claim('pages', 'w1')
+    expire_leases()
+    job_queue.claim('pages', 'w2')
+    expire_leases()
+    assert job_queue.counts('pages') == {'failed': 1}
+
+
+def test_redis_claim_has_no_window_without_lease():
+    # Job phải luôn nằm trong pending hoặc leases - không có lúc đã lấy ra mà chưa có lease
+    fakeredis = pytest.importorskip('fakeredis')
+    job_queue = RedisJobQueue(client=fakeredis.FakeRedis(), lease_seconds=LEASE)
+    job_queue.put_many('pages', [{'page_num': 1}])
+    job_id, _ = job_queue.claim('pages', 'w1')
+    client = job_queue.client
+    assert client.llen(job_queue._key('pages', 'pending')) == 0
+    assert client.zscore(job_queue._key('pages', 'leases'), job_id) is not None
+    expire_leases()
+    assert job_queue.claim('pages', 'w2')[0] == job_id
@@ -0,0 +1,155 @@
+import http.server
+import os
+import random
+import tempfile
+import threading
+import time
+
+import pytest
+
+from a import PixabayMusicDownloader, S3MultipartSink
+
+PART = S3MultipartSink.MIN_PART_SIZE
+
+
+class StubS3Client:
+    """
+    Client S3 giả: ghi lại các lời gọi, upload_part chậm ngẫu nhiên để part xong không theo thứ tự
+    """
+    def __init__(self):
+        self.calls = []
+        self.parts = {}
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def create_multipart_upload(self, Bucket, Key):
+        self.calls.append(('create', Key))
+        return {'UploadId': 'upload-1'}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(random.uniform(0, 0.02))
+        with self._lock:
+            self.active -= 1
+            self.parts[PartNumber] = Body
+        return {'ETag': f'etag-{PartNumber}'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.calls.append(('complete', Key, MultipartUpload['Parts']))
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.calls.append(('abort', Key))
+
+    def put_object(self, Bucket, Key, Body):
+        self.calls.append(('put', Key, Body))
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        return [{'Contents': []}]
+
+
+def test_parts_are_ordered_and_inflight_is_bounded():
+    client = StubS3Client()
+    sink = S3MultipartSink('bucket', 'music', part_size=PART, max_parallel_parts=2, client=client)
+    data = os.urandom(PART * 6 + 123)
+    writer = sink.open_writer('a.mp3')
+    for start in range(0, len(data), 65536):
+        writer.write(data[start:start + 65536])
+        # Chỉ gom tối đa một part trong buffer
+        assert len(writer._buffer) < PART
+    writer.commit()
+    sink.close()
+    _, key, parts = client.calls[-1]
+    assert key == 'music/a.mp3'
+    assert [part['PartNumber'] for part in parts] == list(range(1, 8))
+    assert [part['ETag'] for part in parts] == [f'etag-{number}' for number in range(1, 8)]
+    assert b''.join(client.parts[number] for number in range(1, 8)) == data
+    assert client.max_active <= 2
+
+
+def test_small_file_uses_single_put():
+    client = StubS3Client()
+    sink = S3MultipartSink('bucket', '', client=client)
+    writer = sink.open_writer('b.mp3')
+    writer.write(b'ID3' + b'\x00' * 100)
+    writer.commit()
+    sink.close()
+    assert client.calls == [('put', 'b.mp3', b'ID3' + b'\x00' * 100)]
+
+
+class AudioHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    body = b'ID3\x03' + os.urandom(PART * 2)
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'audio/mpeg')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+
+    def do_GET(self):
+        truncated = 'truncated' in self.path
+        self.send_response(200)
+        self.send_header('Content-Type', 'audio/mpeg')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        # Bản "truncated" cắt giữa chừng - verify độ dài phải thất bại
+        self.wfile.write(self.body[:PART + 1000] if truncated else self.body)
+
+
+@pytest.fixture
+def audio_server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), AudioHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+
+
+def download_to(sink, url, folder):
+    downloader = PixabayMusicDownloader()
+    downloader.music_list = [{'title': 'Track', 'download_url': url, 'index': 1}]
+    return downloader.download_music_range(1, 1, folder, 1, sink=sink)
+
+
+def test_failed_verification_aborts_multipart_upload(audio_server, tmp_path):
+    client = StubS3Client()
+    sink = S3MultipartSink('bucket', 'music', part_size=PART, client=client)
+    summary = download_to(sink, f'{audio_server}/truncated.mp3', str(tmp_path / 'downloads'))
+    sink.close()
+    assert summary['failed'] == 1
+    kinds = [call[0] for call in client.calls]
+    assert 'create' in kinds and 'abort' in kinds and 'complete' not in kinds
+
+
+def test_download_goes_straight_to_bucket(audio_server, tmp_path, monkeypatch):
+    moto = pytest.importorskip('moto')
+    boto3 = pytest.importorskip('boto3')
+    for name, value in (('AWS_ACCESS_KEY_ID', 'test'), ('AWS_SECRET_ACCESS_KEY', 'test'),
+                        ('AWS_DEFAULT_REGION', 'us-east-1')):
+        monkeypatch.setenv(name, value)
+    spool_dir = tmp_path / 'tmp'
+    spool_dir.mkdir()
+    monkeypatch.setattr(tempfile, 'tempdir', str(spool_dir))
+    monkeypatch.chdir(tmp_path)
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket='music')
+        sink = S3MultipartSink('music', 'piano', part_size=PART, client=client)
+        summary = download_to(sink, f'{audio_server}/track.mp3', 'downloads')
+        sink.close()
+        assert summary['success'] == 1
+        keys = [obj['Key'] for obj in client.list_objects_v2(Bucket='music')['Contents']]
+        assert len(keys) == 1 and keys[0].startswith('piano/')
+        assert client.get_object(Bucket='music', Key=keys[0])['Body'].read() == AudioHandler.body
+    # Không có file nào trên đĩa local (thư mục download, file tạm)
+    assert sorted(os.listdir(tmp_path)) == ['tmp']
+    assert os.listdir(spool_dir) == []
@@ -0,0 +1,49 @@
+import sqlite3
+
+from a import TrackCatalog, TrackIndex
+
+
+def make_tracks(count):
+    return [{'title': f'Piano {i}', 'download_url': f'https://pixabay.com/music/piano-{100000 + i}/', 'page': 1}
+            for i in range(count)]
+
+
+def test_imported_resolved_tracks_are_not_downloaded(tmp_path):
+    catalog = TrackCatalog(str(tmp_path / 'catalog.db'))
+    tracks = make_tracks(3)
+    tracks[0].update(resolved_url='https://cdn.pixabay.com/audio/a.mp3', resolved_at=1.0)
+    catalog.add_tracks(tracks)
+    catalog.set_resolved(tracks[1], 'https://cdn.pixabay.com/audio/b.mp3')
+    assert catalog.downloaded_keys() == set()
+    assert len(TrackIndex.from_catalog(catalog).search('downloaded:yes')) == 0
+
+
+def test_set_downloaded(tmp_path):
+    catalog = TrackCatalog(str(tmp_path / 'catalog.db'))
+    tracks = make_tracks(3)
+    catalog.add_tracks(tracks)
+    stamp = catalog.stamp()
+    catalog.set_downloaded(tracks[2], 'https://cdn.pixabay.com/audio/c.mp3', 1234)
+    assert catalog.downloaded_keys() == {'100002'}
+    assert catalog.stamp() != stamp
+    assert catalog.select_ids(['100002'])[0]['size'] == 1234
+    # Export/import sang catalog khác không mang theo trạng thái đã tải
+    catalog.export_jsonl(str(tmp_path / 'export.jsonl'))
+    other = TrackCatalog(str(tmp_path / 'other.db'))
+    assert other.import_jsonl(str(tmp_path / 'export.jsonl')) == (3, 0)
+    assert other.downloaded_keys() == set()
+
+
+def test_migrates_catalog_without_downloaded_at(tmp_path):
+    path = str(tmp_path / 'old.db')
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE tracks (track_id TEXT PRIMARY KEY, idx INTEGER NOT NULL UNIQUE, source TEXT, page INTEGER,
+                             title TEXT NOT NULL, detail_url TEXT, resolved_url TEXT, duration INTEGER,
+                             size INTEGER, crawled_at REAL NOT NULL, resolved_at REAL);
+        INSERT INTO tracks VALUES ('1', 1, NULL, 1, 'a', NULL, 'https://cdn/a.mp3', NULL, NULL, 1.0, 2.0);
+        INSERT INTO tracks VALUES ('2', 2, NULL, 1, 'b', NULL, NULL, NULL, NULL, 1.0, NULL);
+    """)
+    conn.commit()
+    conn.close()
+    assert TrackCatalog(path).downloaded_keys() == {'1'}
@@ -0,0 +1,48 @@
+import tracemalloc
+
+from a import Track, TrackIndex, TrackTable
+
+
+def make_tracks(count):
+    return [{'index': i + 1, 'id': str(100000 + i), 'title': f'Piano relax {i}' if i % 2 else f'Lofi beat {i}',
+             'download_url': f'https://pixabay.com/music/track-{100000 + i}/', 'page': i // 20 + 1,
+             'duration': 60 + i % 240} for i in range(count)]
+
+
+def allocated(build):
+    tracemalloc.start()
+    try:
+        kept = build()
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del kept
+    return size
+
+
+def test_search_filters():
+    index = TrackIndex(make_tracks(100))
+    assert isinstance(index.tracks, TrackTable)
+    result = index.search('piano page:1 duration:>60')
+    assert [track['id'] for track in result] == [str(100000 + i) for i in range(1, 20, 2)]
+    assert result[0]['title'] == 'Piano relax 1' and result[0]['page'] == 1
+    assert len(index.search('id:100005')) == 1
+    index.mark_downloaded('100003')
+    assert [track['id'] for track in index.search('piano downloaded:yes')] == ['100003']
+
+
+def test_save_load_roundtrip(tmp_path):
+    index = TrackIndex(make_tracks(50), downloaded=['100001'])
+    index.save(str(tmp_path / 'index.json'))
+    loaded = TrackIndex.load(str(tmp_path / 'index.json'))
+    assert [track.to_dict() for track in loaded.tracks] == [track.to_dict() for track in index.tracks]
+    assert [track['id'] for track in loaded.search('piano* downloaded:yes')] == ['100001']
+    assert loaded.add([make_tracks(1)[0]]) == 0
+
+
+def test_track_table_uses_less_memory_than_track_objects():
+    tracks = make_tracks(20000)
+    table_size = allocated(lambda: TrackTable(tracks))
+    objects_size = allocated(lambda: [Track.from_dict(track) for track in tracks])
+    # Chuỗi dùng chung với input - chỉ so phần mỗi track tự cấp phát
+    assert table_size / len(tracks) < objects_size / len(tracks) * 0.6